@@ -0,0 +1,285 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Callable, Sequence
+
+import black
+from black.mode import TargetVersion
+
+import blacken_docs
+
+# Snippets of unformatted Python, filled in with a random number.
+SNIPPETS = (
+    "f(1,2,{n})\n",
+    "x = [ {n},2,3 ]\n",
+    "def f{n}(a,b):\n    return a+b\n",
+    "class C{n}:\n    def m(self): return {n}\n",
+    "for i in range({n}):\n    print( i )\n",
+    "d = {{'a':{n}, 'b':[1,2]}}\n",
+    "if x=={n}:\n    y = x\nelse:\n    y = None\n",
+    "import os\nos.path.join( 'a','{n}' )\n",
+)
+PROSE = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod.\n"
+
+
+def _indent(code: str) -> str:
+    return "".join(
+        f"    {line}" if line != "\n" else line for line in code.splitlines(True)
+    )
+
+
+def _pycon(code: str) -> str:
+    lines = code.splitlines()
+    session = f">>> {lines[0]}\n" + "".join(f"... {line}\n" for line in lines[1:])
+    if len(lines) > 1:
+        session += "...\n"
+    return session
+
+
+# Each corpus's source format, whether it needs --rst-literal-blocks, and a
+# function wrapping code in a block.
+CORPORA: dict[str, tuple[str, bool, Callable[[str], str]]] = {
+    "md": ("markdown", False, lambda code: f"```python\n{code}```\n"),
+    "md-pycon": ("markdown", False, lambda code: f"```pycon\n{_pycon(code)}```\n"),
+    "rst": (
+        "rst",
+        False,
+        lambda code: f".. code-block:: python\n\n{_indent(code)}\n",
+    ),
+    "rst-pycon": (
+        "rst",
+        False,
+        lambda code: f".. code-block:: pycon\n\n{_indent(_pycon(code))}\n",
+    ),
+    "rst-literal": ("rst", True, lambda code: f"Example::\n\n{_indent(code)}\n"),
+    "latex": (
+        "latex",
+        False,
+        lambda code: f"\\begin{{minted}}{{python}}\n{code}\\end{{minted}}\n",
+    ),
+    "latex-pycon": (
+        "latex",
+        False,
+        lambda code: f"\\begin{{minted}}{{pycon}}\n{_pycon(code)}\\end{{minted}}\n",
+    ),
+    "pythontex": (
+        "latex",
+        False,
+        lambda code: f"\\begin{{pycode}}\n{code}\\end{{pycode}}\n",
+    ),
+}
+
+
+def generate(name: str, size: int, prose_lines: int, seed: int) -> tuple[str, int]:
+    # Return a document of about size bytes, with prose_lines lines of text
+    # between blocks, and its number of blocks.
+    wrap = CORPORA[name][2]
+    rng = random.Random(seed)
+    prose = f"\n{PROSE * prose_lines}\n"
+    parts = []
+    length = 0
+    blocks = 0
+    while length < size:
+        code = rng.choice(SNIPPETS).format(n=rng.randrange(1000))
+        part = prose + wrap(code)
+        parts.append(part)
+        length += len(part)
+        blocks += 1
+    return "".join(parts), blocks
+
+
+def _best_time(func: Callable[[], object], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def _peak_memory(func: Callable[[], object]) -> int:
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(
+    names: Sequence[str],
+    size: int,
+    prose_lines: int,
+    seed: int,
+    repeat: int,
+    black_mode: black.Mode,
+) -> dict[str, dict[str, float]]:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in names:
+            src, blocks = generate(name, size, prose_lines, seed)
+            megabytes = len(src.encode()) / 1e6
+            funcs = _benchmark_funcs(name, src, tmpdir, black_mode)
+            for func_name, func in funcs.items():
+                seconds = _best_time(func, repeat)
+                results[f"{name} {func_name}"] = {
+                    "blocks_per_sec": blocks / seconds,
+                    "mb_per_sec": megabytes / seconds,
+                    "peak_mb": _peak_memory(func) / 1e6,
+                }
+    return results
+
+
+def _benchmark_funcs(
+    name: str, src: str, tmpdir: str, black_mode: black.Mode
+) -> dict[str, Callable[[], object]]:
+    source_format, rst_literal_blocks, _ = CORPORA[name]
+
+    def format_str() -> None:
+        blacken_docs.format_str(
+            src,
+            black_mode,
+            rst_literal_blocks=rst_literal_blocks,
+            source_format=source_format,
+        )
+
+    filename = os.path.join(tmpdir, f"{name}.txt")
+    with open(filename, "w", encoding="UTF-8") as f:
+        f.write(src)
+    # Check only and without the cache, so each run does the same work.
+    argv = [filename, "--check", "--no-cache", "--format", source_format]
+    if rst_literal_blocks:
+        argv.append("--rst-literal-blocks")
+    for target_version in black_mode.target_versions:
+        argv += ["--target-version", target_version.name.lower()]
+
+    def main() -> None:
+        with open(os.devnull, "w") as devnull:
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                blacken_docs.main(argv)
+            finally:
+                sys.stdout = stdout
+
+    return {"format_str": format_str, "main": main}
+
+
+def compare(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, dict[str, float]],
+    tolerance: float,
+) -> bool:
+    # Print changes from the baseline and return whether any result is worse
+    # than it by more than tolerance.
+    regressed = False
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        old = baseline[key]
+        speed = result["mb_per_sec"] / old["mb_per_sec"]
+        memory = result["peak_mb"] / old["peak_mb"] if old["peak_mb"] else 1.0
+        flags = []
+        if speed < 1 - tolerance:
+            flags.append("slower")
+        if memory > 1 + tolerance:
+            flags.append("more memory")
+        regressed = regressed or bool(flags)
+        print(
+            f"{key:24} speed {speed:6.2f}x  memory {memory:6.2f}x  {', '.join(flags)}"
+        )
+    return regressed
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark blacken-docs on generated documents."
+    )
+    parser.add_argument(
+        "corpora",
+        nargs="*",
+        help=f"block types to generate documents for, from {list(CORPORA)} "
+        + "(default: all)",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=100_000,
+        help="approximate size of each document in bytes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--prose-lines",
+        type=int,
+        default=10,
+        help="lines of text between code blocks (default: %(default)s)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="runs to take the best time of (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-t",
+        "--target-version",
+        action="append",
+        type=lambda v: TargetVersion[v.upper()],
+        default=[],
+        dest="target_versions",
+    )
+    parser.add_argument("--save", metavar="FILE", help="save results as a baseline")
+    parser.add_argument(
+        "--compare",
+        metavar="FILE",
+        help="compare results to a saved baseline, failing on regressions",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="fraction of slowdown or memory growth allowed (default: %(default)s)",
+    )
+    args = parser.parse_args(argv)
+    for name in args.corpora:
+        if name not in CORPORA:
+            parser.error(f"unknown corpus {name!r}")
+
+    black_mode = black.Mode(target_versions=set(args.target_versions))
+    results = run(
+        args.corpora or list(CORPORA),
+        size=args.size,
+        prose_lines=args.prose_lines,
+        seed=args.seed,
+        repeat=args.repeat,
+        black_mode=black_mode,
+    )
+    for key, result in results.items():
+        print(
+            f"{key:24} {result['blocks_per_sec']:10.1f} blocks/s"
+            f" {result['mb_per_sec']:8.3f} MB/s"
+            f" {result['peak_mb']:8.2f} MB peak"
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
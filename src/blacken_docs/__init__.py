@@ -1,42 +1,70 @@
 from __future__ import annotations
 
 import argparse
+import codecs
+import collections
 import contextlib
+import functools
+import io
+import itertools
+import mmap
+import os
+import queue
 import re
+import signal
+import sys
 import textwrap
-from bisect import bisect
-from collections.abc import Generator, Sequence
+import threading
+import time
+from array import array
+from bisect import bisect, bisect_left
+from collections.abc import Callable, Generator, Iterator, Sequence
 from re import Match
+from typing import TYPE_CHECKING, BinaryIO
 
-import black
-from black.const import DEFAULT_LINE_LENGTH
-from black.mode import TargetVersion
+from blacken_docs._stats import Stats
+
+# Black and the cache are imported only once a file has a candidate code
+# block, so runs over files without any skip the cost of importing them.
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+    import black
+
+    from blacken_docs._cache import Cache
 
 PYGMENTS_PY_LANGS = frozenset(("python", "py", "sage", "python3", "py3", "numpy"))
 PYGMENTS_PY_LANGS_RE_FRAGMENT = f"({'|'.join(PYGMENTS_PY_LANGS)})"
+MD_OPEN = (
+    r"^(?P<indent> *)```[^\S\r\n]*"
+    + f"(?P<lang>{PYGMENTS_PY_LANGS_RE_FRAGMENT})"
+    + r"( .*?)?\n"
+)
 MD_RE = re.compile(
-    r"(?P<before>^(?P<indent> *)```[^\S\r\n]*"
-    + PYGMENTS_PY_LANGS_RE_FRAGMENT
-    + r"( .*?)?\n)"
+    rf"(?P<before>{MD_OPEN})"
     r"(?P<code>.*?)"
     r"(?P<after>^(?P=indent)```[^\S\r\n]*$)",
     re.DOTALL | re.MULTILINE,
 )
+MD_PYCON_OPEN = r"^(?P<indent> *)```[^\S\r\n]*(?P<lang>pycon)( .*?)?\n"
 MD_PYCON_RE = re.compile(
-    r"(?P<before>^(?P<indent> *)```[^\S\r\n]*pycon( .*?)?\n)"
+    rf"(?P<before>{MD_PYCON_OPEN})"
     r"(?P<code>.*?)"
     r"(?P<after>^(?P=indent)```[^\S\r\n]*$)",
     re.DOTALL | re.MULTILINE,
 )
 BLOCK_TYPES = "(code|code-block|sourcecode|ipython)"
 DOCTEST_TYPES = "(testsetup|testcleanup|testcode)"
-RST_RE = re.compile(
-    rf"(?P<before>"
+RST_HEADER = (
     rf"^(?P<indent> *)\.\. ("
     rf"jupyter-execute::|"
     rf"{BLOCK_TYPES}:: (?P<lang>\w+)|"
     rf"{DOCTEST_TYPES}::.*"
     rf")\n"
+)
+RST_RE = re.compile(
+    rf"(?P<before>"
+    rf"{RST_HEADER}"
     rf"((?P=indent) +:.*\n)*"
     rf"( *\n)*"
     rf")"
@@ -52,39 +80,90 @@ RST_LITERAL_BLOCKS_RE = re.compile(
     r"(?P<code>(^((?P=indent) +.*)?\n)+)",
     re.MULTILINE,
 )
+RST_PYCON_HEADER = (
+    r"(?P<indent> *)\.\. ((code|code-block):: (?P<lang>pycon)|doctest::.*)\n"
+)
 RST_PYCON_RE = re.compile(
     r"(?P<before>"
-    r"(?P<indent> *)\.\. ((code|code-block):: pycon|doctest::.*)\n"
+    rf"{RST_PYCON_HEADER}"
     r"((?P=indent) +:.*\n)*"
     r"\n*"
     r")"
     r"(?P<code>(^((?P=indent) +.*)?(\n|$))+)",
     re.MULTILINE,
 )
+# The rST patterns backtrack heavily to find where their code ends, so their
+# matches are found by matching only their header line, then following the
+# lines of their options, blank lines, and code. For each pattern: its header
+# pattern, whether its blank lines may hold spaces, whether its code may end
+# without a newline, and whether its indent may be shorter than the header's,
+# as for literal blocks.
+RST_HEADERS = {
+    RST_RE: (re.compile(RST_HEADER, re.MULTILINE), True, False, False),
+    RST_PYCON_RE: (re.compile(RST_PYCON_HEADER), False, True, False),
+    RST_LITERAL_BLOCKS_RE: (
+        re.compile(r"(?! *\.\. )(?P<indent> *)(?! ).*::\n"),
+        False,
+        False,
+        True,
+    ),
+}
 PYCON_PREFIX = ">>> "
 PYCON_CONTINUATION_PREFIX = "..."
 PYCON_CONTINUATION_RE = re.compile(
     rf"^{re.escape(PYCON_CONTINUATION_PREFIX)}( |$)",
 )
+LATEX_OPEN = r"^(?P<indent> *)\\begin{minted}(\[.*?\])?{(?P<lang>python)}\n"
 LATEX_RE = re.compile(
-    r"(?P<before>^(?P<indent> *)\\begin{minted}(\[.*?\])?{python}\n)"
+    rf"(?P<before>{LATEX_OPEN})"
     r"(?P<code>.*?)"
     r"(?P<after>^(?P=indent)\\end{minted}\s*$)",
     re.DOTALL | re.MULTILINE,
 )
+LATEX_PYCON_OPEN = r"^(?P<indent> *)\\begin{minted}(\[.*?\])?{(?P<lang>pycon)}\n"
 LATEX_PYCON_RE = re.compile(
-    r"(?P<before>^(?P<indent> *)\\begin{minted}(\[.*?\])?{pycon}\n)"
+    rf"(?P<before>{LATEX_PYCON_OPEN})"
     r"(?P<code>.*?)"
     r"(?P<after>^(?P=indent)\\end{minted}\s*$)",
     re.DOTALL | re.MULTILINE,
 )
 PYTHONTEX_LANG = r"(?P<lang>pyblock|pycode|pyconsole|pyverbatim)"
+PYTHONTEX_OPEN = rf"^(?P<indent> *)\\begin{{{PYTHONTEX_LANG}}}\n"
 PYTHONTEX_RE = re.compile(
-    rf"(?P<before>^(?P<indent> *)\\begin{{{PYTHONTEX_LANG}}}\n)"
+    rf"(?P<before>{PYTHONTEX_OPEN})"
     rf"(?P<code>.*?)"
     rf"(?P<after>^(?P=indent)\\end{{(?P=lang)}}\s*$)",
     re.DOTALL | re.MULTILINE,
 )
+# For an unterminated block, the fenced patterns scan to the end of the
+# document from every line opening one. So their opening lines are matched
+# alone, and their closing lines looked up by indent, and language if the
+# closing line repeats it, in an index of each document's closing lines, built
+# in one pass. For each pattern: the
+# patterns of its opening and closing lines.
+MD_CLOSE_RE = re.compile(r"^(?P<indent> *)```(?=[^\S\r\n]*$)", re.DOTALL | re.MULTILINE)
+LATEX_CLOSE_RE = re.compile(
+    r"^(?P<indent> *)\\end\{minted\}(?=\s*$)", re.DOTALL | re.MULTILINE
+)
+FENCES = {
+    MD_RE: (re.compile(MD_OPEN, MD_RE.flags), MD_CLOSE_RE),
+    MD_PYCON_RE: (re.compile(MD_PYCON_OPEN, MD_PYCON_RE.flags), MD_CLOSE_RE),
+    LATEX_RE: (re.compile(LATEX_OPEN, LATEX_RE.flags), LATEX_CLOSE_RE),
+    LATEX_PYCON_RE: (
+        re.compile(LATEX_PYCON_OPEN, LATEX_PYCON_RE.flags),
+        LATEX_CLOSE_RE,
+    ),
+    PYTHONTEX_RE: (
+        re.compile(PYTHONTEX_OPEN, PYTHONTEX_RE.flags),
+        re.compile(
+            rf"^(?P<indent> *)\\end\{{{PYTHONTEX_LANG}\}}(?=\s*$)",
+            re.DOTALL | re.MULTILINE,
+        ),
+    ),
+}
+# Lines that may start any of the above blocks.
+BLOCK_START_RE = re.compile(r"^ *(?:```|\.\. |\\begin\{)|::$", re.MULTILINE)
+NEWLINE_RE = re.compile("\n")
 INDENT_RE = re.compile("^ +(?=[^ ])", re.MULTILINE)
 TRAILING_NL_RE = re.compile(r"\n+\Z", re.MULTILINE)
 ON_OFF = r"blacken-docs:(on|off)"
@@ -99,10 +178,379 @@ ON_OFF_COMMENT_RE = re.compile(
 )
 
 
+# Small Python code blocks are formatted in batches, separated by this
+# statement, to save Black's per-call overhead. A statement, rather than a
+# comment, ends any decorator, or if or try statement, so blocks that don't
+# parse alone don't parse in a batch either.
+BATCH_SEPARATOR = "__blacken_docs_batch_separator__ = 0"
+BATCH_SEPARATOR_RE = re.compile(rf"^{re.escape(BATCH_SEPARATOR)}\n", re.MULTILINE)
+BATCH_SIZE = 100
+BATCH_MAX_LINES = 20
+DOCSTRING_START_RE = re.compile(r"([^\S\n]*(#.*)?\n)*[^\S\n]*[a-zA-Z]{0,2}['\"]")
+
+# Names of Black's target versions, such as PY312.
+TARGET_VERSION_RE = re.compile(r"PY3[0-9]+")
+
+# Files at least this large are memory-mapped and processed as bytes.
+MMAP_MIN_SIZE = 1024 * 1024
+MMAP_CHUNK_SIZE = 1024 * 1024
+# The UTF-8 encodings of the characters that \s matches in text but not in
+# bytes. Memory-mapped files holding any are read as text, so their code blocks
+# end where they would in text.
+UNICODE_SPACE_RE = re.compile(
+    rb"[\x1c-\x1f]|\xc2[\x85\xa0]|\xe1\x9a\x80|\xe2\x80[\x80-\x8a\xa8\xa9\xaf]"
+    rb"|\xe2\x81\x9f|\xe3\x80\x80"
+)
+
+# Files read ahead of formatting, and rewritten files waiting to be written,
+# when formatting in one process.
+PIPELINE_DEPTH = 8
+
+
+def _pycon_session(code: str) -> list[tuple[str, bool]]:
+    # Split a pycon session into its dedented lines, and the code of each
+    # prompt with its continuation lines, marked True.
+    parts: list[tuple[str, bool]] = []
+    fragment: list[str] | None = None
+    indentation: int | None = None
+    for line in code.splitlines():
+        orig_line, line = line, line.lstrip()
+        if indentation is None and line:
+            indentation = len(orig_line) - len(line)
+        continuation_match = PYCON_CONTINUATION_RE.match(line)
+        if continuation_match and fragment is not None:
+            fragment.append(line[continuation_match.end() :] + "\n")
+            continue
+        if fragment is not None:
+            parts.append(("".join(fragment), True))
+            fragment = None
+        if line.startswith(PYCON_PREFIX):
+            fragment = [line[len(PYCON_PREFIX) :] + "\n"]
+        else:
+            parts.append((orig_line[indentation:] + "\n", False))
+    if fragment is not None:
+        parts.append(("".join(fragment), True))
+    return parts
+
+
+def _pycon_prompts(code: str) -> str:
+    # Return the lines of a prompt running code.
+    code_lines = code.splitlines()
+    lines = [f"{PYCON_PREFIX}{code_lines[0]}\n"]
+    for line in code_lines[1:]:
+        # Skip blank lines to handle Black adding a blank above functions
+        # within blocks. A blank line would end the REPL continuation prompt.
+        #
+        # >>> if True:
+        # ...     def f():
+        # ...         pass
+        # ...
+        if line:
+            lines.append(f"{PYCON_CONTINUATION_PREFIX} {line}\n")
+    if code_lines[-1].startswith(" "):
+        lines.append(f"{PYCON_CONTINUATION_PREFIX}\n")
+    return "".join(lines)
+
+
+def _batchable(code: str) -> bool:
+    if not code.endswith("\n") or code.count("\n") > BATCH_MAX_LINES:
+        return False
+    # Black treats some code differently at the start or end of a file, or
+    # may join it with a following block.
+    if BATCH_SEPARATOR in code or "fmt:" in code or "yapf:" in code:
+        return False
+    if code.count('"""') % 2 or code.count("'''") % 2:
+        return False
+    if DOCSTRING_START_RE.match(code):
+        return False
+    last_line = code.rstrip().rpartition("\n")[2].lstrip()
+    return not last_line.startswith("#") and not last_line.endswith("\\")
+
+
+class SourceFormat:
+    def __init__(
+        self,
+        extensions: tuple[str, ...],
+        block_types: frozenset[str],
+        triggers: tuple[str, ...],
+    ) -> None:
+        # File extensions to detect the format from.
+        self.extensions = extensions
+        # Types of code block to look for.
+        self.block_types = block_types
+        # Substrings that appear in every such block, so documents without
+        # any can be skipped.
+        self.triggers = triggers
+
+
+MARKDOWN_BLOCK_TYPES = frozenset(("md", "md-pycon"))
+RST_BLOCK_TYPES = frozenset(("rst", "rst-pycon", "rst-literal"))
+LATEX_BLOCK_TYPES = frozenset(("latex", "latex-pycon", "pythontex"))
+PYCON_BLOCK_TYPES = frozenset(("md-pycon", "rst-pycon", "latex-pycon"))
+FORMATS = {
+    "markdown": SourceFormat((".md", ".markdown"), MARKDOWN_BLOCK_TYPES, ("```",)),
+    "rst": SourceFormat((".rst",), RST_BLOCK_TYPES, (".. ", "::")),
+    "latex": SourceFormat((".tex",), LATEX_BLOCK_TYPES, ("\\begin{",)),
+    # Only the docstrings of Python files are searched.
+    "python": SourceFormat(
+        (".py",),
+        MARKDOWN_BLOCK_TYPES | RST_BLOCK_TYPES | LATEX_BLOCK_TYPES,
+        ("```", ".. ", "::", "\\begin{"),
+    ),
+    # Used for other files.
+    "all": SourceFormat(
+        (),
+        MARKDOWN_BLOCK_TYPES | RST_BLOCK_TYPES | LATEX_BLOCK_TYPES,
+        ("```", ".. ", "::", "\\begin{"),
+    ),
+}
+
+
+def detect_format(filename: str) -> str:
+    ext = os.path.splitext(filename)[1].lower()
+    for name, source_format in FORMATS.items():
+        if ext in source_format.extensions:
+            return name
+    return "all"
+
+
 class CodeBlockError:
-    def __init__(self, offset: int, exc: Exception) -> None:
+    def __init__(
+        self,
+        offset: int,
+        exc: Exception,
+        lineno: int | None = None,
+        col_offset: int | None = None,
+    ) -> None:
         self.offset = offset
         self.exc = exc
+        # 1-indexed line and 0-indexed column of the offset, as in ast. Set
+        # for errors from format_str(), and None if not given.
+        self.lineno = lineno
+        self.col_offset = col_offset
+
+
+class UnterminatedBlockError(ValueError):
+    # The exception of a CodeBlockError for a fenced code block without a
+    # closing line.
+    pass
+
+
+class BlockTimeoutError(TimeoutError):
+    # The exception of a CodeBlockError for a code block that Black didn't
+    # format within the block timeout.
+    pass
+
+
+class CodeBlock:
+    # A Python code block, as found by iter_code_blocks(). It holds offsets
+    # into the document, so its text is only copied when asked for.
+    __slots__ = (
+        "kind",
+        "language",
+        "indent",
+        "start",
+        "end",
+        "code_start",
+        "code_end",
+        "_src",
+    )
+
+    def __init__(
+        self,
+        src: str,
+        kind: str,
+        language: str | None,
+        indent: int,
+        start: int,
+        end: int,
+        code_start: int,
+        code_end: int,
+    ) -> None:
+        self._src = src
+        # The type of block, such as "md", "rst-pycon", or "pythontex".
+        self.kind = kind
+        # The language given by the block, if any, such as "python", "py3",
+        # "pycon", or "pycode".
+        self.language = language
+        # The number of spaces before the block's opening line.
+        self.indent = indent
+        # Offsets of the whole block, and of its code, in the document.
+        self.start = start
+        self.end = end
+        self.code_start = code_start
+        self.code_end = code_end
+
+    @property
+    def text(self) -> str:
+        return self._src[self.start : self.end]
+
+    @property
+    def code(self) -> str:
+        # The code as written, without dedenting or removing prompts.
+        return self._src[self.code_start : self.code_end]
+
+
+class _LineIndex:
+    def __init__(self, src: str) -> None:
+        # Offsets of the start of each line.
+        self.starts = array("q", [0])
+        self.starts.extend(match.end() for match in NEWLINE_RE.finditer(src))
+
+    def position(self, offset: int) -> tuple[int, int]:
+        lineno = bisect(self.starts, offset)
+        return lineno, offset - self.starts[lineno - 1]
+
+
+@functools.cache
+def _ascii_pattern(pattern: re.Pattern[str]) -> re.Pattern[str]:
+    # Matches like the bytes version of pattern, for searching UTF-8 encoded
+    # text decoded as latin-1.
+    return re.compile(pattern.pattern, (pattern.flags & ~re.UNICODE) | re.ASCII)
+
+
+def _block_matcher(
+    pattern: re.Pattern[str], ascii: bool
+) -> Callable[[str, int], Match[str] | None]:
+    # Return a function matching pattern at a position in a string.
+    rst = RST_HEADERS.get(pattern)
+    fence = FENCES.get(pattern)
+    if ascii:
+        pattern = _ascii_pattern(pattern)
+    if fence is not None:
+        open_re, close_re = fence
+        if ascii:
+            open_re = _ascii_pattern(open_re)
+            close_re = _ascii_pattern(close_re)
+        return _FenceMatcher(pattern, open_re, close_re).match
+    if rst is None:
+        return pattern.match
+    header_re, blank_spaces, open_end, literal = rst
+    if ascii:
+        header_re = _ascii_pattern(header_re)
+    return functools.partial(
+        _match_rst_block, pattern, header_re, blank_spaces, open_end, literal
+    )
+
+
+class _FenceMatcher:
+    def __init__(
+        self,
+        pattern: re.Pattern[str],
+        open_re: re.Pattern[str],
+        close_re: re.Pattern[str],
+    ) -> None:
+        self.pattern = pattern
+        self.open_re = open_re
+        self.close_re = close_re
+        self.closing_lang = "lang" in close_re.groupindex
+        # The starts of the closing lines of the last string searched, by
+        # indent and language.
+        self.src: str | None = None
+        self.closes: dict[tuple[str, str | None], list[int]] = {}
+
+    def match(self, src: str, pos: int) -> Match[str] | None:
+        # Raises UnterminatedBlockError if a block opens at pos but never
+        # closes.
+        opening = self.open_re.match(src, pos)
+        if opening is None:
+            return None
+        if src is not self.src:
+            self.src = src
+            self.closes = {}
+            for close in self.close_re.finditer(src):
+                self.closes.setdefault(self._key(close), []).append(close.start())
+        closes = self.closes.get(self._key(opening), [])
+        if bisect_left(closes, opening.end()) == len(closes):
+            raise UnterminatedBlockError("unterminated code block")
+        # The pattern now stops at the first closing line.
+        return self.pattern.match(src, pos)
+
+    def _key(self, match: Match[str]) -> tuple[str, str | None]:
+        return match["indent"], match["lang"] if self.closing_lang else None
+
+
+def _match_rst_block(
+    pattern: re.Pattern[str],
+    header_re: re.Pattern[str],
+    blank_spaces: bool,
+    open_end: bool,
+    literal: bool,
+    src: str,
+    pos: int,
+) -> Match[str] | None:
+    header = header_re.match(src, pos)
+    if header is None:
+        return None
+    # Like the pattern, a literal block takes the longest indent its code
+    # lines follow, which must be shorter than the next line's.
+    indent = len(header["indent"])
+    while (
+        end := _rst_block_end(src, header.end(), indent, blank_spaces, open_end)
+    ) is None:
+        line_end = src.find("\n", header.end())
+        if not literal or line_end == -1:
+            return None
+        line = src[header.end() : line_end]
+        indent = min(indent, len(line) - len(line.lstrip(" "))) - 1
+        if indent < 0:
+            return None
+    if literal:
+        pattern = _indented_pattern(pattern, indent)
+    # Only let the pattern see the block and the line that ended it, so that
+    # it matches the same groups without searching further.
+    line_end = src.find("\n", end)
+    return pattern.match(src, pos, len(src) if line_end == -1 else line_end + 1)
+
+
+@functools.lru_cache(maxsize=64)
+def _indented_pattern(pattern: re.Pattern[str], indent: int) -> re.Pattern[str]:
+    return re.compile(
+        pattern.pattern.replace("(?P<indent> *)", f"(?P<indent> {{{indent}}})", 1),
+        pattern.flags,
+    )
+
+
+def _rst_block_end(
+    src: str, pos: int, indent: int, blank_spaces: bool, open_end: bool
+) -> int | None:
+    # Return the end of the options, blank lines, and code lines following an
+    # rST block header ending at pos, in one pass over the lines, or None if
+    # there's no code. This matches the end of the rST patterns: when no code
+    # follows the blank lines, they backtrack to start the code at the last
+    # blank or option line that can be code.
+    fallback = None
+    options = True
+    while True:
+        line_end = src.find("\n", pos)
+        if line_end == -1:
+            break
+        line = src[pos:line_end]
+        content = line.lstrip(" ")
+        code = not line or len(line) - len(content) > indent
+        if options and code and content.startswith(":"):
+            fallback = line_end + 1
+        elif not content if blank_spaces else not line:
+            options = False
+            if code:
+                fallback = line_end + 1
+        else:
+            break
+        pos = line_end + 1
+
+    start = pos
+    while True:
+        line_end = src.find("\n", pos)
+        if line_end == -1:
+            line = src[pos:]
+            if open_end and (not line or len(line) - len(line.lstrip(" ")) > indent):
+                return len(src)
+            break
+        line = src[pos:line_end]
+        if line and len(line) - len(line.lstrip(" ")) <= indent:
+            break
+        pos = line_end + 1
+    return pos if pos > start else fallback
 
 
 def format_str(
@@ -110,12 +558,97 @@ def format_str(
     black_mode: black.Mode,
     *,
     rst_literal_blocks: bool = False,
+    source_format: str = "all",
+    cache: Cache | None = None,
+    stats: Stats | None = None,
+    lines: Sequence[tuple[int, int]] | None = None,
+    block_timeout: float | None = None,
+    max_block_lines: int | None = None,
 ) -> tuple[str, Sequence[CodeBlockError]]:
-    errors: list[CodeBlockError] = []
+    edits, errors = _format_blocks(
+        src,
+        black_mode,
+        rst_literal_blocks=rst_literal_blocks,
+        source_format=source_format,
+        cache=cache,
+        stats=stats,
+        lines=lines,
+        block_timeout=block_timeout,
+        max_block_lines=max_block_lines,
+        utf8=False,
+    )
+    if not edits:
+        return src, errors
+    parts = []
+    last_end = 0
+    for start, end, replacement in edits:
+        parts.append(src[last_end:start])
+        parts.append(replacement)
+        last_end = end
+    parts.append(src[last_end:])
+    return "".join(parts), errors
+
+
+def iter_code_blocks(
+    src: str,
+    *,
+    rst_literal_blocks: bool = False,
+    source_format: str = "all",
+    errors: list[CodeBlockError] | None = None,
+) -> Iterator[CodeBlock]:
+    # Yield the Python code blocks in src that format_str() formats, in
+    # order, as they're found. Errors for code blocks without a closing line
+    # are added to errors, if given.
+    line_index: _LineIndex | None = None
+
+    def _unterminated(start: int, end: int, exc: UnterminatedBlockError) -> None:
+        nonlocal line_index
+        if errors is not None:
+            if line_index is None:
+                line_index = _LineIndex(src)
+            errors.append(CodeBlockError(start, exc, *line_index.position(start)))
+
+    return _iter_code_blocks(
+        src,
+        rst_literal_blocks=rst_literal_blocks,
+        source_format=source_format,
+        utf8=False,
+        unterminated=_unterminated,
+    )
+
+
+def _iter_code_blocks(
+    src: str,
+    *,
+    rst_literal_blocks: bool,
+    source_format: str,
+    utf8: bool,
+    unterminated: Callable[[int, int, UnterminatedBlockError], None],
+) -> Generator[CodeBlock]:
+    # With *utf8*, *src* is UTF-8 encoded text decoded as latin-1, searched
+    # with ASCII-only patterns, so offsets are byte offsets.
+    block_format = FORMATS[source_format]
+    if not any(trigger in src for trigger in block_format.triggers):
+        return
+    if source_format == "python":
+        yield from _iter_docstring_code_blocks(
+            src,
+            rst_literal_blocks=rst_literal_blocks,
+            utf8=utf8,
+            unterminated=unterminated,
+        )
+        return
+
+    block_start_re = BLOCK_START_RE
+    on_off_comment_re = ON_OFF_COMMENT_RE
+    if utf8:
+        block_start_re = _ascii_pattern(block_start_re)
+        on_off_comment_re = _ascii_pattern(on_off_comment_re)
 
     off_ranges = []
     off_start = None
-    for comment in re.finditer(ON_OFF_COMMENT_RE, src):
+    comments = on_off_comment_re.finditer(src) if "blacken-docs:" in src else ()
+    for comment in comments:
         # Check for the "off" value across the multiple (on|off) groups.
         if "off" in comment.groups():
             if off_start is None:
@@ -127,155 +660,417 @@ def format_str(
     if off_start is not None:
         off_ranges.append((off_start, len(src)))
 
-    def _within_off_range(code_range: tuple[int, int]) -> bool:
-        index = bisect(off_ranges, code_range)
-        try:
-            off_start, off_end = off_ranges[index - 1]
-        except IndexError:
-            return False
-        code_start, code_end = code_range
-        return code_start >= off_start and code_end <= off_end
-
-    @contextlib.contextmanager
-    def _collect_error(match: Match[str]) -> Generator[None]:
-        try:
-            yield
-        except Exception as e:
-            errors.append(CodeBlockError(match.start(), e))
-
-    def _md_match(match: Match[str]) -> str:
-        if _within_off_range(match.span()):
-            return match[0]
-        code = textwrap.dedent(match["code"])
-        with _collect_error(match):
-            code = black.format_str(code, mode=black_mode)
-        code = textwrap.indent(code, match["indent"])
-        return f"{match['before']}{code}{match['after']}"
-
-    def _rst_match(match: Match[str]) -> str:
-        if _within_off_range(match.span()):
-            return match[0]
-        lang = match["lang"]
-        if lang is not None and lang not in PYGMENTS_PY_LANGS:
-            return match[0]
-        if not match["code"].strip():
-            return match[0]
-        min_indent = min(INDENT_RE.findall(match["code"]))
-        trailing_ws_match = TRAILING_NL_RE.search(match["code"])
-        assert trailing_ws_match
-        trailing_ws = trailing_ws_match.group()
-        code = textwrap.dedent(match["code"])
-        with _collect_error(match):
-            code = black.format_str(code, mode=black_mode)
-        code = textwrap.indent(code, min_indent)
-        return f"{match['before']}{code.rstrip()}{trailing_ws}"
-
-    def _rst_literal_blocks_match(match: Match[str]) -> str:
-        if _within_off_range(match.span()):
-            return match[0]
-        if not match["code"].strip():
-            return match[0]
-        min_indent = min(INDENT_RE.findall(match["code"]))
-        trailing_ws_match = TRAILING_NL_RE.search(match["code"])
+    # Each block type's name, and a function matching its pattern in src.
+    block_types = [
+        (block_type, _block_matcher(pattern, utf8))
+        for block_type, pattern in (
+            ("md", MD_RE),
+            ("md-pycon", MD_PYCON_RE),
+            ("rst", RST_RE),
+            ("rst-pycon", RST_PYCON_RE),
+            ("rst-literal", RST_LITERAL_BLOCKS_RE),
+            ("latex", LATEX_RE),
+            ("latex-pycon", LATEX_PYCON_RE),
+            ("pythontex", PYTHONTEX_RE),
+        )
+        if block_type in block_format.block_types
+        and (rst_literal_blocks or block_type != "rst-literal")
+    ]
+
+    # Find all blocks in one pass over the lines that can start a block,
+    # jumping over off ranges. A block that is skipped, such as a non-Python
+    # rST code block, only hides later matches of its own type, so blocks of
+    # other types nested inside it are still found, as when each type was
+    # substituted in turn.
+    type_ends = [0] * len(block_types)
+    off_ranges.append((len(src), len(src)))
+    off_index = 0
+    pos = 0
+    while pos < len(src):
+        off_start, off_end = off_ranges[off_index]
+        if pos >= off_start:
+            off_index += 1
+            line_end = src.find("\n", off_end)
+            pos = max(pos, len(src) if line_end == -1 else line_end + 1)
+            continue
+        start_match = block_start_re.search(src, pos, off_start)
+        if start_match is None:
+            pos = off_start
+            continue
+        line_start = src.rfind("\n", 0, start_match.start()) + 1
+        line_end = src.find("\n", start_match.end())
+        pos = len(src) if line_end == -1 else line_end + 1
+        for index, (name, match_block) in enumerate(block_types):
+            if line_start < type_ends[index]:
+                continue
+            try:
+                match = match_block(src, line_start)
+            except UnterminatedBlockError as e:
+                unterminated(line_start, pos, e)
+                continue
+            if match is None:
+                continue
+            type_ends[index] = block_end = match.end()
+            language = match["lang"] if "lang" in match.re.groupindex else None
+            if (
+                name == "rst"
+                and language is not None
+                and language not in PYGMENTS_PY_LANGS
+            ):
+                continue
+            if name in ("rst", "rst-literal"):
+                code = match["code"]
+                if utf8:
+                    code = code.encode("latin-1").decode()
+                if not code.strip():
+                    continue
+            yield CodeBlock(
+                src,
+                name,
+                language,
+                len(match["indent"]),
+                line_start,
+                block_end,
+                match.start("code"),
+                match.end("code"),
+            )
+            if block_end > 0 and src[block_end - 1] != "\n":
+                line_end = src.find("\n", block_end)
+                block_end = len(src) if line_end == -1 else line_end + 1
+            pos = max(pos, block_end)
+            type_ends = [max(type_end, block_end) for type_end in type_ends]
+            break
+
+
+def _iter_docstring_code_blocks(
+    src: str,
+    *,
+    rst_literal_blocks: bool,
+    utf8: bool,
+    unterminated: Callable[[int, int, UnterminatedBlockError], None],
+) -> Generator[CodeBlock]:
+    # Yield the code blocks in the docstrings of the Python module src,
+    # searching each docstring as a document of its own. Tokenizing costs
+    # more than searching the whole module, so it's only done once a code
+    # block is found anywhere. A module that can't be tokenized is searched
+    # whole.
+    found = False
+
+    def _found(start: int, end: int, exc: UnterminatedBlockError) -> None:
+        nonlocal found
+        found = True
+
+    blocks = _iter_code_blocks(
+        src,
+        rst_literal_blocks=rst_literal_blocks,
+        source_format="all",
+        utf8=utf8,
+        unterminated=_found,
+    )
+    if next(blocks, None) is None and not found:
+        return
+
+    from blacken_docs._python import docstring_spans
+
+    text = src
+    if utf8 and not src.isascii():
+        text = src.encode("latin-1").decode()
+    spans = docstring_spans(text)
+    if spans is None:
+        yield from _iter_code_blocks(
+            src,
+            rst_literal_blocks=rst_literal_blocks,
+            source_format="all",
+            utf8=utf8,
+            unterminated=unterminated,
+        )
+        return
+    if text is not src:
+        # Convert the offsets to byte offsets.
+        byte_spans = []
+        char_pos = byte_pos = 0
+        for start, end in spans:
+            byte_pos += len(text[char_pos:start].encode())
+            byte_start = byte_pos
+            byte_pos += len(text[start:end].encode())
+            byte_spans.append((byte_start, byte_pos))
+            char_pos = end
+        spans = byte_spans
+
+    for docstring_start, docstring_end in spans:
+
+        def _unterminated(
+            start: int,
+            end: int,
+            exc: UnterminatedBlockError,
+            offset: int = docstring_start,
+        ) -> None:
+            unterminated(start + offset, end + offset, exc)
+
+        for block in _iter_code_blocks(
+            src[docstring_start:docstring_end],
+            rst_literal_blocks=rst_literal_blocks,
+            source_format="all",
+            utf8=utf8,
+            unterminated=_unterminated,
+        ):
+            yield CodeBlock(
+                src,
+                block.kind,
+                block.language,
+                block.indent,
+                block.start + docstring_start,
+                block.end + docstring_start,
+                block.code_start + docstring_start,
+                block.code_end + docstring_start,
+            )
+
+
+def _format_blocks(
+    src: str,
+    black_mode: black.Mode,
+    *,
+    rst_literal_blocks: bool,
+    source_format: str,
+    cache: Cache | None,
+    stats: Stats | None,
+    lines: Sequence[tuple[int, int]] | None,
+    block_timeout: float | None,
+    max_block_lines: int | None,
+    utf8: bool,
+) -> tuple[list[tuple[int, int, str]], list[CodeBlockError]]:
+    # Return the start, end, and replacement of each changed block, in order.
+    # With *lines*, only blocks overlapping those 1-based, inclusive ranges
+    # of lines are formatted. With *block_timeout*, blocks that Black takes
+    # longer than that many seconds to format are left as they are, with a
+    # BlockTimeoutError. With *max_block_lines*, blocks of more lines of
+    # code are left as they are, before any work on their code.
+    #
+    # With *utf8*, *src* is UTF-8 encoded text decoded as latin-1, so offsets
+    # are byte offsets. It is searched with ASCII-only patterns, each block
+    # is decoded before formatting, and replacements are encoded likewise.
+    errors: list[CodeBlockError] = []
+    line_index: _LineIndex | None = None
+
+    def _position(offset: int) -> tuple[int, int]:
+        nonlocal line_index
+        if line_index is None:
+            line_index = _LineIndex(src)
+        return line_index.position(offset)
+
+    def _add_error(offset: int, exc: Exception) -> None:
+        errors.append(CodeBlockError(offset, exc, *_position(offset)))
+
+    def _touched(start: int, end: int) -> bool:
+        if lines is None:
+            return True
+        first_line = _position(start)[0]
+        last_line = _position(max(start, end - 1))[0]
+        return any(
+            range_start <= last_line and range_end >= first_line
+            for range_start, range_end in lines
+        )
+
+    if lines is not None and not lines:
+        return [], errors
+    if not any(trigger in src for trigger in FORMATS[source_format].triggers):
+        return [], errors
+
+    def _run_black(code: str) -> str:
+        import black
+
+        with _phase(stats, "black"), _time_limit(block_timeout):
+            return black.format_str(code, mode=black_mode)
+
+    def _black_format(code: str) -> str:
+        formatted = _run_black(code)
+        if cache is not None:
+            cache.set_block(code, black_mode, formatted)
+        return formatted
+
+    def _format_codes(
+        codes: Sequence[str],
+    ) -> tuple[list[str | Exception], list[float]]:
+        # Return the result for each code, and the time taken formatting it.
+        results: list[str | Exception] = list(codes)
+        times = [0.0] * len(codes)
+
+        def _format_alone(index: int) -> None:
+            start = time.perf_counter()
+            try:
+                results[index] = _black_format(codes[index])
+            except Exception as e:
+                results[index] = e
+            times[index] += time.perf_counter() - start
+
+        def _format_batch(indexes: list[int]) -> None:
+            if len(indexes) == 1:
+                _format_alone(indexes[0])
+                return
+            batch = "".join(f"{codes[index]}{BATCH_SEPARATOR}\n" for index in indexes)
+            start = time.perf_counter()
+            timed_out = False
+            pieces: list[str] = []
+            try:
+                formatted_batch = _run_black(batch)
+            except BlockTimeoutError:
+                timed_out = True
+            except Exception:
+                pass
+            else:
+                pieces = BATCH_SEPARATOR_RE.split(formatted_batch)
+            # Share the batch's time between its blocks.
+            batch_time = (time.perf_counter() - start) / len(indexes)
+            for index in indexes:
+                times[index] += batch_time
+            if timed_out:
+                # A batch gets the time limit of one block, so a slow block
+                # costs one timeout, then each block is formatted alone with
+                # its own limit.
+                for index in indexes:
+                    _format_alone(index)
+                return
+            if len(pieces) != len(indexes) + 1:
+                # Some block failed to parse, or merged with its neighbour.
+                # Narrow down by halving, so errors are reported per block.
+                half = len(indexes) // 2
+                _format_batch(indexes[:half])
+                _format_batch(indexes[half:])
+                return
+            for index, piece in zip(indexes, pieces):
+                piece = piece.strip("\n")
+                formatted = f"{piece}\n" if piece else ""
+                results[index] = formatted
+                if cache is not None:
+                    cache.set_block(codes[index], black_mode, formatted)
+
+        batch_indexes = []
+        for index, code in enumerate(codes):
+            if cache is not None:
+                formatted = cache.get_block(code, black_mode)
+                if formatted is not None:
+                    results[index] = formatted
+                    continue
+            # Without explicit target versions, Black infers them from the
+            # syntax of its input, so blocks can't share a call.
+            if black_mode.target_versions and _batchable(code):
+                batch_indexes.append(index)
+            else:
+                _format_alone(index)
+        for batch_start in range(0, len(batch_indexes), BATCH_SIZE):
+            _format_batch(batch_indexes[batch_start : batch_start + BATCH_SIZE])
+        return results, times
+
+    def _text(start: int, end: int) -> str:
+        text = src[start:end]
+        return text.encode("latin-1").decode() if utf8 else text
+
+    def _fenced_replacement(block: CodeBlock, code: str) -> str:
+        code = textwrap.indent(code, " " * block.indent)
+        before = _text(block.start, block.code_start)
+        return f"{before}{code}{_text(block.code_end, block.end)}"
+
+    def _rst_replacement(block: CodeBlock, code: str) -> str:
+        block_code = _text(block.code_start, block.code_end)
+        min_indent = min(INDENT_RE.findall(block_code))
+        trailing_ws_match = TRAILING_NL_RE.search(block_code)
         assert trailing_ws_match
         trailing_ws = trailing_ws_match.group()
-        code = textwrap.dedent(match["code"])
-        with _collect_error(match):
-            code = black.format_str(code, mode=black_mode)
         code = textwrap.indent(code, min_indent)
-        return f"{match['before']}{code.rstrip()}{trailing_ws}"
-
-    def _pycon_match(match: Match[str]) -> str:
-        code = ""
-        fragment: str | None = None
-
-        def finish_fragment() -> None:
-            nonlocal code
-            nonlocal fragment
-
-            if fragment is not None:
-                with _collect_error(match):
-                    fragment = black.format_str(fragment, mode=black_mode)
-                fragment_lines = fragment.splitlines()
-                code += f"{PYCON_PREFIX}{fragment_lines[0]}\n"
-                for line in fragment_lines[1:]:
-                    # Skip blank lines to handle Black adding a blank above
-                    # functions within blocks. A blank line would end the REPL
-                    # continuation prompt.
-                    #
-                    # >>> if True:
-                    # ...     def f():
-                    # ...         pass
-                    # ...
-                    if line:
-                        code += f"{PYCON_CONTINUATION_PREFIX} {line}\n"
-                if fragment_lines[-1].startswith(" "):
-                    code += f"{PYCON_CONTINUATION_PREFIX}\n"
-                fragment = None
-
-        indentation: int | None = None
-        for line in match["code"].splitlines():
-            orig_line, line = line, line.lstrip()
-            if indentation is None and line:
-                indentation = len(orig_line) - len(line)
-            continuation_match = PYCON_CONTINUATION_RE.match(line)
-            if continuation_match and fragment is not None:
-                fragment += line[continuation_match.end() :] + "\n"
-            else:
-                finish_fragment()
-                if line.startswith(PYCON_PREFIX):
-                    fragment = line[len(PYCON_PREFIX) :] + "\n"
-                else:
-                    code += orig_line[indentation:] + "\n"
-        finish_fragment()
-        return code
-
-    def _md_pycon_match(match: Match[str]) -> str:
-        if _within_off_range(match.span()):
-            return match[0]
-        code = _pycon_match(match)
-        code = textwrap.indent(code, match["indent"])
-        return f"{match['before']}{code}{match['after']}"
-
-    def _rst_pycon_match(match: Match[str]) -> str:
-        if _within_off_range(match.span()):
-            return match[0]
-        code = _pycon_match(match)
+        return f"{_text(block.start, block.code_start)}{code.rstrip()}{trailing_ws}"
+
+    def _rst_pycon_replacement(block: CodeBlock, code: str) -> str:
         if not code.strip():
-            return match[0]
-        min_indent = min(INDENT_RE.findall(match["code"]))
+            return _text(block.start, block.end)
+        min_indent = min(INDENT_RE.findall(_text(block.code_start, block.code_end)))
         code = textwrap.indent(code, min_indent)
-        return f"{match['before']}{code}"
-
-    def _latex_match(match: Match[str]) -> str:
-        if _within_off_range(match.span()):
-            return match[0]
-        code = textwrap.dedent(match["code"])
-        with _collect_error(match):
-            code = black.format_str(code, mode=black_mode)
-        code = textwrap.indent(code, match["indent"])
-        return f"{match['before']}{code}{match['after']}"
-
-    def _latex_pycon_match(match: Match[str]) -> str:
-        if _within_off_range(match.span()):
-            return match[0]
-        code = _pycon_match(match)
-        code = textwrap.indent(code, match["indent"])
-        return f"{match['before']}{code}{match['after']}"
-
-    src = MD_RE.sub(_md_match, src)
-    src = MD_PYCON_RE.sub(_md_pycon_match, src)
-    src = RST_RE.sub(_rst_match, src)
-    src = RST_PYCON_RE.sub(_rst_pycon_match, src)
-    if rst_literal_blocks:
-        src = RST_LITERAL_BLOCKS_RE.sub(
-            _rst_literal_blocks_match,
-            src,
-        )
-    src = LATEX_RE.sub(_latex_match, src)
-    src = LATEX_PYCON_RE.sub(_latex_pycon_match, src)
-    src = PYTHONTEX_RE.sub(_latex_match, src)
-    return src, errors
+        return f"{_text(block.start, block.code_start)}{code}"
+
+    # Each block type's function building the replacement from the formatted
+    # code.
+    replacements: dict[str, Callable[[CodeBlock, str], str]] = {
+        "md": _fenced_replacement,
+        "md-pycon": _fenced_replacement,
+        "rst": _rst_replacement,
+        "rst-pycon": _rst_pycon_replacement,
+        "rst-literal": _rst_replacement,
+        "latex": _fenced_replacement,
+        "latex-pycon": _fenced_replacement,
+        "pythontex": _fenced_replacement,
+    }
+
+    def _unterminated(start: int, end: int, exc: UnterminatedBlockError) -> None:
+        if _touched(start, end):
+            _add_error(start, exc)
+
+    scan_start = time.perf_counter()
+    blocks = []
+    for block in _iter_code_blocks(
+        src,
+        rst_literal_blocks=rst_literal_blocks,
+        source_format=source_format,
+        utf8=utf8,
+        unterminated=_unterminated,
+    ):
+        if not _touched(block.start, block.end):
+            continue
+        if (
+            max_block_lines is not None
+            and src.count("\n", block.code_start, block.code_end) > max_block_lines
+        ):
+            if stats is not None:
+                stats.skip_block()
+            continue
+        blocks.append(block)
+    if stats is not None:
+        stats.add_phase("scan", time.perf_counter() - scan_start)
+
+    # Format the code of all Python blocks, and of each prompt in all pycon
+    # blocks, together, then splice in the replacements.
+    codes = [_text(block.code_start, block.code_end) for block in blocks]
+    sessions = [
+        _pycon_session(code) if block.kind in PYCON_BLOCK_TYPES else None
+        for block, code in zip(blocks, codes)
+    ]
+    to_format = []
+    for code, session in zip(codes, sessions):
+        if session is None:
+            to_format.append(textwrap.dedent(code))
+        else:
+            to_format.extend(text for text, prompt in session if prompt)
+    results, times = _format_codes(to_format)
+    results_iter = iter(zip(to_format, results, times))
+
+    def _next_result(start: int) -> tuple[str, float]:
+        # Unformatted code is kept, with an error for the block at start.
+        code, result, seconds = next(results_iter)
+        if isinstance(result, Exception):
+            _add_error(start, result)
+            return code, seconds
+        return result, seconds
+
+    edits = []
+    for block, session in zip(blocks, sessions):
+        if session is None:
+            code, seconds = _next_result(block.start)
+        else:
+            seconds = 0.0
+            parts = []
+            for text, prompt in session:
+                if prompt:
+                    text, prompt_seconds = _next_result(block.start)
+                    seconds += prompt_seconds
+                    text = _pycon_prompts(text)
+                parts.append(text)
+            code = "".join(parts)
+        if stats is not None:
+            stats.add_block(block.kind, _position(block.start)[0], seconds)
+        replacement = replacements[block.kind](block, code)
+        if replacement != _text(block.start, block.end):
+            if utf8:
+                replacement = replacement.encode().decode("latin-1")
+            edits.append((block.start, block.end, replacement))
+    return edits, errors
 
 
 def format_file(
@@ -284,37 +1079,372 @@ def format_file(
     skip_errors: bool,
     rst_literal_blocks: bool,
     check_only: bool,
+    *,
+    source_format: str | None = None,
+    cache: Cache | None = None,
+    stats: Stats | None = None,
+    lines: Sequence[tuple[int, int]] | None = None,
+    block_timeout: float | None = None,
+    max_file_size: int | None = None,
+    max_block_lines: int | None = None,
 ) -> int:
-    with open(filename, encoding="UTF-8") as f:
-        contents = f.read()
+    if source_format is None:
+        source_format = detect_format(filename)
+    with contextlib.ExitStack() as stack:
+        if stats is not None:
+            stack.enter_context(stats.file(filename))
+        try:
+            return _format_file(
+                filename,
+                black_mode,
+                skip_errors=skip_errors,
+                rst_literal_blocks=rst_literal_blocks,
+                check_only=check_only,
+                source_format=source_format,
+                cache=cache,
+                stats=stats,
+                lines=lines,
+                block_timeout=block_timeout,
+                max_file_size=max_file_size,
+                max_block_lines=max_block_lines,
+            )
+        finally:
+            if cache is not None:
+                cache.flush()
+
+
+def _format_file(
+    filename: str,
+    black_mode: black.Mode,
+    *,
+    skip_errors: bool,
+    rst_literal_blocks: bool,
+    check_only: bool,
+    source_format: str,
+    cache: Cache | None,
+    stats: Stats | None,
+    lines: Sequence[tuple[int, int]] | None,
+    block_timeout: float | None = None,
+    max_file_size: int | None = None,
+    max_block_lines: int | None = None,
+    contents: str | None = None,
+    write: Callable[[str, str | None], None] | None = None,
+) -> int:
+    # With *contents*, the file has already been read. With *write*, it is
+    # called with the new contents, and the cache options to mark the file
+    # clean with once written, or None, instead of writing the file here.
+    # Files larger than *max_file_size* bytes are skipped without reading
+    # them.
+    size = None
+    if contents is None:
+        size = os.path.getsize(filename)
+        if max_file_size is not None and size > max_file_size:
+            if stats is not None:
+                stats.skip_file()
+            return 0
+    cache_options = (
+        f"rst_literal_blocks={rst_literal_blocks},source_format={source_format}"
+    )
+    if max_block_lines is not None:
+        # Skipped blocks leave files unformatted without the limit.
+        cache_options += f",max_block_lines={max_block_lines}"
+    if cache is not None:
+        with _phase(stats, "cache"):
+            if cache.is_file_clean(filename, black_mode, cache_options):
+                return 0
+    if size is not None and size >= MMAP_MIN_SIZE:
+        retv = _format_mapped_file(
+            filename,
+            black_mode,
+            skip_errors=skip_errors,
+            rst_literal_blocks=rst_literal_blocks,
+            check_only=check_only,
+            source_format=source_format,
+            cache=cache,
+            cache_options=cache_options,
+            stats=stats,
+            lines=lines,
+            block_timeout=block_timeout,
+            max_block_lines=max_block_lines,
+        )
+        if retv is not None:
+            return retv
+    if contents is None:
+        with _phase(stats, "read"):
+            contents = _read_file(filename, source_format)
+        if contents is None:
+            return 0
     new_contents, errors = format_str(
         contents,
         black_mode,
         rst_literal_blocks=rst_literal_blocks,
+        source_format=source_format,
+        cache=cache,
+        stats=stats,
+        lines=lines,
+        block_timeout=block_timeout,
+        max_block_lines=max_block_lines,
     )
     for error in errors:
-        lineno = contents[: error.offset].count("\n") + 1
-        print(f"{filename}:{lineno}: code block parse error {error.exc}")
+        _print_error(filename, error)
     if errors and not skip_errors:
         return 2
     if contents == new_contents:
+        # With lines, other blocks may still be unformatted.
+        if cache is not None and not errors and lines is None:
+            cache.set_file_clean(filename, black_mode, cache_options, contents)
         return 0
     if check_only:
         print(f"{filename}: Requires a rewrite.")
         return 1
     print(f"{filename}: Rewriting...")
-    with open(filename, "w", encoding="UTF-8") as f:
+    if write is not None:
+        clean = cache is not None and not errors and lines is None
+        write(new_contents, cache_options if clean else None)
+        return 1
+    with _phase(stats, "write"), open(filename, "w", encoding="UTF-8") as f:
         f.write(new_contents)
+    if cache is not None and not errors and lines is None:
+        cache.set_file_clean(filename, black_mode, cache_options, new_contents)
     return 1
 
 
-def main(argv: Sequence[str] | None = None) -> int:
-    parser = argparse.ArgumentParser()
+def _format_mapped_file(
+    filename: str,
+    black_mode: black.Mode,
+    *,
+    skip_errors: bool,
+    rst_literal_blocks: bool,
+    check_only: bool,
+    source_format: str,
+    cache: Cache | None,
+    cache_options: str,
+    stats: Stats | None,
+    lines: Sequence[tuple[int, int]] | None,
+    block_timeout: float | None,
+    max_block_lines: int | None,
+) -> int | None:
+    # Format a large file from a memory map of its UTF-8 bytes, decoded as
+    # latin-1 so only one copy is held, and rewrite only from the first
+    # changed block. Return None if the file can't be handled this way.
+    with _phase(stats, "read"):
+        src = _read_mapped_file(filename, source_format)
+    if src is None:
+        return None
+
+    edits, errors = _format_blocks(
+        src,
+        black_mode,
+        rst_literal_blocks=rst_literal_blocks,
+        source_format=source_format,
+        cache=cache,
+        stats=stats,
+        lines=lines,
+        block_timeout=block_timeout,
+        max_block_lines=max_block_lines,
+        utf8=True,
+    )
+    for error in errors:
+        _print_error(filename, error)
+    if errors and not skip_errors:
+        return 2
+    if not edits:
+        if cache is not None and not errors and lines is None:
+            cache.set_file_clean(filename, black_mode, cache_options)
+        return 0
+    if check_only:
+        print(f"{filename}: Requires a rewrite.")
+        return 1
+    print(f"{filename}: Rewriting...")
+    with _phase(stats, "write"), open(filename, "r+b") as f:
+        last_end = edits[0][0]
+        f.seek(last_end)
+        for start, end, replacement in edits:
+            _write_latin1(f, src, last_end, start)
+            f.write(replacement.encode("latin-1"))
+            last_end = end
+        _write_latin1(f, src, last_end, len(src))
+        f.truncate()
+    if cache is not None and not errors and lines is None:
+        cache.set_file_clean(filename, black_mode, cache_options)
+    return 1
+
+
+def _read_file(filename: str, source_format: str) -> str | None:
+    # Read a file as text mode would, or return None if it has none of its
+    # format's block markers, without decoding it.
+    with open(filename, "rb") as f:
+        data = f.read()
+    if not _has_triggers(data, source_format):
+        return None
+    contents = data.decode("UTF-8")
+    if "\r" in contents:
+        contents = contents.replace("\r\n", "\n").replace("\r", "\n")
+    return contents
+
+
+def _print_error(filename: str, error: CodeBlockError) -> None:
+    if isinstance(error.exc, BlockTimeoutError):
+        kind = "timeout"
+    else:
+        kind = "parse error"
+    print(f"{filename}:{error.lineno}: code block {kind} {error.exc}")
+
+
+def _has_triggers(data: bytes | mmap.mmap, source_format: str) -> bool:
+    return any(
+        data.find(trigger.encode()) != -1 for trigger in FORMATS[source_format].triggers
+    )
+
+
+def _read_mapped_file(filename: str, source_format: str) -> str | None:
+    with open(filename, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Empty files and some file systems can't be mapped.
+            return None
+    with data:
+        if data.find(b"\r") != -1:
+            # Leave universal newlines translation to text mode.
+            return None
+        if UNICODE_SPACE_RE.search(data):
+            return None
+        if not _has_triggers(data, source_format):
+            # Nothing to format, so skip decoding.
+            return ""
+        # Fail on invalid UTF-8 as text mode would, without decoding it all
+        # at once.
+        decoder = codecs.getincrementaldecoder("UTF-8")()
+        for chunk_start in range(0, len(data), MMAP_CHUNK_SIZE):
+            decoder.decode(data[chunk_start : chunk_start + MMAP_CHUNK_SIZE])
+        decoder.decode(b"", final=True)
+        return str(data, "latin-1")
+
+
+def _phase(stats: Stats | None, name: str) -> contextlib.AbstractContextManager[None]:
+    if stats is None:
+        return contextlib.nullcontext()
+    return stats.phase(name)
+
+
+@contextlib.contextmanager
+def _time_limit(seconds: float | None) -> Generator[None]:
+    # Raise BlockTimeoutError in the body once it has run for seconds. This
+    # uses a SIGALRM timer, so it's only enforced on the main thread of
+    # platforms that have one, which is where files are formatted.
+    if (
+        seconds is None
+        or not hasattr(signal, "setitimer")
+        or threading.current_thread() is not threading.main_thread()
+    ):
+        yield
+        return
+
+    def _alarm(signum: int, frame: object) -> None:
+        raise BlockTimeoutError(f"formatting took longer than {seconds:g} seconds")
+
+    previous = signal.signal(signal.SIGALRM, _alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _write_latin1(f: BinaryIO, src: str, start: int, end: int) -> None:
+    for chunk_start in range(start, end, MMAP_CHUNK_SIZE):
+        chunk_end = min(chunk_start + MMAP_CHUNK_SIZE, end)
+        f.write(src[chunk_start:chunk_end].encode("latin-1"))
+
+
+def _format_file_capturing_output(
+    filename: str,
+    black_mode: black.Mode,
+    skip_errors: bool,
+    rst_literal_blocks: bool,
+    check_only: bool,
+    source_format: str | None,
+    cache: Cache | None,
+    collect_stats: bool,
+    cwd: str,
+    lines: Sequence[tuple[int, int]] | None,
+    block_timeout: float | None,
+    max_file_size: int | None,
+    max_block_lines: int | None,
+) -> tuple[int, str, Stats | None]:
+    # Run in worker processes, so output can be printed in filename order, and
+    # stats merged. The daemon's workers serve clients in any directory.
+    os.chdir(cwd)
+    output = io.StringIO()
+    stats = Stats() if collect_stats else None
+    with contextlib.redirect_stdout(output):
+        retv = format_file(
+            filename,
+            black_mode,
+            skip_errors=skip_errors,
+            rst_literal_blocks=rst_literal_blocks,
+            check_only=check_only,
+            source_format=source_format,
+            cache=cache,
+            stats=stats,
+            lines=lines,
+            block_timeout=block_timeout,
+            max_file_size=max_file_size,
+            max_block_lines=max_block_lines,
+        )
+    return retv, output.getvalue(), stats
+
+
+def _make_executor(workers: int) -> Executor | None:
+    if sys.platform == "win32":
+        # Work around https://bugs.python.org/issue26903
+        workers = min(workers, 60)
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+
+        return ProcessPoolExecutor(max_workers=workers)
+    except (ImportError, NotImplementedError, OSError):
+        # Some platforms, such as AWS Lambda, don't support multiprocessing.
+        return None
+
+
+def _regex(value: str) -> re.Pattern[str]:
+    try:
+        return re.compile(value)
+    except re.error as exc:
+        raise argparse.ArgumentTypeError(
+            f"invalid regular expression {value!r}: {exc}"
+        ) from None
+
+
+def _target_version(value: str) -> str:
+    # Rejects names that can't be any target version as arguments are parsed,
+    # before Black is imported. Black's own list of versions varies with its
+    # version, so names are checked against it once it's imported.
+    name = value.upper()
+    if not TARGET_VERSION_RE.fullmatch(name):
+        raise argparse.ArgumentTypeError(f"invalid value: {value.lower()!r}")
+    return name
+
+
+class _HelpFormatter(argparse.HelpFormatter):
+    def _get_help_string(self, action: argparse.Action) -> str | None:
+        if action.dest == "target_versions":
+            from black.mode import TargetVersion
+
+            return f"choices: {[v.name.lower() for v in TargetVersion]}"
+        return super()._get_help_string(action)
+
+
+def _make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(formatter_class=_HelpFormatter)
     parser.add_argument(
         "-l",
         "--line-length",
         type=int,
-        default=DEFAULT_LINE_LENGTH,
+        default=None,
     )
     parser.add_argument("--preview", action="store_true")
     parser.add_argument(
@@ -326,9 +1456,10 @@ def main(argv: Sequence[str] | None = None) -> int:
         "-t",
         "--target-version",
         action="append",
-        type=lambda v: TargetVersion[v.upper()],
+        type=_target_version,
         default=[],
-        help=f"choices: {[v.name.lower() for v in TargetVersion]}",
+        # Filled in by _HelpFormatter.
+        help="choices",
         dest="target_versions",
     )
     parser.add_argument("--check", action="store_true")
@@ -338,24 +1469,463 @@ def main(argv: Sequence[str] | None = None) -> int:
         action="store_true",
     )
     parser.add_argument("--pyi", action="store_true")
-    parser.add_argument("filenames", nargs="*")
+    parser.add_argument(
+        "--format",
+        choices=list(FORMATS),
+        default=None,
+        help="markup format of all files (default: detect from file extension)",
+        dest="source_format",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="number of parallel processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--block-timeout",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="leave code blocks that take longer to format unchanged, as errors",
+    )
+    parser.add_argument(
+        "--max-file-size",
+        type=int,
+        default=None,
+        metavar="BYTES",
+        help="skip files larger than this without reading them",
+    )
+    parser.add_argument(
+        "--max-block-lines",
+        type=int,
+        default=None,
+        metavar="LINES",
+        help="skip code blocks with more lines of code than this",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="don't read or write the cache of formatted code blocks",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="report where time was spent, per phase and per code block type",
+    )
+    parser.add_argument(
+        "--include",
+        type=_regex,
+        default=None,
+        help="regular expression of files to format in directories (default: "
+        "Markdown, reStructuredText, LaTeX, and Python files)",
+    )
+    parser.add_argument(
+        "--exclude",
+        type=_regex,
+        default=None,
+        help="regular expression of files and directories to skip in "
+        "directories (default: Black's default excludes)",
+    )
+    parser.add_argument(
+        "--diff-base",
+        default=None,
+        metavar="REF",
+        help="only format code blocks in lines changed since the git ref",
+    )
+    parser.add_argument(
+        "--staged",
+        action="store_true",
+        help="only format code blocks in lines changed in the git index",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="run a server that formats files for clients using --use-daemon",
+    )
+    parser.add_argument(
+        "--use-daemon",
+        action="store_true",
+        help="format files with a running daemon, if there is one",
+    )
+    parser.add_argument(
+        "--daemon-socket",
+        default=None,
+        help="path of the daemon's Unix socket",
+    )
+    parser.add_argument("filenames", nargs="*", metavar="PATH")
+    return parser
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = _make_parser()
     args = parser.parse_args(argv)
 
-    black_mode = black.Mode(
-        target_versions=set(args.target_versions),
-        line_length=args.line_length,
-        string_normalization=not args.skip_string_normalization,
-        is_pyi=args.pyi,
-        preview=args.preview,
+    if args.daemon and sys.platform == "win32":
+        parser.error("--daemon is not supported on Windows")
+    if (args.daemon or args.use_daemon) and sys.platform != "win32":
+        from blacken_docs import _daemon
+
+        socket_path = args.daemon_socket or _daemon.default_socket_path()
+        if args.daemon:
+            return _daemon.serve(parser, socket_path)
+        # Fall back to formatting here if no daemon is running.
+        retv = _daemon.request(
+            socket_path, list(sys.argv[1:] if argv is None else argv)
+        )
+        if retv is not None:
+            return retv
+
+    return _run(parser, args)
+
+
+def _run(
+    parser: argparse.ArgumentParser,
+    args: argparse.Namespace,
+    *,
+    executor: Executor | None = None,
+    close_cache: bool = True,
+) -> int:
+    if args.workers is not None and args.workers < 1:
+        parser.error("argument -j/--workers: must be at least 1")
+    if args.block_timeout is not None and not args.block_timeout > 0:
+        parser.error("argument --block-timeout: must be positive")
+    if args.max_file_size is not None and args.max_file_size < 1:
+        parser.error("argument --max-file-size: must be at least 1")
+    if args.max_block_lines is not None and args.max_block_lines < 1:
+        parser.error("argument --max-block-lines: must be at least 1")
+
+    start = time.perf_counter()
+    # Skips are counted even without --stats, so they can be reported.
+    stats = (
+        Stats()
+        if args.stats
+        or args.max_file_size is not None
+        or args.max_block_lines is not None
+        else None
+    )
+
+    def _report() -> None:
+        if stats is None:
+            return
+        if args.stats:
+            stats.report(time.perf_counter() - start)
+        else:
+            stats.report_skipped()
+
+    from blacken_docs._files import DEFAULT_EXCLUDES, DEFAULT_INCLUDES, gen_files
+
+    filenames: Iterator[str] = gen_files(
+        args.filenames,
+        include=args.include or re.compile(DEFAULT_INCLUDES),
+        exclude=args.exclude or re.compile(DEFAULT_EXCLUDES),
+    )
+    line_ranges = None
+    if args.diff_base is not None or args.staged:
+        from blacken_docs._git import GitError, changed_lines
+
+        # git diff needs all the files up front.
+        all_filenames = list(filenames)
+        try:
+            line_ranges = changed_lines(
+                all_filenames, diff_base=args.diff_base, staged=args.staged
+            )
+        except GitError as exc:
+            parser.error(f"git diff failed: {exc}")
+        filenames = iter(
+            [filename for filename in all_filenames if filename in line_ranges]
+        )
+    # Format files as they are found, but only import Black once one has a
+    # possible code block. Later files are checked as they are read.
+    for first in filenames:
+        if args.max_file_size is not None and _too_large(first, args.max_file_size):
+            # Skips are always counted with a limit.
+            assert stats is not None
+            stats.skip_file()
+            continue
+        if _has_candidates(first, args.source_format or detect_format(first)):
+            break
+    else:
+        _report()
+        return 0
+    filenames = itertools.chain([first], filenames)
+
+    import black
+    from black.const import DEFAULT_LINE_LENGTH
+    from black.mode import TargetVersion
+
+    from blacken_docs._cache import get_cache, get_cache_dir
+    from blacken_docs._config import ConfigError, ConfigFinder
+
+    def _target_versions(names: list[str], source: str) -> set[TargetVersion]:
+        target_versions = set()
+        for name in names:
+            try:
+                target_versions.add(TargetVersion[name.upper()])
+            except KeyError:
+                parser.error(f"{source}: invalid value: {name.lower()!r}")
+        return target_versions
+
+    cli_target_versions = _target_versions(
+        args.target_versions, "argument -t/--target-version"
     )
+    # Options given on the command line override each project's settings.
+    config_finder = ConfigFinder()
+    black_modes: dict[str | None, black.Mode] = {}
+
+    def _black_mode(filename: str) -> black.Mode:
+        root = config_finder.root(filename)
+        black_mode = black_modes.get(root)
+        if black_mode is not None:
+            return black_mode
+        try:
+            settings = config_finder.settings(root)
+        except ConfigError as exc:
+            parser.error(f"invalid configuration: {exc}")
+        line_length = args.line_length
+        if line_length is None:
+            line_length = settings.get("line-length", DEFAULT_LINE_LENGTH)
+        target_versions = cli_target_versions
+        if not target_versions and "target-version" in settings:
+            target_versions = _target_versions(
+                settings["target-version"],
+                f"{os.path.join(root or '', 'pyproject.toml')}: target-version",
+            )
+        black_mode = black_modes[root] = black.Mode(
+            target_versions=target_versions,
+            line_length=line_length,
+            string_normalization=not (
+                args.skip_string_normalization
+                or settings.get("skip-string-normalization", False)
+            ),
+            is_pyi=args.pyi or settings.get("pyi", False),
+            preview=args.preview or settings.get("preview", False),
+        )
+        return black_mode
+
+    cache = None if args.no_cache else get_cache(get_cache_dir())
+    try:
+        return _format_files(
+            args, filenames, _black_mode, cache, stats, line_ranges, executor
+        )
+    finally:
+        if cache is not None and close_cache:
+            cache.close()
+        _report()
+
+
+def _too_large(filename: str, max_file_size: int) -> bool:
+    try:
+        return os.path.getsize(filename) > max_file_size
+    except OSError:
+        # Leave the error to formatting.
+        return False
+
+
+def _has_candidates(filename: str, source_format: str) -> bool:
+    # Whether the file contains any of its format's block markers, checked
+    # without decoding it.
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_MIN_SIZE:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return _has_triggers(mapped, source_format)
+            except (OSError, ValueError):
+                # As in _read_mapped_file(), read files that can't be mapped.
+                pass
+        data = f.read()
+    return _has_triggers(data, source_format)
+
+
+def _format_files(
+    args: argparse.Namespace,
+    filenames: Iterator[str],
+    black_mode_for: Callable[[str], black.Mode],
+    cache: Cache | None,
+    stats: Stats | None,
+    line_ranges: dict[str, list[tuple[int, int]]] | None,
+    shared_executor: Executor | None,
+) -> int:
+    # black_mode_for() returns the Black mode to format a file with.
+    workers = args.workers or os.cpu_count() or 1
+    # Use no more workers than files, without waiting to find them all.
+    first_filenames = list(itertools.islice(filenames, workers))
+    workers = len(first_filenames)
+    filenames = itertools.chain(first_filenames, filenames)
+    executor = None
+    if workers > 1:
+        executor = shared_executor or _make_executor(workers)
+
+    if executor is None:
+        return _format_files_pipelined(
+            args, filenames, black_mode_for, cache, stats, line_ranges
+        )
 
     retv = 0
-    for filename in args.filenames:
-        retv |= format_file(
-            filename,
-            black_mode,
-            skip_errors=args.skip_errors,
-            rst_literal_blocks=args.rst_literal_blocks,
-            check_only=args.check,
+
+    with contextlib.ExitStack() as stack:
+        if executor is not shared_executor:
+            stack.enter_context(executor)
+        futures = [
+            executor.submit(
+                _format_file_capturing_output,
+                filename,
+                black_mode_for(filename),
+                skip_errors=args.skip_errors,
+                rst_literal_blocks=args.rst_literal_blocks,
+                check_only=args.check,
+                source_format=args.source_format,
+                cache=cache,
+                collect_stats=stats is not None,
+                cwd=os.getcwd(),
+                lines=None if line_ranges is None else line_ranges[filename],
+                block_timeout=args.block_timeout,
+                max_file_size=args.max_file_size,
+                max_block_lines=args.max_block_lines,
+            )
+            for filename in filenames
+        ]
+        for future in futures:
+            file_retv, output, file_stats = future.result()
+            sys.stdout.write(output)
+            retv |= file_retv
+            if stats is not None and file_stats is not None:
+                stats.merge(file_stats)
+    return retv
+
+
+def _format_files_pipelined(
+    args: argparse.Namespace,
+    filenames: Iterator[str],
+    black_mode_for: Callable[[str], black.Mode],
+    cache: Cache | None,
+    stats: Stats | None,
+    line_ranges: dict[str, list[tuple[int, int]]] | None,
+) -> int:
+    # Format files in this process, with a thread finding and reading the
+    # next few files, and another writing rewritten files, so that
+    # formatting overlaps I/O. The cache and stats are only used from this
+    # thread.
+    from concurrent.futures import Future, ThreadPoolExecutor
+
+    reads: queue.Queue[tuple[str, str | None, float] | None]
+    reads = queue.Queue(PIPELINE_DEPTH)
+    stop = threading.Event()
+    writes: collections.deque[tuple[Future[float], str, black.Mode, str, str | None]]
+    writes = collections.deque()
+
+    def _finish_writes(limit: int) -> None:
+        while len(writes) > limit:
+            future, filename, black_mode, new_contents, cache_options = writes.popleft()
+            seconds = future.result()
+            if stats is not None:
+                stats.add_phase("write", seconds)
+            if cache is not None and cache_options is not None:
+                cache.set_file_clean(filename, black_mode, cache_options, new_contents)
+                cache.flush()
+
+    def _write(
+        filename: str,
+        black_mode: black.Mode,
+        new_contents: str,
+        cache_options: str | None,
+    ) -> None:
+        future = writer.submit(_write_file, filename, new_contents)
+        writes.append((future, filename, black_mode, new_contents, cache_options))
+
+    retv = 0
+    with ThreadPoolExecutor(1) as reader, ThreadPoolExecutor(1) as writer:
+        reader_future = reader.submit(
+            _read_ahead,
+            filenames,
+            args.source_format,
+            args.max_file_size,
+            reads,
+            stop,
         )
+        try:
+            while (item := reads.get()) is not None:
+                filename, contents, read_seconds = item
+                if stats is not None and contents is not None:
+                    stats.add_phase("read", read_seconds)
+
+                source_format = args.source_format or detect_format(filename)
+                black_mode = black_mode_for(filename)
+                with contextlib.ExitStack() as stack:
+                    if stats is not None:
+                        stack.enter_context(stats.file(filename))
+                    try:
+                        retv |= _format_file(
+                            filename,
+                            black_mode,
+                            skip_errors=args.skip_errors,
+                            rst_literal_blocks=args.rst_literal_blocks,
+                            check_only=args.check,
+                            source_format=source_format,
+                            cache=cache,
+                            stats=stats,
+                            lines=(
+                                None if line_ranges is None else line_ranges[filename]
+                            ),
+                            block_timeout=args.block_timeout,
+                            max_file_size=args.max_file_size,
+                            max_block_lines=args.max_block_lines,
+                            contents=contents,
+                            write=functools.partial(_write, filename, black_mode),
+                        )
+                    finally:
+                        if cache is not None:
+                            cache.flush()
+                _finish_writes(PIPELINE_DEPTH)
+            reader_future.result()
+            _finish_writes(0)
+        finally:
+            # Unblock the reader if formatting failed.
+            stop.set()
+            while not reader_future.done():
+                with contextlib.suppress(queue.Empty):
+                    reads.get(timeout=0.01)
     return retv
+
+
+def _read_ahead(
+    filenames: Iterator[str],
+    source_format: str | None,
+    max_file_size: int | None,
+    reads: queue.Queue[tuple[str, str | None, float] | None],
+    stop: threading.Event,
+) -> None:
+    # Put each file's name, contents, and time taken reading it, or None for
+    # contents to leave reading to the formatting thread, as for large files
+    # that are memory-mapped, files over the size limit, or files that fail
+    # to read, so their errors are raised in order. Files without block
+    # markers are skipped.
+    try:
+        for filename in filenames:
+            if stop.is_set():
+                return
+            start = time.perf_counter()
+            contents: str | None = None
+            try:
+                size = os.path.getsize(filename)
+                if size < MMAP_MIN_SIZE and (
+                    max_file_size is None or size <= max_file_size
+                ):
+                    contents = _read_file(
+                        filename, source_format or detect_format(filename)
+                    )
+                    if contents is None:
+                        continue
+            except (OSError, UnicodeDecodeError):
+                pass
+            reads.put((filename, contents, time.perf_counter() - start))
+    finally:
+        reads.put(None)
+
+
+def _write_file(filename: str, contents: str) -> float:
+    start = time.perf_counter()
+    with open(filename, "w", encoding="UTF-8") as f:
+        f.write(contents)
+    return time.perf_counter() - start
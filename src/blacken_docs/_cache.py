@@ -0,0 +1,293 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import time
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    import black
+
+# Entries unused for this many seconds are evicted.
+MAX_AGE = 30 * 24 * 60 * 60
+# Beyond this many entries, the least recently used are evicted.
+MAX_ENTRIES = 100_000
+# Blocks kept in memory, for long-running processes like the daemon.
+MAX_MEMORY_ENTRIES = 10_000
+
+CACHE_FILENAME = "cache.sqlite3"
+
+
+def get_cache_dir() -> str:
+    cache_dir = os.environ.get("BLACKEN_DOCS_CACHE_DIR")
+    if cache_dir:
+        return cache_dir
+
+    from platformdirs import user_cache_dir
+
+    return user_cache_dir("blacken-docs")
+
+
+def _versions() -> str:
+    from importlib.metadata import PackageNotFoundError, version
+
+    try:
+        blacken_docs_version = version("blacken-docs")
+    except PackageNotFoundError:  # pragma: no cover
+        blacken_docs_version = "unknown"
+    return f"{blacken_docs_version}\0{version('black')}"
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _hash_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+# One instance per cache directory per process, so worker processes reuse
+# their connection across files.
+_caches: dict[str, Cache] = {}
+
+
+def get_cache(cache_dir: str) -> Cache:
+    try:
+        return _caches[cache_dir]
+    except KeyError:
+        cache = _caches[cache_dir] = Cache(cache_dir)
+        return cache
+
+
+# Caches inherited by forked processes, such as the daemon's workers.
+# SQLite connections can't be used across fork(), nor closed, so they're
+# kept here unused, and the child opens its own.
+_forked_caches: list[Cache] = []
+
+
+def _forget_caches() -> None:
+    _forked_caches.extend(_caches.values())
+    _caches.clear()
+
+
+if hasattr(os, "register_at_fork"):  # pragma: no branch
+    os.register_at_fork(after_in_child=_forget_caches)
+
+
+# Black's output for code blocks, persisted in SQLite so that concurrent
+# processes, such as parallel pre-commit runs, can share it.
+class Cache:
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        self._connection: sqlite3.Connection | None = None
+        self._disabled = False
+        self._key_prefixes: dict[black.Mode, str] = {}
+        self._used: set[str] = set()
+        self._new: dict[str, str] = {}
+        # Recently used blocks, least recent first.
+        self._memory: dict[str, str] = {}
+        self._new_files: dict[tuple[str, str], tuple[int, int, str]] = {}
+
+    def __reduce__(self) -> tuple[Any, ...]:
+        # Pickled for worker processes, which each open their own connection.
+        return (get_cache, (self.cache_dir,))
+
+    def _connect(self) -> sqlite3.Connection | None:
+        if self._connection is None and not self._disabled:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                connection = sqlite3.connect(
+                    os.path.join(self.cache_dir, CACHE_FILENAME),
+                    timeout=30,
+                    isolation_level=None,
+                )
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS blocks ("
+                    "key TEXT PRIMARY KEY, formatted TEXT NOT NULL, used REAL NOT NULL"
+                    ")"
+                )
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS blocks_used ON blocks (used)"
+                )
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS files ("
+                    "path TEXT NOT NULL, settings TEXT NOT NULL, "
+                    "mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, "
+                    "hash TEXT NOT NULL, used REAL NOT NULL, "
+                    "PRIMARY KEY (path, settings)"
+                    ")"
+                )
+                self._evict(connection)
+            except (OSError, sqlite3.Error):
+                # An unusable cache shouldn't stop formatting.
+                self._disabled = True
+            else:
+                self._connection = connection
+        return self._connection
+
+    def _evict(self, connection: sqlite3.Connection) -> None:
+        with connection:
+            connection.execute("BEGIN")
+            cutoff = time.time() - MAX_AGE
+            connection.execute("DELETE FROM blocks WHERE used < ?", (cutoff,))
+            connection.execute("DELETE FROM files WHERE used < ?", (cutoff,))
+            (count,) = connection.execute("SELECT COUNT(*) FROM blocks").fetchone()
+            if count > MAX_ENTRIES:
+                connection.execute(
+                    "DELETE FROM blocks WHERE key IN "
+                    "(SELECT key FROM blocks ORDER BY used LIMIT ?)",
+                    (count - MAX_ENTRIES,),
+                )
+
+    def _key_prefix(self, black_mode: black.Mode) -> str:
+        try:
+            return self._key_prefixes[black_mode]
+        except KeyError:
+            prefix = self._key_prefixes[black_mode] = (
+                f"{_versions()}\0{black_mode.get_cache_key()}\0"
+            )
+            return prefix
+
+    def _block_key(self, code: str, black_mode: black.Mode) -> str:
+        return _hash(self._key_prefix(black_mode) + code)
+
+    def get_block(self, code: str, black_mode: black.Mode) -> str | None:
+        key = self._block_key(code, black_mode)
+        try:
+            return self._new[key]
+        except KeyError:
+            pass
+        formatted: str | None = self._memory.pop(key, None)
+        if formatted is None:
+            connection = self._connect()
+            if connection is None:
+                return None
+            try:
+                row = connection.execute(
+                    "SELECT formatted FROM blocks WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error:
+                return None
+            if row is None:
+                return None
+            formatted = row[0]
+        self._remember(key, formatted)
+        self._used.add(key)
+        return formatted
+
+    def _remember(self, key: str, formatted: str) -> None:
+        self._memory[key] = formatted
+        if len(self._memory) > MAX_MEMORY_ENTRIES:
+            del self._memory[next(iter(self._memory))]
+
+    def set_block(self, code: str, black_mode: black.Mode, formatted: str) -> None:
+        self._new[self._block_key(code, black_mode)] = formatted
+
+    # Files known to be formatted are tracked per Black mode and per the
+    # blacken-docs options in *options*, like Black's own cache.
+    def is_file_clean(
+        self, filename: str, black_mode: black.Mode, options: str
+    ) -> bool:
+        connection = self._connect()
+        if connection is None:
+            return False
+        path = os.path.abspath(filename)
+        settings = _hash(self._key_prefix(black_mode) + options)
+        try:
+            st = os.stat(path)
+            row = connection.execute(
+                "SELECT mtime_ns, size, hash FROM files "
+                "WHERE path = ? AND settings = ?",
+                (path, settings),
+            ).fetchone()
+        except (OSError, sqlite3.Error):
+            return False
+        if row is None:
+            return False
+        mtime_ns, size, hash_ = row
+        if st.st_size != size:
+            return False
+        if st.st_mtime_ns != mtime_ns:
+            # Touched but maybe not modified, compare contents.
+            try:
+                with open(path, encoding="UTF-8") as f:
+                    contents = f.read()
+            except (OSError, UnicodeDecodeError):
+                return False
+            if _hash(contents) != hash_:
+                return False
+        self._new_files[(path, settings)] = (st.st_mtime_ns, st.st_size, hash_)
+        return True
+
+    # Without *contents*, the file is hashed as stored, which only matches the
+    # hash of its text if it has no carriage returns.
+    def set_file_clean(
+        self,
+        filename: str,
+        black_mode: black.Mode,
+        options: str,
+        contents: str | None = None,
+    ) -> None:
+        path = os.path.abspath(filename)
+        settings = _hash(self._key_prefix(black_mode) + options)
+        try:
+            st = os.stat(path)
+            contents_hash = (
+                _hash(contents) if contents is not None else _hash_file(path)
+            )
+        except OSError:
+            return
+        self._new_files[(path, settings)] = (
+            st.st_mtime_ns,
+            st.st_size,
+            contents_hash,
+        )
+
+    def flush(self) -> None:
+        if not self._new and not self._used and not self._new_files:
+            return
+        connection = self._connect()
+        if connection is not None:
+            now = time.time()
+            try:
+                with connection:
+                    connection.execute("BEGIN")
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO blocks VALUES (?, ?, ?)",
+                        ((key, formatted, now) for key, formatted in self._new.items()),
+                    )
+                    connection.executemany(
+                        "UPDATE blocks SET used = ? WHERE key = ?",
+                        ((now, key) for key in self._used),
+                    )
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                        (
+                            (path, settings, mtime_ns, size, hash_, now)
+                            for (path, settings), (
+                                mtime_ns,
+                                size,
+                                hash_,
+                            ) in self._new_files.items()
+                        ),
+                    )
+            except sqlite3.Error:
+                pass
+        for key, formatted in self._new.items():
+            self._remember(key, formatted)
+        self._new.clear()
+        self._used.clear()
+        self._new_files.clear()
+
+    def close(self) -> None:
+        self.flush()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        _caches.pop(self.cache_dir, None)
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import os
+import sys
+from typing import Any
+
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
+
+# The settings that can be given in pyproject.toml, and their types.
+SETTINGS: dict[str, type] = {
+    "line-length": int,
+    "target-version": list,
+    "skip-string-normalization": bool,
+    "preview": bool,
+    "pyi": bool,
+}
+
+
+class ConfigError(Exception):
+    pass
+
+
+class ConfigFinder:
+    # Finds the settings for files from the [tool.blacken-docs] table of the
+    # nearest pyproject.toml file, searching up from their directory to the
+    # top of their repository. With "use-black-config = true" there, unset
+    # settings are taken from the [tool.black] table. Project roots are
+    # cached per directory, and settings per root, so each pyproject.toml
+    # file is found and read once.
+    def __init__(self) -> None:
+        self._roots: dict[str, str | None] = {}
+        self._settings: dict[str, dict[str, Any]] = {}
+
+    def root(self, filename: str) -> str | None:
+        # The directory of the nearest pyproject.toml file, if any.
+        directory = os.path.dirname(os.path.abspath(filename))
+        visited = []
+        root = None
+        while True:
+            if directory in self._roots:
+                root = self._roots[directory]
+                break
+            visited.append(directory)
+            if os.path.isfile(os.path.join(directory, "pyproject.toml")):
+                root = directory
+                break
+            parent = os.path.dirname(directory)
+            if parent == directory or _is_repository(directory):
+                break
+            directory = parent
+        for directory in visited:
+            self._roots[directory] = root
+        return root
+
+    def settings(self, root: str | None) -> dict[str, Any]:
+        if root is None:
+            return {}
+        settings = self._settings.get(root)
+        if settings is None:
+            settings = self._settings[root] = _read_settings(
+                os.path.join(root, "pyproject.toml")
+            )
+        return settings
+
+
+def _is_repository(directory: str) -> bool:
+    return os.path.exists(os.path.join(directory, ".git")) or os.path.exists(
+        os.path.join(directory, ".hg")
+    )
+
+
+def _read_settings(path: str) -> dict[str, Any]:
+    try:
+        with open(path, "rb") as f:
+            config = tomllib.load(f)
+    except (OSError, tomllib.TOMLDecodeError) as exc:
+        raise ConfigError(f"{path}: {exc}") from None
+    tool = config.get("tool", {})
+    own = _normalize(tool.get("blacken-docs", {}))
+    use_black_config = own.pop("use-black-config", False)
+    if not isinstance(use_black_config, bool):
+        raise ConfigError(f"{path}: use-black-config must be a boolean")
+    for key in own:
+        if key not in SETTINGS:
+            raise ConfigError(f"{path}: unknown setting {key!r} in [tool.blacken-docs]")
+    settings: dict[str, Any] = {}
+    if use_black_config:
+        # Black has many settings of its own, which are ignored.
+        black = _normalize(tool.get("black", {}))
+        settings.update((key, black[key]) for key in SETTINGS if key in black)
+    settings.update(own)
+    for key, value in settings.items():
+        expected = SETTINGS[key]
+        if expected is list:
+            valid = isinstance(value, list) and all(
+                isinstance(item, str) for item in value
+            )
+        else:
+            # bool is a subclass of int.
+            valid = isinstance(value, expected) and (
+                expected is bool or not isinstance(value, bool)
+            )
+        if not valid:
+            raise ConfigError(f"{path}: invalid value for {key}: {value!r}")
+    return settings
+
+
+def _normalize(table: Any) -> dict[str, Any]:
+    # Accept keys with underscores, as Black does.
+    if not isinstance(table, dict):
+        return {}
+    return {key.replace("_", "-"): value for key, value in table.items()}
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import contextlib
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    import argparse
+    from concurrent.futures import Executor
+
+
+def default_socket_path() -> str:
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "blacken-docs.sock")
+    import tempfile
+
+    return os.path.join(tempfile.gettempdir(), f"blacken-docs-{os.getuid()}.sock")
+
+
+# Clients send one JSON request per connection, with their arguments, working
+# directory and Python environment, and receive one JSON response with the
+# output and return code of running them. Requests run one at a time.
+
+
+def request(socket_path: str, argv: list[str]) -> int | None:
+    # Run argv with the daemon, returning None if it is unavailable.
+    message = {"argv": argv, "cwd": os.getcwd(), "prefix": sys.prefix}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(message).encode() + b"\n")
+            sock.shutdown(socket.SHUT_WR)
+            with sock.makefile("rb") as f:
+                response = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if "error" in response:
+        return None
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    returncode: int = response["returncode"]
+    return returncode
+
+
+def serve(parser: argparse.ArgumentParser, socket_path: str) -> int:
+    # Import Black and compile patterns up front, so the first request is as
+    # fast as the rest.
+    import black  # noqa: F401
+
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(socket_path)
+            except OSError:
+                # Left behind by a daemon that didn't exit cleanly.
+                os.unlink(socket_path)
+            else:
+                parser.error(f"a daemon is already listening on {socket_path}")
+
+    server = _Server(socket_path, parser)
+    try:
+        os.chmod(socket_path, 0o600)
+        # Exit cleanly, removing the socket, when terminated.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print(f"blacken-docs daemon listening on {socket_path}", file=sys.stderr)
+        with contextlib.suppress(KeyboardInterrupt):
+            server.serve_forever()
+    finally:
+        server.server_close()
+        if server.executor is not None:
+            server.executor.shutdown()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(socket_path)
+    return 0
+
+
+class _Server(socketserver.UnixStreamServer):
+    def __init__(self, socket_path: str, parser: argparse.ArgumentParser) -> None:
+        self.parser = parser
+        # Worker processes, kept warm between requests with the same number
+        # of workers.
+        self.executor: Executor | None = None
+        self.workers: int | None = None
+        super().__init__(socket_path, _Handler)
+
+    def run(self, message: dict[str, Any]) -> dict[str, Any]:
+        from blacken_docs import _make_executor, _run
+
+        if message.get("prefix") != sys.prefix:
+            # Black and blacken-docs may be different versions.
+            return {"error": "the daemon runs in a different Python environment"}
+
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        cwd = os.getcwd()
+        try:
+            os.chdir(message["cwd"])
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                try:
+                    args = self.parser.parse_args(message["argv"])
+                    if args.daemon:
+                        self.parser.error("a daemon is already running")
+                    workers = args.workers or os.cpu_count() or 1
+                    if workers != self.workers:
+                        if self.executor is not None:
+                            self.executor.shutdown()
+                        self.executor = _make_executor(workers)
+                        self.workers = workers
+                    returncode = _run(
+                        self.parser, args, executor=self.executor, close_cache=False
+                    )
+                except SystemExit as exc:
+                    returncode = exc.code if isinstance(exc.code, int) else 1
+                except Exception as exc:
+                    print(f"blacken-docs daemon: {exc!r}", file=sys.stderr)
+                    returncode = 1
+        finally:
+            os.chdir(cwd)
+        return {
+            "stdout": stdout.getvalue(),
+            "stderr": stderr.getvalue(),
+            "returncode": returncode,
+        }
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: _Server
+
+    def handle(self) -> None:
+        try:
+            message = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        response = self.server.run(message)
+        self.wfile.write(json.dumps(response).encode())
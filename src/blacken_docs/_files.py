@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import os
+import re
+from collections.abc import Generator, Iterable
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pathspec import GitIgnoreSpec
+
+# Matching the files of the pre-commit hook.
+DEFAULT_INCLUDES = r"\.(rst|md|markdown|py|tex)$"
+# Matching Black's default excludes.
+DEFAULT_EXCLUDES = (
+    r"/(\.direnv|\.eggs|\.git|\.hg|\.ipynb_checkpoints|\.mypy_cache|\.nox"
+    r"|\.pytest_cache|\.ruff_cache|\.tox|\.svn|\.venv|\.vscode|__pypackages__"
+    r"|_build|buck-out|build|dist|venv)/"
+)
+
+
+def gen_files(
+    paths: Iterable[str], *, include: re.Pattern[str], exclude: re.Pattern[str]
+) -> Generator[str]:
+    # Yield files, and the files found in directories, as they are found.
+    # Within a directory, paths relative to it, with a leading slash, and a
+    # trailing slash for directories, must match include and not exclude or
+    # a .gitignore file. Files given directly are always yielded.
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        abs_path = os.path.abspath(path)
+        yield from _gen_dir_files(
+            path,
+            abs_path,
+            os.path.join(abs_path, ""),
+            include,
+            exclude,
+            _parent_gitignores(abs_path),
+        )
+
+
+def _gen_dir_files(
+    path: str,
+    abs_path: str,
+    root: str,
+    include: re.Pattern[str],
+    exclude: re.Pattern[str],
+    gitignores: list[tuple[str, GitIgnoreSpec]],
+) -> Generator[str]:
+    # root, and the bases of gitignores, end with a separator.
+    gitignore = _read_gitignore(abs_path)
+    if gitignore is not None:
+        gitignores = [*gitignores, (os.path.join(abs_path, ""), gitignore)]
+    try:
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError:
+        return
+    for entry in entries:
+        if entry.name == ".git":
+            continue
+        entry_path = os.path.join(path, entry.name)
+        entry_abs_path = os.path.join(abs_path, entry.name)
+        # Don't follow symlinks to directories, which may loop.
+        is_dir = entry.is_dir(follow_symlinks=False)
+        if not is_dir and not entry.is_file():
+            continue
+        suffix = "/" if is_dir else ""
+        relative = "/" + _posix(entry_abs_path[len(root) :]) + suffix
+        if exclude.search(relative):
+            continue
+        if any(
+            spec.match_file(_posix(entry_abs_path[len(base) :]) + suffix)
+            for base, spec in gitignores
+        ):
+            continue
+        if is_dir:
+            yield from _gen_dir_files(
+                entry_path, entry_abs_path, root, include, exclude, gitignores
+            )
+        elif include.search(relative):
+            yield entry_path
+
+
+def _parent_gitignores(root: str) -> list[tuple[str, GitIgnoreSpec]]:
+    # The .gitignore files that apply to root from its parent directories,
+    # up to the top of its git repository.
+    parents = []
+    directory = root
+    while True:
+        parent = os.path.dirname(directory)
+        if os.path.exists(os.path.join(directory, ".git")) or parent == directory:
+            break
+        directory = parent
+        parents.append(directory)
+    if not os.path.exists(os.path.join(directory, ".git")):
+        return []
+    gitignores = []
+    for directory in reversed(parents):
+        gitignore = _read_gitignore(directory)
+        if gitignore is not None:
+            gitignores.append((os.path.join(directory, ""), gitignore))
+    return gitignores
+
+
+def _read_gitignore(directory: str) -> GitIgnoreSpec | None:
+    try:
+        with open(os.path.join(directory, ".gitignore"), encoding="UTF-8") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    from pathspec import GitIgnoreSpec
+
+    return GitIgnoreSpec.from_lines(lines)
+
+
+def _posix(path: str) -> str:
+    return path.replace(os.sep, "/") if os.sep != "/" else path
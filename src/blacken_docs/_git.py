@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import os
+import re
+import subprocess
+import sys
+from collections.abc import Sequence
+
+HUNK_RE = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@")
+# Escapes in the C-quoted paths of git's output.
+ESCAPE_RE = re.compile(r"\\([0-7]{3}|.)")
+ESCAPES = {
+    "a": "\a",
+    "b": "\b",
+    "t": "\t",
+    "n": "\n",
+    "v": "\v",
+    "f": "\f",
+    "r": "\r",
+    '"': '"',
+    "\\": "\\",
+}
+
+
+class GitError(Exception):
+    pass
+
+
+def changed_lines(
+    filenames: Sequence[str], *, diff_base: str | None, staged: bool
+) -> dict[str, list[tuple[int, int]]]:
+    # Return the ranges of lines, 1-based and inclusive, changed in each of
+    # filenames since diff_base, or in the index if staged. Files without
+    # changes are left out. Untracked files are new since any ref, so
+    # without staged, all their lines count as changed.
+    top_level = _git("rev-parse", "--show-toplevel").rstrip("\n")
+    args = ["diff", "--no-color", "--no-ext-diff", "--no-renames", "--no-prefix"]
+    args.append("--unified=0")
+    if staged:
+        args.append("--cached")
+    if diff_base is not None:
+        args.append(diff_base)
+    # Map paths from git, relative to the top level, back to the filenames.
+    paths = {os.path.realpath(filename): filename for filename in filenames}
+    output = _git(*args, "--", *filenames)
+
+    ranges: dict[str, list[tuple[int, int]]] = {}
+    file_ranges: list[tuple[int, int]] | None = None
+    for line in output.splitlines():
+        if line.startswith("+++ "):
+            path = _unquote(line[len("+++ ") :])
+            filename = paths.get(os.path.realpath(os.path.join(top_level, path)))
+            file_ranges = None if filename is None else ranges.setdefault(filename, [])
+        elif file_ranges is not None and (match := HUNK_RE.match(line)):
+            start = int(match[1])
+            count = 1 if match[2] is None else int(match[2])
+            if count == 0:
+                # Lines were only removed, after line start, so count the
+                # surrounding block as changed.
+                file_ranges.append((max(start, 1), start + 1))
+            else:
+                file_ranges.append((start, start + count - 1))
+    if not staged:
+        untracked = _git(
+            "ls-files",
+            "--others",
+            "--exclude-standard",
+            "--full-name",
+            "-z",
+            "--",
+            *filenames,
+        )
+        for path in untracked.split("\0"):
+            filename = paths.get(os.path.realpath(os.path.join(top_level, path)))
+            if filename is not None:
+                ranges[filename] = [(1, sys.maxsize)]
+    return ranges
+
+
+def _unquote(path: str) -> str:
+    # git ends paths that contain spaces with a tab, and quotes paths that
+    # contain special characters, like a C string.
+    path = path.removesuffix("\t")
+    if not (len(path) > 1 and path.startswith('"') and path.endswith('"')):
+        return path
+    # Octal escapes are of UTF-8 bytes, so unquote to bytes.
+    raw = bytearray()
+    last_end = 1
+    for match in ESCAPE_RE.finditer(path, 1, len(path) - 1):
+        raw += path[last_end : match.start()].encode()
+        escape = match[1]
+        if len(escape) == 3:
+            raw.append(int(escape, 8))
+        else:
+            raw += ESCAPES.get(escape, escape).encode()
+        last_end = match.end()
+    raw += path[last_end:-1].encode()
+    return raw.decode("UTF-8", "surrogateescape")
+
+
+def _git(*args: str) -> str:
+    try:
+        result = subprocess.run(
+            ["git", "-c", "core.quotePath=false", *args],
+            capture_output=True,
+            check=True,
+            encoding="UTF-8",
+        )
+    except FileNotFoundError:
+        raise GitError("git is not installed") from None
+    except OSError as exc:
+        # Such as too long an argument list for many files.
+        raise GitError(str(exc)) from None
+    except subprocess.CalledProcessError as exc:
+        raise GitError(exc.stderr.strip() or f"git {args[0]} failed") from None
+    return result.stdout
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import io
+import keyword
+import re
+import tokenize
+
+NEWLINE_RE = re.compile("\n")
+STRING_PREFIX_CHARS = "rRuUbBfFtT"
+# Prefix characters of string literals that can't be docstrings.
+NOT_DOCSTRING_PREFIX_CHARS = frozenset("bBfFtT")
+
+
+def docstring_spans(src: str) -> list[tuple[int, int]] | None:
+    # Return the offsets of the contents of each module, class, function,
+    # and attribute docstring in src, between its quotes, in order. As with
+    # Sphinx's autodoc, attribute docstrings are string statements right
+    # after an assignment. Return None if src can't be tokenized.
+    line_starts = [0]
+    line_starts.extend(match.end() for match in NEWLINE_RE.finditer(src))
+    spans = []
+    # Whether the next statement may be a docstring, whether a def or class
+    # statement's colon is still to come, whether the current statement is
+    # an assignment, its first token, its number of tokens so far, and the
+    # nesting of brackets within it.
+    expect = True
+    header = False
+    assignment = False
+    first: tokenize.TokenInfo | None = None
+    index = 0
+    depth = 0
+    candidate: tokenize.TokenInfo | None = None
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(src).readline):
+            kind = token.type
+            if kind in (tokenize.NL, tokenize.COMMENT):
+                continue
+            if kind == tokenize.DEDENT:
+                # A string after the end of a block doesn't document the
+                # assignment within it.
+                expect = False
+                continue
+            end = kind in (tokenize.NEWLINE, tokenize.ENDMARKER) or (
+                kind == tokenize.OP and token.string == ";" and not depth
+            )
+            if candidate is not None:
+                # A docstring is a statement of the string alone.
+                if end:
+                    spans.append(_contents(candidate, line_starts))
+                candidate = None
+            if end:
+                # Statements starting with a keyword, such as "if x: y = 1",
+                # aren't assignments.
+                if not expect:
+                    expect = (
+                        assignment
+                        and first is not None
+                        and not keyword.iskeyword(first.string)
+                    )
+                assignment = False
+                index = depth = 0
+                continue
+            if kind == tokenize.INDENT:
+                continue
+            if expect:
+                expect = False
+                if kind == tokenize.STRING and _is_docstring_literal(token.string):
+                    candidate = token
+                    index = 1
+                    continue
+            if index == 0:
+                first = token
+            if kind == tokenize.OP:
+                if token.string in "([{":
+                    depth += 1
+                elif token.string in ")]}":
+                    depth -= 1
+                elif depth:
+                    pass
+                elif token.string == ":" and header:
+                    header = False
+                    expect = True
+                elif token.string == "=":
+                    assignment = True
+                elif (
+                    token.string == ":"
+                    and index == 1
+                    and first is not None
+                    and first.type == tokenize.NAME
+                ):
+                    # An annotated name.
+                    assignment = True
+            elif kind == tokenize.NAME and token.string in ("def", "class"):
+                header = True
+            index += 1
+    except (tokenize.TokenError, SyntaxError):
+        return None
+    return spans
+
+
+def _is_docstring_literal(text: str) -> bool:
+    prefix = text[: len(text) - len(text.lstrip(STRING_PREFIX_CHARS))]
+    return not NOT_DOCSTRING_PREFIX_CHARS.intersection(prefix)
+
+
+def _contents(token: tokenize.TokenInfo, line_starts: list[int]) -> tuple[int, int]:
+    text = token.string
+    prefix = len(text) - len(text.lstrip(STRING_PREFIX_CHARS))
+    quote = 3 if text[prefix : prefix + 3] in ('"""', "'''") else 1
+    start = line_starts[token.start[0] - 1] + token.start[1]
+    end = line_starts[token.end[0] - 1] + token.end[1]
+    return start + prefix + quote, end - quote
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import heapq
+import sys
+import time
+from collections import Counter, defaultdict
+from collections.abc import Generator
+from contextlib import contextmanager
+from typing import TextIO
+
+# Number of slowest files and code blocks to report.
+TOP = 10
+# Phases of formatting a file, in report order.
+PHASES = ("cache", "read", "scan", "black", "write")
+
+
+# Timings collected with --stats, and counts of files and code blocks skipped
+# for the size limits. Worker processes each collect their own, which are
+# merged for the report.
+class Stats:
+    def __init__(self) -> None:
+        self.files = 0
+        self.phase_times: defaultdict[str, float] = defaultdict(float)
+        self.block_counts: Counter[str] = Counter()
+        self.block_times: defaultdict[str, float] = defaultdict(float)
+        # Min-heaps of the slowest (seconds, location) pairs.
+        self.slowest_files: list[tuple[float, str]] = []
+        self.slowest_blocks: list[tuple[float, str]] = []
+        # Files and code blocks skipped for exceeding the size limits.
+        self.skipped_files = 0
+        self.skipped_blocks = 0
+        self._filename = "<string>"
+
+    def add_phase(self, name: str, seconds: float) -> None:
+        self.phase_times[name] += seconds
+
+    @contextmanager
+    def phase(self, name: str) -> Generator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    @contextmanager
+    def file(self, filename: str) -> Generator[None]:
+        self._filename = filename
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.files += 1
+            _push(self.slowest_files, (time.perf_counter() - start, filename))
+            self._filename = "<string>"
+
+    def add_block(self, block_type: str, lineno: int, seconds: float) -> None:
+        self.block_counts[block_type] += 1
+        self.block_times[block_type] += seconds
+        location = f"{self._filename}:{lineno} ({block_type})"
+        _push(self.slowest_blocks, (seconds, location))
+
+    def skip_file(self) -> None:
+        self.skipped_files += 1
+
+    def skip_block(self) -> None:
+        self.skipped_blocks += 1
+
+    def merge(self, other: Stats) -> None:
+        self.files += other.files
+        self.skipped_files += other.skipped_files
+        self.skipped_blocks += other.skipped_blocks
+        for name, seconds in other.phase_times.items():
+            self.phase_times[name] += seconds
+        self.block_counts.update(other.block_counts)
+        for block_type, seconds in other.block_times.items():
+            self.block_times[block_type] += seconds
+        for item in other.slowest_files:
+            _push(self.slowest_files, item)
+        for item in other.slowest_blocks:
+            _push(self.slowest_blocks, item)
+
+    def report(self, total: float, file: TextIO | None = None) -> None:
+        if file is None:
+            file = sys.stderr
+        lines = [f"{self.files} files in {total:.3f}s", "", "Phases:"]
+        for name in PHASES:
+            if name in self.phase_times:
+                lines.append(f"  {name:12} {self.phase_times[name]:9.3f}s")
+        lines += ["", "Code blocks:"]
+        for block_type, count in sorted(self.block_counts.items()):
+            seconds = self.block_times[block_type]
+            lines.append(f"  {block_type:12} {count:9} {seconds:9.3f}s")
+        if self.skipped_files or self.skipped_blocks:
+            lines += [
+                "",
+                "Skipped for size:",
+                f"  {'files':12} {self.skipped_files:9}",
+                f"  {'code blocks':12} {self.skipped_blocks:9}",
+            ]
+        lines += ["", "Slowest files:"]
+        for seconds, filename in sorted(self.slowest_files, reverse=True):
+            lines.append(f"  {seconds:9.3f}s {filename}")
+        lines += ["", "Slowest code blocks:"]
+        for seconds, location in sorted(self.slowest_blocks, reverse=True):
+            lines.append(f"  {seconds:9.3f}s {location}")
+        peak_memory = _peak_memory()
+        if peak_memory is not None:
+            lines += ["", f"Peak memory: {peak_memory / 2**20:.1f} MiB"]
+        print("\n".join(lines), file=file)
+
+    def report_skipped(self, file: TextIO | None = None) -> None:
+        # A summary of the skips alone, reported without --stats so that
+        # checks don't pass silently over skipped files and code blocks.
+        if file is None:
+            file = sys.stderr
+        if self.skipped_files or self.skipped_blocks:
+            print(
+                f"Skipped {self.skipped_files} files and {self.skipped_blocks} "
+                f"code blocks for size",
+                file=file,
+            )
+
+
+def _push(heap: list[tuple[float, str]], item: tuple[float, str]) -> None:
+    if len(heap) < TOP:
+        heapq.heappush(heap, item)
+    else:
+        heapq.heappushpop(heap, item)
+
+
+def _peak_memory() -> int | None:
+    # Peak resident set size in bytes, of this process or its largest worker.
+    try:
+        import resource
+    except ImportError:  # pragma: no cover
+        # Windows
+        return None
+
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # Reported in kilobytes, except on macOS.
+    return peak if sys.platform == "darwin" else peak * 1024
@@ -1,16 +1,34 @@
 from __future__ import annotations
 
+import mmap
+import signal
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
 from textwrap import dedent
 
 import black
+import pytest
 from black.const import DEFAULT_LINE_LENGTH
+from black.mode import TargetVersion
 
 import blacken_docs
 from blacken_docs import __main__  # noqa: F401
+from blacken_docs._cache import get_cache
+from blacken_docs._stats import Stats
 
 BLACK_MODE = black.Mode(line_length=DEFAULT_LINE_LENGTH)
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("BLACKEN_DOCS_CACHE_DIR", str(cache_dir))
+    return cache_dir
+
+
 def test_format_src_trivial():
     after, _ = blacken_docs.format_str("", BLACK_MODE)
     assert after == ""
@@ -381,749 +399,2841 @@ def test_format_src_markdown_comments_multiple():
     assert after == before
 
 
-def test_on_off_comments_in_code_blocks():
+def test_format_src_markdown_comments_not_scanned(monkeypatch):
+    md_re = blacken_docs.MD_RE
+    matched_at = []
+
+    class SpyPattern:
+        def match(self, src, pos):
+            matched_at.append(pos)
+            return md_re.match(src, pos)
+
+    monkeypatch.setattr(blacken_docs, "MD_RE", SpyPattern())
     before = dedent(
         """\
-        ````md
         <!-- blacken-docs:off -->
         ```python
-        f(1,2,3)
+        'single quotes rock'
         ```
         <!-- blacken-docs:on -->
-        ````
+        ```python
+        'double quotes rock'
+        ```
         """
     )
-    after, _ = blacken_docs.format_str(before, BLACK_MODE)
-    assert after == before
+    after, _ = blacken_docs.format_str(before, BLACK_MODE, source_format="markdown")
+    assert after == before.replace("'double quotes rock'", '"double quotes rock"')
+    assert matched_at == [before.index("```python\n'double")]
 
 
-def test_format_src_markdown_comments_disable_pycon():
+def test_format_src_markdown_unterminated():
     before = dedent(
         """\
-        <!-- blacken-docs:off -->
         ```pycon
-        >>> 'single quotes rock'
+        >>> f(1,2,3)
         ```
-        <!-- blacken-docs:on -->
-        """
-    )
-    after, _ = blacken_docs.format_str(before, BLACK_MODE)
-    assert after == before
-
 
-def test_format_src_latex_minted():
-    before = dedent(
-        """\
-        hello
-        \\begin{minted}{python}
+        ```python
         f(1,2,3)
-        \\end{minted}
-        world!
         """
     )
-    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    after, errors = blacken_docs.format_str(before, BLACK_MODE)
     assert after == dedent(
         """\
-        hello
-        \\begin{minted}{python}
-        f(1, 2, 3)
-        \\end{minted}
-        world!
+        ```pycon
+        >>> f(1, 2, 3)
+        ```
+
+        ```python
+        f(1,2,3)
         """
     )
+    assert len(errors) == 1
+    assert isinstance(errors[0].exc, blacken_docs.UnterminatedBlockError)
+    assert errors[0].lineno == 5
 
 
-def test_format_src_latex_minted_opt():
-    before = dedent(
-        """\
-        maths!
-        \\begin{minted}[mathescape]{python}
-        # Returns $\\sum_{i=1}^{n}i$
-        def sum_from_one_to(n):
-          r = range(1, n+1)
-          return sum(r)
-        \\end{minted}
-        done
-        """
-    )
-    after, _ = blacken_docs.format_str(before, BLACK_MODE)
-    assert after == dedent(
-        """\
-        maths!
-        \\begin{minted}[mathescape]{python}
-        # Returns $\\sum_{i=1}^{n}i$
-        def sum_from_one_to(n):
-            r = range(1, n + 1)
-            return sum(r)
-        \\end{minted}
-        done
-        """
-    )
+def test_format_src_markdown_unterminated_indent():
+    # Closing lines must match the indent of the opening line.
+    before = "- item\n\n  ```python\n  f(1,2,3)\n```\n"
+    after, errors = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == before
+    assert len(errors) == 1
+    assert errors[0].offset == before.index("  ```python")
 
 
-def test_format_src_latex_minted_indented():
-    # Personally I would have minted python code all flush left,
-    # with only the Python code's own four space indentation:
+def test_format_src_markdown_unterminated_off():
     before = dedent(
         """\
-        hello
-          \\begin{minted}{python}
-            if True:
-              f(1,2,3)
-          \\end{minted}
-        world!
-        """
-    )
-    after, _ = blacken_docs.format_str(before, BLACK_MODE)
-    assert after == dedent(
-        """\
-        hello
-          \\begin{minted}{python}
-          if True:
-              f(1, 2, 3)
-          \\end{minted}
-        world!
+        <!-- blacken-docs:off -->
+        ```python
+        f(1,2,3)
+        <!-- blacken-docs:on -->
         """
     )
+    after, errors = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == before
+    assert errors == []
 
 
-def test_format_src_latex_minted_pycon():
+def test_format_src_markdown_comments_block_starts_off():
     before = dedent(
         """\
-        Preceding text
-        \\begin{minted}[gobble=2,showspaces]{pycon}
-        >>> print( 'Hello World' )
-        Hello World
-        \\end{minted}
-        Following text.
+        <!-- blacken-docs:off -->
+        ```python
+        'single quotes rock'
+        <!-- blacken-docs:on -->
+        ```
         """
     )
     after, _ = blacken_docs.format_str(before, BLACK_MODE)
-    assert after == dedent(
-        """\
-        Preceding text
-        \\begin{minted}[gobble=2,showspaces]{pycon}
-        >>> print("Hello World")
-        Hello World
-        \\end{minted}
-        Following text.
-        """
-    )
+    assert after == before
 
 
-def test_format_src_latex_minted_pycon_indented():
-    # Nicer style to put the \begin and \end on new lines,
-    # but not actually required for the begin line
+def test_format_src_lines():
     before = dedent(
         """\
-        Preceding text
-          \\begin{minted}{pycon}
-            >>> print( 'Hello World' )
-            Hello World
-          \\end{minted}
-        Following text.
-        """
-    )
-    after, _ = blacken_docs.format_str(before, BLACK_MODE)
-    assert after == dedent(
-        """\
-        Preceding text
-          \\begin{minted}{pycon}
-          >>> print("Hello World")
-          Hello World
-          \\end{minted}
-        Following text.
+        ```python
+        f(1,2)
+        ```
+
+        ```python
+        g(1,2)
+        ```
         """
     )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE, lines=[(6, 6)])
+    assert after == before.replace("g(1,2)", "g(1, 2)")
 
 
-def test_format_src_latex_minted_comments_off():
+def test_format_src_lines_block_boundary():
+    before = "```python\nf(1,2)\n```\ntext\n"
+    after, _ = blacken_docs.format_str(before, BLACK_MODE, lines=[(3, 4)])
+    assert after == "```python\nf(1, 2)\n```\ntext\n"
+
+
+def test_format_src_lines_outside():
+    before = "text\n\n```python\nf(1,2)\n```\n\ntext\n"
+    after, _ = blacken_docs.format_str(before, BLACK_MODE, lines=[(1, 2), (6, 7)])
+    assert after == before
+
+
+def test_format_src_lines_empty():
+    before = "```python\nf(1,2)\n```\n"
+    after, _ = blacken_docs.format_str(before, BLACK_MODE, lines=[])
+    assert after == before
+
+
+def test_on_off_comments_in_code_blocks():
     before = dedent(
         """\
-        % blacken-docs:off
-        \\begin{minted}{python}
-        'single quotes rock'
-        \\end{minted}
-        % blacken-docs:on
+        ````md
+        <!-- blacken-docs:off -->
+        ```python
+        f(1,2,3)
+        ```
+        <!-- blacken-docs:on -->
+        ````
         """
     )
     after, _ = blacken_docs.format_str(before, BLACK_MODE)
     assert after == before
 
 
-def test_format_src_latex_minted_comments_off_pycon():
+def test_format_src_markdown_comments_disable_pycon():
     before = dedent(
         """\
-        % blacken-docs:off
-        \\begin{minted}{pycon}
+        <!-- blacken-docs:off -->
+        ```pycon
         >>> 'single quotes rock'
-        \\end{minted}
-        % blacken-docs:on
+        ```
+        <!-- blacken-docs:on -->
         """
     )
     after, _ = blacken_docs.format_str(before, BLACK_MODE)
     assert after == before
 
 
-def test_format_src_pythontex():
-    # fmt: off
+def test_format_src_markdown_comments_disable_after_edit():
     before = dedent(
         """\
-        hello
-        \\begin{pyblock}
-        f(1,2,3)
-        \\end{pyblock}
-        world!
+        ```python
+        x = [
+            1,
+            2,
+        ]
+        ```
+        <!-- blacken-docs:off -->
+        ```pycon
+        >>> 'single quotes rock'
+        ```
+        <!-- blacken-docs:on -->
         """
     )
     after, _ = blacken_docs.format_str(before, BLACK_MODE)
     assert after == dedent(
         """\
-        hello
-        \\begin{pyblock}
-        f(1, 2, 3)
-        \\end{pyblock}
-        world!
+        ```python
+        x = [
+            1,
+            2,
+        ]
+        ```
+        <!-- blacken-docs:off -->
+        ```pycon
+        >>> 'single quotes rock'
+        ```
+        <!-- blacken-docs:on -->
         """
     )
-    # fmt: on
 
 
-def test_format_src_pythontex_comments_off():
+def test_format_src_markdown_in_rst_code_block():
     before = dedent(
         """\
-        % blacken-docs:off
-        \\begin{pyblock}
-        f(1,2,3)
-        \\end{pyblock}
-        % blacken-docs:on
+        .. code-block:: markdown
+
+            ```python
+            f(1,2,3)
+            ```
         """
     )
     after, _ = blacken_docs.format_str(before, BLACK_MODE)
-    assert after == before
+    assert after == dedent(
+        """\
+        .. code-block:: markdown
+
+            ```python
+            f(1, 2, 3)
+            ```
+        """
+    )
 
 
-def test_format_src_rst():
+def test_format_src_rst_in_rst_code_block():
     before = dedent(
         """\
-        hello
-
-        .. code-block:: python
+        .. code-block:: rst
 
-            f(1,2,3)
+            .. code-block:: python
 
-        world
+                f(1,2,3)
         """
     )
     after, _ = blacken_docs.format_str(before, BLACK_MODE)
-    assert after == dedent(
-        """\
-        hello
+    assert after == before
 
-        .. code-block:: python
 
-            f(1, 2, 3)
+@pytest.fixture
+def black_calls(monkeypatch):
+    calls = []
+    original = black.format_str
 
-        world
-        """
-    )
+    def format_str(src, *, mode):
+        calls.append(src)
+        return original(src, mode=mode)
 
+    monkeypatch.setattr(black, "format_str", format_str)
+    return calls
 
-def test_format_src_rst_empty():
-    before = "some text\n\n.. code-block:: python\n\n\nsome other text\n"
-    after, _ = blacken_docs.format_str(before, BLACK_MODE)
-    assert after == before
 
+BATCH_MODE = black.Mode(target_versions={TargetVersion.PY310})
 
-def test_format_src_rst_literal_blocks():
+
+def test_format_src_batch(black_calls):
     before = dedent(
         """\
-        hello::
+        ```python
+        f(1,2,3)
+        ```
 
-            f(1,2,3)
+        ```python
+        def g(): pass
+        ```
 
-        world
+        ```python
+        x = {'a':1}
+        ```
         """
     )
-    after, _ = blacken_docs.format_str(
-        before,
-        BLACK_MODE,
-        rst_literal_blocks=True,
-    )
+    after, errors = blacken_docs.format_str(before, BATCH_MODE)
     assert after == dedent(
         """\
-        hello::
+        ```python
+        f(1, 2, 3)
+        ```
 
-            f(1, 2, 3)
+        ```python
+        def g():
+            pass
+        ```
 
-        world
+        ```python
+        x = {"a": 1}
+        ```
         """
     )
+    assert errors == []
+    assert len(black_calls) == 1
 
 
-def test_format_src_rst_literal_block_empty():
+def test_format_src_batch_error(black_calls):
     before = dedent(
         """\
-        hello::
-        world
-        """
-    )
-    after, _ = blacken_docs.format_str(
-        before,
-        BLACK_MODE,
-        rst_literal_blocks=True,
-    )
-    assert after == before
+        ```python
+        f(1,2,3)
+        ```
 
+        ```python
+        f(
+        ```
 
-def test_format_src_rst_literal_blocks_nested():
-    before = dedent(
+        ```python
+        x = {'a':1}
+        ```
         """
-        * hello
+    )
+    after, errors = blacken_docs.format_str(before, BATCH_MODE)
+    assert after == dedent(
+        """\
+        ```python
+        f(1, 2, 3)
+        ```
 
-          .. warning::
+        ```python
+        f(
+        ```
 
-            don't hello too much
-        """,
-    )
-    after, errors = blacken_docs.format_str(
-        before,
-        BLACK_MODE,
-        rst_literal_blocks=True,
+        ```python
+        x = {"a": 1}
+        ```
+        """
     )
-    assert after == before
-    assert errors == []
+    assert len(errors) == 1
+    assert errors[0].offset == before.index("```python\nf(\n")
+    assert len(black_calls) > 1
+
+
+@pytest.mark.parametrize(
+    ("invalid", "valid"),
+    [
+        ("@decorator\n", "def f(): pass\n"),
+        ("else:\n    pass\n", "if x: pass\n"),
+    ],
+)
+def test_format_src_batch_error_continued(invalid, valid):
+    # Blocks that only parse when joined with their neighbour are still
+    # errors in a batch.
+    if invalid.startswith("@"):
+        blocks = (invalid, valid)
+    else:
+        blocks = (valid, invalid)
+    before = "".join(f"```python\n{block}```\n\n" for block in blocks)
+    for mode in (BLACK_MODE, BATCH_MODE):
+        after, errors = blacken_docs.format_str(before, mode)
+        assert after == before.replace(valid, valid.replace(": pass", ":\n    pass"))
+        assert [error.offset for error in errors] == [
+            before.index(f"```python\n{invalid}")
+        ]
 
 
-def test_format_src_rst_literal_blocks_empty():
+def test_format_src_batch_unsafe(black_calls):
     before = dedent(
+        """\
+        ```python
+        x = 1
+        # trailing comment
+        ```
+
+        ```python
+        def f(): pass
+        ```
+
+        ```python
+        'docstring'
+        ```
         """
-        Example::
+    )
+    after, _ = blacken_docs.format_str(before, BATCH_MODE)
+    assert after == dedent(
+        """\
+        ```python
+        x = 1
+        # trailing comment
+        ```
 
-        .. warning::
+        ```python
+        def f():
+            pass
+        ```
 
-            There was no example.
-        """,
+        ```python
+        "docstring"
+        ```
+        """
     )
-    after, errors = blacken_docs.format_str(
-        before,
-        BLACK_MODE,
-        rst_literal_blocks=True,
+    assert len(black_calls) == 3
+
+
+@pytest.mark.parametrize(
+    ("code", "formatted"),
+    [
+        # Would turn formatting off for the following blocks.
+        ("# fmt: off\nx = [1,2]\n", "# fmt: off\nx = [1,2]\n"),
+        # Would split the batch in the wrong place.
+        (
+            f"{blacken_docs.BATCH_SEPARATOR}\nx = [1,2]\n",
+            f"{blacken_docs.BATCH_SEPARATOR}\nx = [1, 2]\n",
+        ),
+        # An odd number of triple quotes may leave a string open.
+        ('x = [1,2]  # """\n', 'x = [1, 2]  # """\n'),
+        # Too long to be worth batching.
+        ("x=1\n" * 21, "x = 1\n" * 21),
+    ],
+)
+def test_format_src_batch_excluded(black_calls, code, formatted):
+    before = (
+        f"```python\n{code}```\n\n```python\nf(1,2)\n```\n\n```python\ng(1,2)\n```\n"
+    )
+    after, errors = blacken_docs.format_str(before, BATCH_MODE)
+    assert after == (
+        f"```python\n{formatted}```\n\n"
+        f"```python\nf(1, 2)\n```\n\n```python\ng(1, 2)\n```\n"
     )
-    assert after == before
     assert errors == []
+    assert black_calls[0] == code
+    assert len(black_calls) == 2
 
 
-def test_format_src_rst_literal_blocks_comments():
-    before = dedent(
-        """\
-        .. blacken-docs:off
-        Example::
+def test_format_src_batch_cached(black_calls, tmp_path):
+    before = "```python\nf(1,2)\n```\n\n```python\ng(1,2)\n```\n"
+    cache = get_cache(str(tmp_path / "cache"))
+    try:
+        after, _ = blacken_docs.format_str(before, BATCH_MODE, cache=cache)
+        assert len(black_calls) == 1
+        assert blacken_docs.format_str(before, BATCH_MODE, cache=cache)[0] == after
+        assert len(black_calls) == 1
+    finally:
+        cache.close()
+    assert after == "```python\nf(1, 2)\n```\n\n```python\ng(1, 2)\n```\n"
 
-            'single quotes rock'
 
-        .. blacken-docs:on
-        """
-    )
-    after, _ = blacken_docs.format_str(before, BLACK_MODE, rst_literal_blocks=True)
-    assert after == before
+def test_format_src_batch_inferred_target_versions(black_calls):
+    before = "```python\nf(1,2,3)\n```\n\n```python\nf(4,5,6)\n```\n"
+    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == "```python\nf(1, 2, 3)\n```\n\n```python\nf(4, 5, 6)\n```\n"
+    assert len(black_calls) == 2
 
 
-def test_format_src_rst_sphinx_doctest():
+def test_format_src_batch_pycon(black_calls):
     before = dedent(
         """\
-        .. testsetup:: group1
+        ```pycon
+        >>> f(1,2,3)
+        1
+        >>> def g(): pass
+        >>> x = {'a':1}
+        ```
 
-           import parrot
-           mock = SomeMock( )
+        ```python
+        f(4,5,6)
+        ```
 
-        .. testcleanup:: group1
+        .. code-block:: pycon
 
-           mock.stop( )
+            >>> for i in range(3):
+            ...     print(i,end='')
+            012
+        """
+    )
+    after, errors = blacken_docs.format_str(before, BATCH_MODE)
+    assert after == dedent(
+        """\
+        ```pycon
+        >>> f(1, 2, 3)
+        1
+        >>> def g():
+        ...     pass
+        ...
+        >>> x = {"a": 1}
+        ```
 
-        .. doctest:: group1
+        ```python
+        f(4, 5, 6)
+        ```
 
-           >>> parrot.voom( 3000 )
-           This parrot wouldn't voom if you put 3000 volts through it!
+        .. code-block:: pycon
 
-        .. testcode::
+            >>> for i in range(3):
+            ...     print(i, end="")
+            ...
+            012
+        """
+    )
+    assert errors == []
+    assert len(black_calls) == 1
 
-           parrot.voom( 3000 )
 
+def test_format_src_batch_pycon_error(black_calls):
+    before = dedent(
+        """\
+        ```pycon
+        >>> f(1,2,3)
+        >>> f(
+        >>> x = {'a':1}
+        ```
         """
     )
-    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    after, errors = blacken_docs.format_str(before, BATCH_MODE)
     assert after == dedent(
         """\
-        .. testsetup:: group1
+        ```pycon
+        >>> f(1, 2, 3)
+        >>> f(
+        >>> x = {"a": 1}
+        ```
+        """
+    )
+    assert len(errors) == 1
+    assert errors[0].offset == 0
+    assert len(black_calls) > 1
 
-           import parrot
 
-           mock = SomeMock()
+@pytest.mark.parametrize(
+    "session",
+    [
+        ">>> @functools.cache\n>>> def f(): pass\n",
+        ">>> if x: pass\n>>> else: pass\n",
+    ],
+)
+def test_format_src_batch_pycon_error_continued(session):
+    # Prompts that only parse when joined with the next are still errors.
+    before = f"```pycon\n{session}```\n"
+    for mode in (BLACK_MODE, BATCH_MODE):
+        after, errors = blacken_docs.format_str(before, mode)
+        assert len(errors) == 1
+        assert errors[0].offset == 0
 
-        .. testcleanup:: group1
 
-           mock.stop()
+@pytest.fixture
+def slow_black(monkeypatch):
+    # Black, taking a minute over code that calls slow().
+    original = black.format_str
 
-        .. doctest:: group1
+    def format_str(src, *, mode):
+        if "slow(" in src:
+            time.sleep(60)
+        return original(src, mode=mode)
 
-           >>> parrot.voom(3000)
-           This parrot wouldn't voom if you put 3000 volts through it!
+    monkeypatch.setattr(black, "format_str", format_str)
 
-        .. testcode::
 
-           parrot.voom(3000)
+BLOCK_TIMEOUT_SRC = dedent(
+    """\
+    ```python
+    f(1,2,3)
+    ```
 
-        """
+    ```python
+    slow(1,2,3)
+    ```
+
+    ```pycon
+    >>> g(1,2,3)
+    ```
+    """
+)
+
+
+@pytest.mark.skipif(not hasattr(signal, "setitimer"), reason="Requires SIGALRM.")
+@pytest.mark.parametrize("mode", [BLACK_MODE, BATCH_MODE])
+def test_format_src_block_timeout(slow_black, mode):
+    start = time.perf_counter()
+    after, errors = blacken_docs.format_str(BLOCK_TIMEOUT_SRC, mode, block_timeout=0.1)
+    assert time.perf_counter() - start < 10
+    assert after == BLOCK_TIMEOUT_SRC.replace("f(1,2,3)", "f(1, 2, 3)").replace(
+        "g(1,2,3)", "g(1, 2, 3)"
     )
+    assert len(errors) == 1
+    assert errors[0].lineno == 5
+    assert isinstance(errors[0].exc, blacken_docs.BlockTimeoutError)
+    assert str(errors[0].exc) == "formatting took longer than 0.1 seconds"
+    assert signal.getitimer(signal.ITIMER_REAL) == (0.0, 0.0)
 
 
-def test_format_src_rst_indented():
-    before = dedent(
-        """\
-        .. versionadded:: 3.1
+@pytest.mark.skipif(not hasattr(signal, "setitimer"), reason="Requires SIGALRM.")
+def test_format_src_block_timeout_batch(slow_black, monkeypatch):
+    # A slow block in a batch costs one timeout for the batch, and one when
+    # formatted alone, rather than one for every halving of the batch.
+    slow_calls = []
+    format_str = black.format_str
 
-            hello
+    def counting_format_str(src, *, mode):
+        if "slow(" in src:
+            slow_calls.append(src)
+        return format_str(src, mode=mode)
 
-            .. code-block:: python
+    monkeypatch.setattr(black, "format_str", counting_format_str)
+    blocks = [f"```python\nf({i},2,3)\n```\n" for i in range(99)]
+    blocks.insert(50, "```python\nslow(1,2,3)\n```\n")
+    before = "\n".join(blocks)
 
-                def hi():
-                    f(1,2,3)
+    start = time.perf_counter()
+    after, errors = blacken_docs.format_str(before, BATCH_MODE, block_timeout=0.05)
 
-            world
-        """
+    assert time.perf_counter() - start < 10
+    assert len(slow_calls) == 2
+    assert [type(error.exc) for error in errors] == [blacken_docs.BlockTimeoutError]
+    assert after == before.replace(",2,3)", ", 2, 3)").replace(
+        "slow(1, 2, 3)", "slow(1,2,3)"
     )
-    after, _ = blacken_docs.format_str(before, BLACK_MODE)
-    assert after == dedent(
-        """\
-        .. versionadded:: 3.1
 
-            hello
 
-            .. code-block:: python
+def test_format_src_max_block_lines(black_calls):
+    before = dedent(
+        """\
+        ```python
+        f(1,2,3)
+        ```
 
-                def hi():
-                    f(1, 2, 3)
+        .. code-block:: python
 
-            world
+            f(1,2,3)
+            g(1,2,3)
+            h(1,2,3)
         """
     )
-
-
-def test_format_src_rst_code_block_indent():
-    before = "\n".join(
-        [
-            ".. code-block:: python",
-            "   ",
-            "   f(1,2,3)\n",
-        ]
+    stats = Stats()
+    after, errors = blacken_docs.format_str(
+        before, BLACK_MODE, stats=stats, max_block_lines=2
     )
-    after, _ = blacken_docs.format_str(before, BLACK_MODE)
-    assert after == "\n".join(
-        [
-            ".. code-block:: python",
-            "   ",
-            "   f(1, 2, 3)\n",
-        ]
+    assert after == before.replace("f(1,2,3)\n```", "f(1, 2, 3)\n```")
+    assert errors == []
+    assert black_calls == ["f(1,2,3)\n"]
+    assert stats.skipped_blocks == 1
+
+    # Blocks are skipped the same without stats.
+    assert blacken_docs.format_str(before, BLACK_MODE, max_block_lines=2) == (
+        after,
+        [],
     )
 
 
-def test_format_src_rst_with_highlight_directives():
+def test_format_src_latex_minted():
     before = dedent(
         """\
-        .. code-block:: python
-            :lineno-start: 10
-            :emphasize-lines: 11
-
-            def foo():
-                bar(1,2,3)
+        hello
+        \\begin{minted}{python}
+        f(1,2,3)
+        \\end{minted}
+        world!
         """
     )
     after, _ = blacken_docs.format_str(before, BLACK_MODE)
     assert after == dedent(
         """\
-        .. code-block:: python
-            :lineno-start: 10
-            :emphasize-lines: 11
-
-            def foo():
-                bar(1, 2, 3)
+        hello
+        \\begin{minted}{python}
+        f(1, 2, 3)
+        \\end{minted}
+        world!
         """
     )
 
 
-def test_format_src_rst_python_inside_non_python_code_block():
+def test_format_src_latex_minted_opt():
     before = dedent(
         """\
-        blacken-docs does changes like:
-
-        .. code-block:: diff
-
-             .. code-block:: python
-
-            -    'Hello World'
-            +    "Hello World"
+        maths!
+        \\begin{minted}[mathescape]{python}
+        # Returns $\\sum_{i=1}^{n}i$
+        def sum_from_one_to(n):
+          r = range(1, n+1)
+          return sum(r)
+        \\end{minted}
+        done
         """
     )
     after, _ = blacken_docs.format_str(before, BLACK_MODE)
-    assert after == before
-
-
-def test_format_src_rst_python_comments():
-    before = dedent(
+    assert after == dedent(
         """\
-        .. blacken-docs:off
+        maths!
+        \\begin{minted}[mathescape]{python}
+        # Returns $\\sum_{i=1}^{n}i$
+        def sum_from_one_to(n):
+            r = range(1, n + 1)
+            return sum(r)
+        \\end{minted}
+        done
+        """
+    )
+
+
+def test_format_src_latex_minted_indented():
+    # Personally I would have minted python code all flush left,
+    # with only the Python code's own four space indentation:
+    before = dedent(
+        """\
+        hello
+          \\begin{minted}{python}
+            if True:
+              f(1,2,3)
+          \\end{minted}
+        world!
+        """
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == dedent(
+        """\
+        hello
+          \\begin{minted}{python}
+          if True:
+              f(1, 2, 3)
+          \\end{minted}
+        world!
+        """
+    )
+
+
+def test_format_src_latex_minted_pycon():
+    before = dedent(
+        """\
+        Preceding text
+        \\begin{minted}[gobble=2,showspaces]{pycon}
+        >>> print( 'Hello World' )
+        Hello World
+        \\end{minted}
+        Following text.
+        """
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == dedent(
+        """\
+        Preceding text
+        \\begin{minted}[gobble=2,showspaces]{pycon}
+        >>> print("Hello World")
+        Hello World
+        \\end{minted}
+        Following text.
+        """
+    )
+
+
+def test_format_src_latex_minted_pycon_indented():
+    # Nicer style to put the \begin and \end on new lines,
+    # but not actually required for the begin line
+    before = dedent(
+        """\
+        Preceding text
+          \\begin{minted}{pycon}
+            >>> print( 'Hello World' )
+            Hello World
+          \\end{minted}
+        Following text.
+        """
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == dedent(
+        """\
+        Preceding text
+          \\begin{minted}{pycon}
+          >>> print("Hello World")
+          Hello World
+          \\end{minted}
+        Following text.
+        """
+    )
+
+
+def test_format_src_latex_minted_comments_off():
+    before = dedent(
+        """\
+        % blacken-docs:off
+        \\begin{minted}{python}
+        'single quotes rock'
+        \\end{minted}
+        % blacken-docs:on
+        """
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == before
+
+
+def test_format_src_latex_minted_comments_off_pycon():
+    before = dedent(
+        """\
+        % blacken-docs:off
+        \\begin{minted}{pycon}
+        >>> 'single quotes rock'
+        \\end{minted}
+        % blacken-docs:on
+        """
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == before
+
+
+def test_format_src_pythontex():
+    # fmt: off
+    before = dedent(
+        """\
+        hello
+        \\begin{pyblock}
+        f(1,2,3)
+        \\end{pyblock}
+        world!
+        """
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == dedent(
+        """\
+        hello
+        \\begin{pyblock}
+        f(1, 2, 3)
+        \\end{pyblock}
+        world!
+        """
+    )
+    # fmt: on
+
+
+def test_format_src_latex_unterminated():
+    before = dedent(
+        """\
+        \\begin{minted}{python}
+        f(1,2,3)
+        \\end{pycode}
+        \\begin{pycode}
+        f(1,2,3)
+        \\end{pycode}
+        """
+    )
+    after, errors = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == dedent(
+        """\
+        \\begin{minted}{python}
+        f(1,2,3)
+        \\end{pycode}
+        \\begin{pycode}
+        f(1, 2, 3)
+        \\end{pycode}
+        """
+    )
+    assert len(errors) == 1
+    assert isinstance(errors[0].exc, blacken_docs.UnterminatedBlockError)
+    assert errors[0].offset == 0
+
+
+def test_format_src_pythontex_comments_off():
+    before = dedent(
+        """\
+        % blacken-docs:off
+        \\begin{pyblock}
+        f(1,2,3)
+        \\end{pyblock}
+        % blacken-docs:on
+        """
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == before
+
+
+def test_format_src_rst():
+    before = dedent(
+        """\
+        hello
+
+        .. code-block:: python
+
+            f(1,2,3)
+
+        world
+        """
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == dedent(
+        """\
+        hello
+
         .. code-block:: python
 
-            'single quotes rock'
+            f(1, 2, 3)
+
+        world
+        """
+    )
+
+
+def test_format_src_rst_empty():
+    before = "some text\n\n.. code-block:: python\n\n\nsome other text\n"
+    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == before
+
+
+def test_format_src_rst_literal_blocks():
+    before = dedent(
+        """\
+        hello::
+
+            f(1,2,3)
+
+        world
+        """
+    )
+    after, _ = blacken_docs.format_str(
+        before,
+        BLACK_MODE,
+        rst_literal_blocks=True,
+    )
+    assert after == dedent(
+        """\
+        hello::
+
+            f(1, 2, 3)
+
+        world
+        """
+    )
+
+
+def test_format_src_rst_literal_block_empty():
+    before = dedent(
+        """\
+        hello::
+        world
+        """
+    )
+    after, _ = blacken_docs.format_str(
+        before,
+        BLACK_MODE,
+        rst_literal_blocks=True,
+    )
+    assert after == before
+
+
+def test_format_src_rst_literal_blocks_nested():
+    before = dedent(
+        """
+        * hello
+
+          .. warning::
+
+            don't hello too much
+        """,
+    )
+    after, errors = blacken_docs.format_str(
+        before,
+        BLACK_MODE,
+        rst_literal_blocks=True,
+    )
+    assert after == before
+    assert errors == []
+
+
+def test_format_src_rst_literal_blocks_empty():
+    before = dedent(
+        """
+        Example::
+
+        .. warning::
+
+            There was no example.
+        """,
+    )
+    after, errors = blacken_docs.format_str(
+        before,
+        BLACK_MODE,
+        rst_literal_blocks=True,
+    )
+    assert after == before
+    assert errors == []
+
+
+def test_format_src_rst_literal_blocks_comments():
+    before = dedent(
+        """\
+        .. blacken-docs:off
+        Example::
+
+            'single quotes rock'
+
+        .. blacken-docs:on
+        """
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE, rst_literal_blocks=True)
+    assert after == before
+
+
+def test_format_src_rst_sphinx_doctest():
+    before = dedent(
+        """\
+        .. testsetup:: group1
+
+           import parrot
+           mock = SomeMock( )
+
+        .. testcleanup:: group1
+
+           mock.stop( )
+
+        .. doctest:: group1
+
+           >>> parrot.voom( 3000 )
+           This parrot wouldn't voom if you put 3000 volts through it!
+
+        .. testcode::
+
+           parrot.voom( 3000 )
+
+        """
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == dedent(
+        """\
+        .. testsetup:: group1
+
+           import parrot
+
+           mock = SomeMock()
+
+        .. testcleanup:: group1
+
+           mock.stop()
+
+        .. doctest:: group1
+
+           >>> parrot.voom(3000)
+           This parrot wouldn't voom if you put 3000 volts through it!
+
+        .. testcode::
+
+           parrot.voom(3000)
+
+        """
+    )
+
+
+def test_format_src_rst_indented():
+    before = dedent(
+        """\
+        .. versionadded:: 3.1
+
+            hello
+
+            .. code-block:: python
+
+                def hi():
+                    f(1,2,3)
+
+            world
+        """
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == dedent(
+        """\
+        .. versionadded:: 3.1
+
+            hello
+
+            .. code-block:: python
+
+                def hi():
+                    f(1, 2, 3)
+
+            world
+        """
+    )
+
+
+def test_format_src_rst_code_block_indent():
+    before = "\n".join(
+        [
+            ".. code-block:: python",
+            "   ",
+            "   f(1,2,3)\n",
+        ]
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == "\n".join(
+        [
+            ".. code-block:: python",
+            "   ",
+            "   f(1, 2, 3)\n",
+        ]
+    )
+
+
+def test_format_src_rst_with_highlight_directives():
+    before = dedent(
+        """\
+        .. code-block:: python
+            :lineno-start: 10
+            :emphasize-lines: 11
+
+            def foo():
+                bar(1,2,3)
+        """
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == dedent(
+        """\
+        .. code-block:: python
+            :lineno-start: 10
+            :emphasize-lines: 11
+
+            def foo():
+                bar(1, 2, 3)
+        """
+    )
+
+
+def test_format_src_rst_python_inside_non_python_code_block():
+    before = dedent(
+        """\
+        blacken-docs does changes like:
+
+        .. code-block:: diff
+
+             .. code-block:: python
+
+            -    'Hello World'
+            +    "Hello World"
+        """
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == before
+
+
+def test_format_src_rst_python_comments():
+    before = dedent(
+        """\
+        .. blacken-docs:off
+        .. code-block:: python
+
+            'single quotes rock'
+
+        .. blacken-docs:on
+        """
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == before
+
+
+def test_format_src_rst_option_without_code():
+    # Without code after the options, the last option is taken as the code.
+    before = dedent(
+        """\
+        .. code-block:: python
+            :caption: f(1,2,3)
+        text
+        """
+    )
+    after, errors = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == dedent(
+        """\
+        .. code-block:: python
+            :caption: f(1,2,3)
+        text
+        """
+    )
+    assert len(errors) == 1
+
+
+@pytest.mark.parametrize(
+    ("before", "after"),
+    (
+        # No code follows the header.
+        (".. code-block:: python\ntext\n", ".. code-block:: python\ntext\n"),
+        ("text::\nf(1,2)", "text::\nf(1,2)"),
+        # The literal block takes the longest indent its code follows.
+        ("    text::\n  f(1,2)\n", "    text::\n  f(1, 2)\n"),
+        # A blank line indented less than the header may hold spaces.
+        (
+            "    .. code-block:: python\n  \n        f(1,2)\n",
+            "    .. code-block:: python\n  \n        f(1, 2)\n",
+        ),
+    ),
+)
+def test_format_src_rst_block_ends(before, after):
+    assert blacken_docs.format_str(before, BLACK_MODE, rst_literal_blocks=True) == (
+        after,
+        [],
+    )
+
+
+def _scan_seconds(src: str) -> float:
+    start = time.perf_counter()
+    blacken_docs.format_str(src, BLACK_MODE, rst_literal_blocks=True)
+    return time.perf_counter() - start
+
+
+@pytest.mark.parametrize(
+    "line",
+    (
+        # A literal block header may take any of its indents.
+        "{indent}x::\nz\n",
+        "{indent}```python\n",
+        "{indent}.. code-block:: text\n{indent}   :caption: x\n{indent}z\n",
+        "{indent}.. code-block:: pycon\n\n\n{indent}z\n",
+    ),
+)
+def test_format_src_rst_linear(line):
+    # Scanning takes tens of milliseconds, where backtracking over each indent
+    # takes around forty seconds. The limit is generous, for slow shared
+    # machines.
+    assert _scan_seconds(line.format(indent=" " * 32000) * 8) < 5
+
+
+@pytest.mark.parametrize(
+    "block",
+    ("```python\nx\n", "\\begin{minted}{python}\nx\n", "\\begin{pycode}\nx\n"),
+)
+def test_format_src_unterminated_linear(block):
+    # Unterminated blocks are found in a fraction of a second, without
+    # searching the rest of the document from each one, which takes around
+    # thirty seconds here. The limit is generous, for slow shared machines.
+    assert _scan_seconds(block * 16000) < 5
+
+
+def test_detect_format():
+    assert blacken_docs.detect_format("README.md") == "markdown"
+    assert blacken_docs.detect_format("docs/index.markdown") == "markdown"
+    assert blacken_docs.detect_format("README.RST") == "rst"
+    assert blacken_docs.detect_format("paper.tex") == "latex"
+    assert blacken_docs.detect_format("example.py") == "python"
+    assert blacken_docs.detect_format("README") == "all"
+
+
+def test_format_file_source_format(tmp_path):
+    f = tmp_path / "f.txt"
+    f.write_text("```python\nf(1,2,3)\n```\n\n.. code-block:: python\n\n    f(1,2,3)\n")
+
+    result = blacken_docs.format_file(
+        str(f), BLACK_MODE, False, False, False, source_format="rst"
+    )
+
+    assert result == 1
+    assert f.read_text() == (
+        "```python\nf(1,2,3)\n```\n\n.. code-block:: python\n\n    f(1, 2, 3)\n"
+    )
+
+
+def test_iter_code_blocks():
+    src = dedent(
+        """\
+        ```py3
+        f(1,2,3)
+        ```
+
+        .. code-block:: bash
+
+            echo hi
+
+          .. code-block:: pycon
+
+              >>> f(1,2,3)
+
+        Literal::
+
+            f(1,2,3)
+        """
+    )
+    blocks = list(blacken_docs.iter_code_blocks(src, rst_literal_blocks=True))
+    assert [(b.kind, b.language, b.indent) for b in blocks] == [
+        ("md", "py3", 0),
+        ("rst-pycon", "pycon", 2),
+        ("rst-literal", None, 0),
+    ]
+    assert blocks[0].start == 0
+    assert blocks[0].end == src.index("\n\n.. code-block:: bash")
+    assert blocks[0].text == "```py3\nf(1,2,3)\n```"
+    assert blocks[0].code == "f(1,2,3)\n"
+    assert blocks[1].code == "      >>> f(1,2,3)\n\n"
+    assert src[blocks[2].code_start : blocks[2].code_end] == "    f(1,2,3)\n"
+    assert not hasattr(blocks[0], "__dict__")
+
+
+def test_format_src_nested_in_skipped_block():
+    # Blocks inside a block that isn't formatted, such as a non-Python rST
+    # code block, are formatted.
+    before = ".. code-block:: markdown\n\n    ```python\n    f(1,2)\n    ```\n"
+    after, errors = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == before.replace("f(1,2)", "f(1, 2)")
+    assert errors == []
+
+
+@pytest.mark.parametrize(
+    ("before", "error_count"),
+    [
+        # Inside a docstring of a Python block.
+        (
+            '```python\ndef f():\n    """\n    .. code-block:: python\n\n'
+            '        f(1,2)\n    """\n```\n',
+            0,
+        ),
+        # Inside a Python block that fails to parse.
+        (".. code-block:: python\n\n    ```python\n    f(1,2)\n    ```\n", 1),
+    ],
+)
+def test_format_src_nested_in_python_block(before, error_count):
+    # Blocks inside a Python block are part of its code, so aren't formatted
+    # on their own.
+    after, errors = blacken_docs.format_str(before, BLACK_MODE)
+    assert after == before
+    assert len(errors) == error_count
+
+
+def test_iter_code_blocks_source_format():
+    src = "```python\nf(1,2,3)\n```\n\n.. code-block:: python\n\n    f()\n"
+    blocks = blacken_docs.iter_code_blocks(src, source_format="rst")
+    assert [block.kind for block in blocks] == ["rst"]
+
+
+def test_iter_code_blocks_errors():
+    src = "text\n```python\nf(1,2,3)\n"
+    errors: list[blacken_docs.CodeBlockError] = []
+    assert list(blacken_docs.iter_code_blocks(src, errors=errors)) == []
+    assert len(errors) == 1
+    assert errors[0].offset == 5
+    assert errors[0].lineno == 2
+
+
+def test_iter_code_blocks_errors_multiple():
+    src = "```python\nf()\n\\begin{minted}{python}\nf()\n"
+    errors: list[blacken_docs.CodeBlockError] = []
+    assert list(blacken_docs.iter_code_blocks(src, errors=errors)) == []
+    assert [error.lineno for error in errors] == [1, 3]
+    # Without a list, the errors are dropped.
+    assert list(blacken_docs.iter_code_blocks(src)) == []
+
+
+def test_iter_code_blocks_no_triggers():
+    assert list(blacken_docs.iter_code_blocks("f(1,2,3)\n")) == []
+
+
+def test_format_src_unterminated_untouched():
+    before = "```python\nf(1,2,3)\n"
+    after, errors = blacken_docs.format_str(before, BLACK_MODE, lines=[(5, 6)])
+    assert after == before
+    assert errors == []
+
+
+def test_format_src_format_markdown():
+    before = dedent(
+        """\
+        ```python
+        f(1,2,3)
+        ```
+
+        .. code-block:: python
+
+            f(1,2,3)
+        """
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE, source_format="markdown")
+    assert after == dedent(
+        """\
+        ```python
+        f(1, 2, 3)
+        ```
+
+        .. code-block:: python
+
+            f(1,2,3)
+        """
+    )
+
+
+def test_format_src_format_rst():
+    before = dedent(
+        """\
+        ```python
+        f(1,2,3)
+        ```
+
+        .. code-block:: python
+
+            f(1,2,3)
+        """
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE, source_format="rst")
+    assert after == dedent(
+        """\
+        ```python
+        f(1,2,3)
+        ```
+
+        .. code-block:: python
+
+            f(1, 2, 3)
+        """
+    )
+
+
+def test_format_src_format_latex():
+    before = dedent(
+        """\
+        \\begin{minted}{python}
+        f(1,2,3)
+        \\end{minted}
+
+        ```python
+        f(1,2,3)
+        ```
+        """
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE, source_format="latex")
+    assert after == dedent(
+        """\
+        \\begin{minted}{python}
+        f(1, 2, 3)
+        \\end{minted}
+
+        ```python
+        f(1,2,3)
+        ```
+        """
+    )
+
+
+def test_format_src_format_python():
+    before = dedent(
+        '''\
+        def f():
+            """Call f.
+
+            ```python
+            f(1,2,3)
+            ```
+
+            .. code-block:: python
+
+                f(1,2,3)
+            """
+            return """
+        ```python
+        f(1,2,3)
+        ```
+        """
+        '''
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE, source_format="python")
+    assert after == dedent(
+        '''\
+        def f():
+            """Call f.
+
+            ```python
+            f(1, 2, 3)
+            ```
+
+            .. code-block:: python
+
+                f(1, 2, 3)
+            """
+            return """
+        ```python
+        f(1,2,3)
+        ```
+        """
+        '''
+    )
+
+
+def test_format_src_format_python_attribute_docstring():
+    before = dedent(
+        '''\
+        class A:
+            x = 1
+            """The x.
+
+            .. code-block:: python
+
+                g(1,2)
+            """
+        '''
+    )
+    after, _ = blacken_docs.format_str(before, BLACK_MODE, source_format="python")
+    assert after == before.replace("g(1,2)", "g(1, 2)")
+
+
+def test_format_src_format_python_no_blocks(monkeypatch):
+    # Modules without code blocks aren't tokenized.
+    from blacken_docs import _python
+
+    def fail(src):  # pragma: no cover
+        raise AssertionError("docstrings should not be searched for")
+
+    monkeypatch.setattr(_python, "docstring_spans", fail)
+    before = 'x = ".. note::"\n'
+    after, errors = blacken_docs.format_str(before, BLACK_MODE, source_format="python")
+    assert after == before
+    assert errors == []
+
+
+def test_format_src_format_python_tokenize_error():
+    # Modules that can't be tokenized are searched whole.
+    before = 'def f(:\n    """\n```python\nf(1,2,3)\n```\n'
+    after, errors = blacken_docs.format_str(before, BLACK_MODE, source_format="python")
+    assert after == 'def f(:\n    """\n```python\nf(1, 2, 3)\n```\n'
+    assert errors == []
+
+
+def test_format_src_format_python_unterminated():
+    before = 'def f():\n    """\n    ```python\n    f(1,2,3)\n    """\n'
+    after, errors = blacken_docs.format_str(before, BLACK_MODE, source_format="python")
+    assert after == before
+    assert [(error.lineno, str(error.exc)) for error in errors] == [
+        (3, "unterminated code block")
+    ]
+
+
+def test_iter_code_blocks_python():
+    src = (
+        'x = 1\n\n\ndef f():\n    """\n    ```python\n    f(1,2,3)\n    ```\n    """\n'
+    )
+    (block,) = blacken_docs.iter_code_blocks(src, source_format="python")
+    assert block.kind == "md"
+    assert block.start == src.index("    ```")
+    assert block.code == "    f(1,2,3)\n"
+
+
+def test_format_src_no_triggers():
+    before = "# Title\n\nSome text.\n"
+    after, errors = blacken_docs.format_str(before, BLACK_MODE)
+    assert after is before
+    assert errors == []
+
+
+def test_format_src_error_position():
+    before = "Text\n\n  ```python\n  f(\n  ```\n\n```python\nf(\n```\n"
+    _, errors = blacken_docs.format_str(before, BLACK_MODE)
+    assert [(e.offset, e.lineno, e.col_offset) for e in errors] == [
+        (6, 3, 0),
+        (30, 7, 0),
+    ]
+
+
+def test_code_block_error_without_position():
+    exc = ValueError("bad")
+    error = blacken_docs.CodeBlockError(6, exc)
+    assert (error.offset, error.exc, error.lineno, error.col_offset) == (
+        6,
+        exc,
+        None,
+        None,
+    )
+
+
+def test_line_index():
+    index = blacken_docs._LineIndex("ab\n\ncd\n")
+    assert index.position(0) == (1, 0)
+    assert index.position(1) == (1, 1)
+    assert index.position(2) == (1, 2)
+    assert index.position(3) == (2, 0)
+    assert index.position(5) == (3, 1)
+    assert index.position(7) == (4, 0)
+
+
+def test_integration_ok(tmp_path, capsys):
+    f = tmp_path / "f.md"
+    f.write_text(
+        "```python\nf(1, 2, 3)\n```\n",
+    )
+
+    result = blacken_docs.main((str(f),))
+
+    assert result == 0
+    assert not capsys.readouterr()[1]
+    assert f.read_text() == ("```python\nf(1, 2, 3)\n```\n")
+
+
+def test_integration_modifies(tmp_path, capsys):
+    f = tmp_path / "f.md"
+    f.write_text(
+        "```python\nf(1,2,3)\n```\n",
+    )
+
+    result = blacken_docs.main((str(f),))
+
+    assert result == 1
+    out, _ = capsys.readouterr()
+    assert out == f"{f}: Rewriting...\n"
+    assert f.read_text() == ("```python\nf(1, 2, 3)\n```\n")
+
+
+def test_integration_line_length(tmp_path):
+    f = tmp_path / "f.md"
+    f.write_text(
+        "```python\n"
+        "foo(very_very_very_very_very_very_very, long_long_long_long_long)\n"
+        "```\n",
+    )
+
+    result = blacken_docs.main((str(f), "--line-length=80"))
+    assert result == 0
+
+    result2 = blacken_docs.main((str(f), "--line-length=50"))
+    assert result2 == 1
+    assert f.read_text() == (
+        "```python\n"
+        "foo(\n"
+        "    very_very_very_very_very_very_very,\n"
+        "    long_long_long_long_long,\n"
+        ")\n"
+        "```\n"
+    )
+
+
+def test_integration_check(tmp_path):
+    f = tmp_path / "f.md"
+    text = dedent(
+        """\
+        ```python
+        x = 'a' 'b'
+        ```
+        """
+    )
+    f.write_text(text)
+
+    result = blacken_docs.main((str(f), "--check"))
+
+    assert result == 1
+    assert f.read_text() == text
+
+
+def test_integration_preview(tmp_path):
+    f = tmp_path / "f.md"
+    f.write_text(
+        dedent(
+            """\
+            ```python
+            x = 'a' 'b'
+            ```
+            """
+        )
+    )
+
+    result = blacken_docs.main((str(f), "--preview"))
+
+    assert result == 1
+    assert f.read_text() == dedent(
+        """\
+        ```python
+        x = "a" "b"
+        ```
+        """
+    )
+
+
+def test_integration_pyi(tmp_path):
+    f = tmp_path / "f.md"
+    f.write_text(
+        dedent(
+            """\
+            ```python
+            class Foo: ...
+
+
+            class Bar: ...
+            ```
+            """
+        )
+    )
+
+    result = blacken_docs.main((str(f), "--pyi"))
+
+    assert result == 1
+    assert f.read_text() == dedent(
+        """\
+        ```python
+        class Foo: ...
+        class Bar: ...
+        ```
+        """
+    )
+
+
+def test_integration_py36(tmp_path):
+    f = tmp_path / "f.md"
+    f.write_text(
+        "```python\n"
+        "def very_very_long_function_name(\n"
+        "    very_very_very_very_very_very,\n"
+        "    very_very_very_very_very_very,\n"
+        "    *long_long_long_long_long_long\n"
+        "):\n"
+        "    pass\n"
+        "```\n",
+    )
+
+    result = blacken_docs.main((str(f),))
+    assert result == 0
+
+    result2 = blacken_docs.main((str(f), "--target-version=py36"))
+
+    assert result2 == 1
+    assert f.read_text() == (
+        "```python\n"
+        "def very_very_long_function_name(\n"
+        "    very_very_very_very_very_very,\n"
+        "    very_very_very_very_very_very,\n"
+        "    *long_long_long_long_long_long,\n"
+        "):\n"
+        "    pass\n"
+        "```\n"
+    )
+
+
+def test_integration_filename_last(tmp_path):
+    f = tmp_path / "f.md"
+    f.write_text(
+        "```python\n"
+        "def very_very_long_function_name(\n"
+        "    very_very_very_very_very_very,\n"
+        "    very_very_very_very_very_very,\n"
+        "    *long_long_long_long_long_long\n"
+        "):\n"
+        "    pass\n"
+        "```\n",
+    )
+
+    result = blacken_docs.main((str(f),))
+    assert result == 0
+
+    result2 = blacken_docs.main(("--target-version", "py36", str(f)))
+
+    assert result2 == 1
+    assert f.read_text() == (
+        "```python\n"
+        "def very_very_long_function_name(\n"
+        "    very_very_very_very_very_very,\n"
+        "    very_very_very_very_very_very,\n"
+        "    *long_long_long_long_long_long,\n"
+        "):\n"
+        "    pass\n"
+        "```\n"
+    )
+
+
+def test_integration_multiple_target_version(tmp_path):
+    f = tmp_path / "f.md"
+    f.write_text(
+        "```python\n"
+        "def very_very_long_function_name(\n"
+        "    very_very_very_very_very_very,\n"
+        "    very_very_very_very_very_very,\n"
+        "    *long_long_long_long_long_long\n"
+        "):\n"
+        "    pass\n"
+        "```\n",
+    )
+
+    result = blacken_docs.main((str(f),))
+    assert result == 0
+
+    result2 = blacken_docs.main(
+        ("--target-version", "py35", "--target-version", "py36", str(f)),
+    )
+    assert result2 == 0
+
+
+def test_integration_skip_string_normalization(tmp_path):
+    f = tmp_path / "f.md"
+    f.write_text(
+        "```python\nf('hi')\n```\n",
+    )
+
+    result = blacken_docs.main((str(f), "--skip-string-normalization"))
+
+    assert result == 0
+    assert f.read_text() == ("```python\nf('hi')\n```\n")
+
+
+def test_integration_syntax_error(tmp_path, capsys):
+    f = tmp_path / "f.md"
+    f.write_text(
+        "```python\nf(\n```\n",
+    )
+
+    result = blacken_docs.main((str(f),))
+
+    assert result == 2
+    out, _ = capsys.readouterr()
+    assert out.startswith(f"{f}:1: code block parse error")
+    assert f.read_text() == ("```python\nf(\n```\n")
+
+
+def test_integration_syntax_error_after_edit(tmp_path, capsys):
+    f = tmp_path / "f.rst"
+    f.write_text(
+        ".. code-block:: python\n\n    x = [1,\n        2]\n\n"
+        ".. code-block:: python\n\n    f(\n"
+    )
+
+    result = blacken_docs.main((str(f),))
+
+    assert result == 2
+    out, _ = capsys.readouterr()
+    assert out.startswith(f"{f}:6: code block parse error")
+
+
+def test_integration_unterminated(tmp_path, capsys):
+    f = tmp_path / "f.md"
+    f.write_text("text\n\n```python\nf(1,2,3)\n")
+
+    result = blacken_docs.main((str(f),))
+
+    assert result == 2
+    out, _ = capsys.readouterr()
+    assert out == f"{f}:3: code block parse error unterminated code block\n"
+    assert f.read_text() == "text\n\n```python\nf(1,2,3)\n"
+
+
+@pytest.mark.skipif(not hasattr(signal, "setitimer"), reason="Requires SIGALRM.")
+def test_integration_block_timeout(tmp_path, capsys, slow_black):
+    f = tmp_path / "f.md"
+    f.write_text("```python\nslow(1,2,3)\n```\n")
+
+    result = blacken_docs.main((str(f), "--block-timeout", "0.1"))
+
+    assert result == 2
+    out, _ = capsys.readouterr()
+    assert out == (
+        f"{f}:1: code block timeout formatting took longer than 0.1 seconds\n"
+    )
+    assert f.read_text() == "```python\nslow(1,2,3)\n```\n"
+
+
+def test_integration_block_timeout_invalid(capsys):
+    with pytest.raises(SystemExit) as excinfo:
+        blacken_docs.main(("--block-timeout", "0"))
+
+    assert excinfo.value.code == 2
+    _, err = capsys.readouterr()
+    assert "argument --block-timeout: must be positive" in err
+
+
+def test_integration_ignored_syntax_error(tmp_path, capsys):
+    f = tmp_path / "f.md"
+    f.write_text(
+        "```python\nf( )\n```\n\n```python\nf(\n```\n",
+    )
+
+    result = blacken_docs.main((str(f), "--skip-errors"))
+
+    assert result == 1
+    out, _ = capsys.readouterr()
+    assert f.read_text() == ("```python\nf()\n```\n\n```python\nf(\n```\n")
+
+
+def test_integration_detect_format(tmp_path):
+    f = tmp_path / "f.md"
+    text = ".. code-block:: python\n\n    f(1,2,3)\n"
+    f.write_text(text)
+
+    result = blacken_docs.main((str(f),))
+
+    assert result == 0
+    assert f.read_text() == text
+
+
+def test_integration_format(tmp_path):
+    f = tmp_path / "f.txt"
+    f.write_text(".. code-block:: python\n\n    f(1,2,3)\n\n```python\nf(1,2,3)\n```\n")
+
+    result = blacken_docs.main((str(f), "--format", "rst"))
+
+    assert result == 1
+    assert f.read_text() == (
+        ".. code-block:: python\n\n    f(1, 2, 3)\n\n```python\nf(1,2,3)\n```\n"
+    )
+
+
+def test_integration_workers(tmp_path, capsys):
+    f1 = tmp_path / "f1.md"
+    f1.write_text("```python\nf(1,2,3)\n```\n")
+    f2 = tmp_path / "f2.md"
+    f2.write_text("```python\nf(1, 2, 3)\n```\n")
+    f3 = tmp_path / "f3.md"
+    f3.write_text("```python\nf(\n```\n")
+
+    result = blacken_docs.main(("-j", "2", str(f1), str(f2), str(f3)))
+
+    assert result == 3
+    out, _ = capsys.readouterr()
+    assert out.splitlines()[0] == f"{f1}: Rewriting..."
+    assert out.splitlines()[1].startswith(f"{f3}:1: code block parse error")
+    assert f1.read_text() == "```python\nf(1, 2, 3)\n```\n"
+
+
+def test_format_file_capturing_output(tmp_path, monkeypatch):
+    # As run in worker processes, which coverage doesn't see.
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "f.md").write_text("```python\nf(1,2,3)\n```\n")
+
+    retv, output, stats = blacken_docs._format_file_capturing_output(
+        "f.md",
+        BLACK_MODE,
+        skip_errors=False,
+        rst_literal_blocks=False,
+        check_only=False,
+        source_format=None,
+        cache=None,
+        collect_stats=True,
+        cwd=str(tmp_path),
+        lines=None,
+        block_timeout=None,
+        max_file_size=None,
+        max_block_lines=None,
+    )
+
+    assert (retv, output) == (1, "f.md: Rewriting...\n")
+    assert stats is not None
+    assert stats.files == 1
+    assert (tmp_path / "f.md").read_text() == "```python\nf(1, 2, 3)\n```\n"
+
+
+@pytest.mark.parametrize(("platform", "workers"), [("linux", 100), ("win32", 60)])
+def test_make_executor_workers(monkeypatch, platform, workers):
+    import concurrent.futures
+
+    created = []
+
+    def process_pool_executor(max_workers):
+        created.append(max_workers)
+        return concurrent.futures.ThreadPoolExecutor(max_workers)
+
+    monkeypatch.setattr(sys, "platform", platform)
+    monkeypatch.setattr(
+        concurrent.futures, "ProcessPoolExecutor", process_pool_executor
+    )
+
+    executor = blacken_docs._make_executor(100)
+
+    assert executor is not None
+    executor.shutdown()
+    assert created == [workers]
+
+
+@pytest.mark.parametrize("exc", [ImportError, NotImplementedError, OSError])
+def test_make_executor_unsupported(monkeypatch, exc):
+    import concurrent.futures
+
+    def unsupported(max_workers):
+        raise exc
+
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", unsupported)
+
+    assert blacken_docs._make_executor(2) is None
+
+
+def test_integration_cache(tmp_path, cache_dir, monkeypatch):
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n")
+    assert blacken_docs.main((str(f),)) == 1
+    assert (cache_dir / "cache.sqlite3").exists()
+
+    def fail(*args, **kwargs):  # pragma: no cover
+        raise AssertionError("Black should not be called")
+
+    monkeypatch.setattr(black, "format_str", fail)
+    f.write_text("```python\nf(1,2,3)\n```\n")
+
+    assert blacken_docs.main((str(f),)) == 1
+    assert f.read_text() == "```python\nf(1, 2, 3)\n```\n"
+
+
+@pytest.mark.parametrize("corrupt", [False, True])
+def test_integration_cache_unusable(tmp_path, cache_dir, corrupt):
+    # An unusable cache doesn't stop formatting.
+    if corrupt:
+        cache_dir.mkdir()
+        (cache_dir / "cache.sqlite3").write_bytes(b"not a database" * 100)
+    else:
+        cache_dir.write_text("")
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n")
+
+    assert blacken_docs.main((str(f),)) == 1
+    assert f.read_text() == "```python\nf(1, 2, 3)\n```\n"
+    assert blacken_docs.main((str(f),)) == 0
+
+
+def test_integration_cache_clean_file(tmp_path, monkeypatch):
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n")
+    assert blacken_docs.main((str(f),)) == 1
+
+    def fail(*args, **kwargs):  # pragma: no cover
+        raise AssertionError("format_str() should not be called")
+
+    monkeypatch.setattr(blacken_docs, "format_str", fail)
+
+    assert blacken_docs.main((str(f), "--check")) == 0
+    assert blacken_docs.main((str(f),)) == 0
+
+
+def test_integration_cache_clean_file_options(tmp_path):
+    f = tmp_path / "f.rst"
+    f.write_text("hello::\n\n    f(1,2,3)\n")
+    assert blacken_docs.main((str(f),)) == 0
+
+    result = blacken_docs.main((str(f), "--rst-literal-blocks"))
+
+    assert result == 1
+    assert f.read_text() == "hello::\n\n    f(1, 2, 3)\n"
+
+
+def test_format_file_cache(tmp_path, monkeypatch):
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n")
+    cache = get_cache(str(tmp_path / "cache"))
+    try:
+        result = blacken_docs.format_file(
+            str(f), BLACK_MODE, False, False, False, cache=cache
+        )
+        assert result == 1
+
+        def fail(*args, **kwargs):  # pragma: no cover
+            raise AssertionError("format_str() should not be called")
+
+        monkeypatch.setattr(blacken_docs, "format_str", fail)
+
+        result = blacken_docs.format_file(
+            str(f), BLACK_MODE, False, False, False, cache=cache
+        )
+        assert result == 0
+    finally:
+        cache.close()
+    assert f.read_text() == "```python\nf(1, 2, 3)\n```\n"
+
+
+def test_integration_no_cache(tmp_path, cache_dir):
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n")
+
+    result = blacken_docs.main((str(f), "--no-cache"))
+
+    assert result == 1
+    assert not cache_dir.exists()
+
+
+def test_integration_daemon_windows(capsys, monkeypatch):
+    monkeypatch.setattr(sys, "platform", "win32")
+
+    with pytest.raises(SystemExit) as excinfo:
+        blacken_docs.main(("--daemon",))
+
+    assert excinfo.value.code == 2
+    _, err = capsys.readouterr()
+    assert "--daemon is not supported on Windows" in err
+
+
+def test_integration_workers_invalid(capsys):
+    with pytest.raises(SystemExit) as excinfo:
+        blacken_docs.main(("--workers", "0"))
+
+    assert excinfo.value.code == 2
+    _, err = capsys.readouterr()
+    assert "argument -j/--workers: must be at least 1" in err
+
+
+def test_integration_stats(tmp_path, capsys):
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n\n```pycon\n>>> f( )\n```\n")
+
+    result = blacken_docs.main((str(f), "--stats"))
+
+    assert result == 1
+    out, err = capsys.readouterr()
+    assert out == f"{f}: Rewriting...\n"
+    assert err.startswith("1 files in ")
+    assert "\n  md                   1 " in err
+    assert "\n  md-pycon             1 " in err
+    assert f"s {f}:1 (md)\n" in err
+    assert f"s {f}:5 (md-pycon)\n" in err
+
+
+def test_integration_stats_workers(tmp_path, capsys):
+    f1 = tmp_path / "f1.md"
+    f1.write_text("```python\nf(1,2,3)\n```\n")
+    f2 = tmp_path / "f2.rst"
+    f2.write_text(".. code-block:: python\n\n    f(1,2,3)\n")
+
+    result = blacken_docs.main((str(f1), str(f2), "--stats", "--workers", "2"))
+
+    assert result == 1
+    _, err = capsys.readouterr()
+    assert err.startswith("2 files in ")
+    assert "\n  md                   1 " in err
+    assert "\n  rst                  1 " in err
+
+
+@pytest.mark.parametrize("workers", ["1", "2"])
+def test_integration_max_file_size(tmp_path, capsys, workers):
+    small = tmp_path / "small.md"
+    small.write_text("```python\nf(1,2,3)\n```\n")
+    large = tmp_path / "large.md"
+    large.write_text("```python\nf(1,2,3)\n```\n" + "text\n" * 100)
+
+    result = blacken_docs.main(
+        (str(small), str(large), "--max-file-size", "100", "-j", workers, "--stats")
+    )
+
+    assert result == 1
+    out, err = capsys.readouterr()
+    assert out == f"{small}: Rewriting...\n"
+    assert "\n  files                1\n" in err
+    assert large.read_text().startswith("```python\nf(1,2,3)\n```\n")
+
+
+def test_integration_max_file_size_only_large_files(tmp_path, capsys):
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n" + "text\n" * 100)
+
+    result = blacken_docs.main((str(f), "--max-file-size", "100", "--stats"))
+
+    assert result == 0
+    _, err = capsys.readouterr()
+    assert "\n  files                1\n" in err
+    assert f.read_text().startswith("```python\nf(1,2,3)\n```\n")
+
+
+def test_integration_max_block_lines(tmp_path, capsys):
+    f = tmp_path / "f.md"
+    text = "```python\nf(1,2,3)\ng(1,2,3)\n```\n"
+    f.write_text(text)
+
+    result = blacken_docs.main((str(f), "--max-block-lines", "1", "--stats"))
+
+    assert result == 0
+    _, err = capsys.readouterr()
+    assert "\n  code blocks          1\n" in err
+    assert f.read_text() == text
+
+    # Files with skipped blocks aren't cached as formatted without the limit.
+    assert blacken_docs.main((str(f),)) == 1
+    assert f.read_text() == "```python\nf(1, 2, 3)\ng(1, 2, 3)\n```\n"
+
+
+def test_format_file_max_file_size(tmp_path):
+    f = tmp_path / "f.md"
+    text = "```python\nf(1,2,3)\n```\n"
+    f.write_text(text)
+
+    result = blacken_docs.format_file(
+        str(f), BLACK_MODE, False, False, False, max_file_size=10
+    )
+
+    assert result == 0
+    assert f.read_text() == text
+
+
+@pytest.mark.parametrize("workers", ["1", "2"])
+def test_integration_size_limits_summary(tmp_path, capsys, workers):
+    large = tmp_path / "large.md"
+    large.write_text("```python\nf(1,2,3)\n```\n" + "text\n" * 100)
+    f = tmp_path / "f.md"
+    text = "```python\nf(1,2,3)\ng(1,2,3)\n```\n"
+    f.write_text(text)
+
+    result = blacken_docs.main(
+        (
+            str(large),
+            str(f),
+            "--check",
+            "--max-file-size",
+            "100",
+            "--max-block-lines",
+            "1",
+            "-j",
+            workers,
+        )
+    )
+
+    assert result == 0
+    out, err = capsys.readouterr()
+    assert out == ""
+    assert err == "Skipped 1 files and 1 code blocks for size\n"
+
+
+def test_integration_size_limits_nothing_skipped(tmp_path, capsys):
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1, 2, 3)\n```\n")
+
+    result = blacken_docs.main((str(f), "--max-file-size", "100"))
+
+    assert result == 0
+    assert capsys.readouterr() == ("", "")
+
+
+def test_integration_max_file_size_missing_file(tmp_path):
+    # The error is left to reading the file.
+    f = tmp_path / "missing.md"
+
+    with pytest.raises(FileNotFoundError) as excinfo:
+        blacken_docs.main((str(f), "--max-file-size", "100"))
+
+    assert excinfo.value.filename == str(f)
+
+
+@pytest.mark.parametrize("option", ["--max-file-size", "--max-block-lines"])
+def test_integration_size_limit_invalid(capsys, option):
+    with pytest.raises(SystemExit) as excinfo:
+        blacken_docs.main((option, "0"))
+
+    assert excinfo.value.code == 2
+    _, err = capsys.readouterr()
+    assert f"argument {option}: must be at least 1" in err
+
+
+MONOREPO_TEXT = "```python\nf(aaaaaaaaaa, bbbbbbbbbb, cccccccccc, dddddddddd)\n```\n"
+
+
+def _make_monorepo(tmp_path: Path) -> tuple[Path, Path]:
+    (tmp_path / ".git").mkdir()
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "pyproject.toml").write_text(
+        "[tool.blacken-docs]\nline-length = 40\n"
+    )
+    (tmp_path / "b").mkdir()
+    (tmp_path / "b" / "pyproject.toml").write_text("[tool.black]\nline-length = 40\n")
+    a = tmp_path / "a" / "index.md"
+    a.write_text(MONOREPO_TEXT)
+    b = tmp_path / "b" / "index.md"
+    b.write_text(MONOREPO_TEXT)
+    return a, b
+
+
+@pytest.mark.parametrize("workers", ["1", "2"])
+def test_integration_config(tmp_path, workers):
+    a, b = _make_monorepo(tmp_path)
+
+    result = blacken_docs.main((str(tmp_path), "-j", workers))
+
+    assert result == 1
+    assert a.read_text() == (
+        "```python\n"
+        "f(\n"
+        "    aaaaaaaaaa,\n"
+        "    bbbbbbbbbb,\n"
+        "    cccccccccc,\n"
+        "    dddddddddd,\n"
+        ")\n"
+        "```\n"
+    )
+    # [tool.black] is only read with use-black-config.
+    assert b.read_text() == MONOREPO_TEXT
+
+
+def test_integration_config_use_black_config(tmp_path):
+    _, b = _make_monorepo(tmp_path)
+    (tmp_path / "b" / "pyproject.toml").write_text(
+        "[tool.blacken-docs]\nuse-black-config = true\n[tool.black]\nline-length = 40\n"
+    )
+
+    result = blacken_docs.main((str(b),))
+
+    assert result == 1
+    assert b.read_text().startswith("```python\nf(\n    aaaaaaaaaa,\n")
+
+
+def test_integration_config_command_line_overrides(tmp_path):
+    a, _ = _make_monorepo(tmp_path)
+
+    result = blacken_docs.main((str(a), "--line-length", "88"))
+
+    assert result == 0
+    assert a.read_text() == MONOREPO_TEXT
+
+
+def test_integration_config_invalid(tmp_path, capsys):
+    a, _ = _make_monorepo(tmp_path)
+    (tmp_path / "a" / "pyproject.toml").write_text(
+        "[tool.blacken-docs]\ntarget-version = ['py2']\n"
+    )
+
+    with pytest.raises(SystemExit) as excinfo:
+        blacken_docs.main((str(a),))
+
+    assert excinfo.value.code == 2
+    _, err = capsys.readouterr()
+    assert "pyproject.toml: target-version: invalid value: 'py2'" in err
+    assert a.read_text() == MONOREPO_TEXT
+
+
+def test_integration_config_unknown_setting(tmp_path, capsys):
+    a, _ = _make_monorepo(tmp_path)
+    (tmp_path / "a" / "pyproject.toml").write_text("[tool.blacken-docs]\nfoo = 1\n")
+
+    with pytest.raises(SystemExit) as excinfo:
+        blacken_docs.main((str(a),))
+
+    assert excinfo.value.code == 2
+    _, err = capsys.readouterr()
+    assert "invalid configuration: " in err
+    assert "pyproject.toml: unknown setting 'foo' in [tool.blacken-docs]" in err
+    assert a.read_text() == MONOREPO_TEXT
+
+
+def test_integration_pipelined(tmp_path, capsys, monkeypatch):
+    monkeypatch.setattr(blacken_docs, "PIPELINE_DEPTH", 1)
+    paths = []
+    for i in range(5):
+        path = tmp_path / f"f{i}.md"
+        path.write_text("```python\nf(1,2,3)\n```\n" if i % 2 else "text\n")
+        paths.append(path)
+
+    result = blacken_docs.main((*map(str, paths), "--workers", "1", "--stats"))
+
+    assert result == 1
+    out, err = capsys.readouterr()
+    assert out == f"{paths[1]}: Rewriting...\n{paths[3]}: Rewriting...\n"
+    assert "\n  read " in err
+    assert "\n  write " in err
+    for i, path in enumerate(paths):
+        assert path.read_text() == (
+            "```python\nf(1, 2, 3)\n```\n" if i % 2 else "text\n"
+        )
+
+
+def test_integration_pipelined_cache(tmp_path, capsys):
+    f1 = tmp_path / "f1.md"
+    f1.write_text("```python\nf(1,2,3)\n```\n")
+    f2 = tmp_path / "f2.md"
+    f2.write_text("```python\nf(1, 2, 3)\n```\n")
+
+    blacken_docs.main((str(f1), str(f2), "--workers", "1"))
+    capsys.readouterr()
+    result = blacken_docs.main((str(f1), str(f2), "--workers", "1", "--stats"))
+
+    assert result == 0
+    out, err = capsys.readouterr()
+    assert out == ""
+    assert "\n  cache " in err
+    assert "\n  write " not in err
+
+
+def test_integration_pipelined_read_error(tmp_path, capsys):
+    f1 = tmp_path / "f1.md"
+    f1.write_text("```python\nf(1,2,3)\n```\n")
+    f2 = tmp_path / "f2.md"
+    f2.write_bytes(b"```python\n\xff\n```\n")
+
+    with pytest.raises(UnicodeDecodeError):
+        blacken_docs.main((str(f1), str(f2), "--workers", "1"))
+
+    out, _ = capsys.readouterr()
+    assert out == f"{f1}: Rewriting...\n"
+    assert f1.read_text() == "```python\nf(1, 2, 3)\n```\n"
+
+
+def test_integration_pipelined_format_error_stops_reader(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(blacken_docs, "PIPELINE_DEPTH", 1)
+    paths = []
+    for i in range(5):
+        path = tmp_path / f"f{i}.md"
+        path.write_text("```python\nf(1,2,3)\n```\n")
+        paths.append(path)
+
+    def format_str(*args, **kwargs):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(blacken_docs, "format_str", format_str)
+    threads = threading.active_count()
+
+    with pytest.raises(RuntimeError, match="boom"):
+        blacken_docs.main((*map(str, paths), "--workers", "1"))
+
+    assert threading.active_count() == threads
+
+
+def test_integration_no_candidates_not_decoded(tmp_path, monkeypatch):
+    f1 = tmp_path / "f1.md"
+    f1.write_bytes(b"\xff no code blocks\n")
+    f2 = tmp_path / "f2.md"
+    f2.write_text("```python\nf(1,2,3)\n```\n")
+    formatted = []
+    format_str = blacken_docs.format_str
+
+    def spy(src, *args, **kwargs):
+        formatted.append(src)
+        return format_str(src, *args, **kwargs)
+
+    monkeypatch.setattr(blacken_docs, "format_str", spy)
+
+    result = blacken_docs.main((str(f1), str(f2), str(f1), "--workers", "1"))
+
+    assert result == 1
+    assert formatted == ["```python\nf(1,2,3)\n```\n"]
+
+
+def test_integration_format_file_no_candidates(tmp_path):
+    f = tmp_path / "f.md"
+    f.write_bytes(b"\xff no code blocks\n")
+
+    result = blacken_docs.format_file(str(f), BLACK_MODE, False, False, False)
+
+    assert result == 0
+
+
+def test_integration_carriage_returns(tmp_path):
+    f = tmp_path / "f.md"
+    f.write_bytes(b"```python\r\nf( 1 )\r```\r\n")
+
+    result = blacken_docs.main((str(f),))
+
+    assert result == 1
+    assert f.read_bytes() == b"```python\nf(1)\n```\n"
+
+
+def test_integration_no_candidates_skips_black(tmp_path):
+    f = tmp_path / "f.md"
+    f.write_text("hello\n")
+
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, blacken_docs\n"
+            "assert blacken_docs.main(sys.argv[1:]) == 0\n"
+            "assert 'black' not in sys.modules\n",
+            str(f),
+        ],
+        check=False,
+        capture_output=True,
+        text=True,
+    )
+
+    assert result.returncode == 0, result.stderr
+    assert result.stdout == ""
+
+
+@pytest.mark.parametrize("name", ["py99", "py399"])
+def test_integration_target_version_invalid(tmp_path, capsys, name):
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n")
+
+    with pytest.raises(SystemExit) as excinfo:
+        blacken_docs.main((str(f), "-t", name))
+
+    assert excinfo.value.code == 2
+    _, err = capsys.readouterr()
+    assert f"argument -t/--target-version: invalid value: '{name}'" in err
+
+
+def test_integration_target_version_invalid_no_code_blocks(tmp_path, capsys):
+    f = tmp_path / "plain.md"
+    f.write_text("No code here.\n")
+
+    with pytest.raises(SystemExit) as excinfo:
+        blacken_docs.main((str(f), "-t", "bogus"))
+
+    assert excinfo.value.code == 2
+    _, err = capsys.readouterr()
+    assert "argument -t/--target-version: invalid value: 'bogus'" in err
+
+
+def test_integration_help_target_versions(capsys):
+    with pytest.raises(SystemExit):
+        blacken_docs.main(("--help",))
+
+    out, _ = capsys.readouterr()
+    assert "choices: ['py33'," in out
+
+
+def test_integration_directory(tmp_path, capsys):
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "a.md").write_text("```python\nf(1,2,3)\n```\n")
+    (tmp_path / "docs" / "b.txt").write_text("```python\nf(1,2,3)\n```\n")
+    (tmp_path / "docs" / "_build").mkdir()
+    (tmp_path / "docs" / "_build" / "c.md").write_text("```python\nf(1,2,3)\n```\n")
+
+    result = blacken_docs.main((str(tmp_path / "docs"), "--workers", "2"))
+
+    assert result == 1
+    out, _ = capsys.readouterr()
+    assert out == f"{tmp_path / 'docs' / 'a.md'}: Rewriting...\n"
+    assert (tmp_path / "docs" / "b.txt").read_text() == "```python\nf(1,2,3)\n```\n"
 
-        .. blacken-docs:on
-        """
+
+def test_integration_directory_include_exclude(tmp_path, capsys):
+    (tmp_path / "a.md").write_text("```python\nf(1,2,3)\n```\n")
+    (tmp_path / "b.txt").write_text("```python\nf(1,2,3)\n```\n")
+    (tmp_path / "c.txt").write_text("```python\nf(1,2,3)\n```\n")
+
+    result = blacken_docs.main(
+        (str(tmp_path), "--include", r"\.txt$", "--exclude", "^/c")
     )
-    after, _ = blacken_docs.format_str(before, BLACK_MODE)
-    assert after == before
 
+    assert result == 1
+    out, _ = capsys.readouterr()
+    assert out == f"{tmp_path / 'b.txt'}: Rewriting...\n"
 
-def test_integration_ok(tmp_path, capsys):
-    f = tmp_path / "f.md"
-    f.write_text(
-        "```python\nf(1, 2, 3)\n```\n",
+
+def test_integration_include_invalid(capsys):
+    with pytest.raises(SystemExit) as excinfo:
+        blacken_docs.main((".", "--include", "("))
+
+    assert excinfo.value.code == 2
+    _, err = capsys.readouterr()
+    assert "argument --include: invalid regular expression '('" in err
+
+
+def _git(cwd: Path, *args: str) -> None:
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
     )
 
-    result = blacken_docs.main((str(f),))
+
+@pytest.fixture
+def git_repo(tmp_path, monkeypatch):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    monkeypatch.chdir(repo)
+    _git(repo, "init", "-q")
+    (repo / "f.md").write_text("```python\nf(1,2)\n```\n\n```python\ng(1,2)\n```\n")
+    (repo / "g.md").write_text("```python\nh(1,2)\n```\n")
+    _git(repo, "add", ".")
+    _git(repo, "commit", "-q", "-m", "Initial")
+    return repo
+
+
+def test_integration_diff_base(git_repo, capsys):
+    f = git_repo / "f.md"
+    f.write_text("```python\nf(1,2)\n```\n\n```python\ng(1,2,3)\n```\n")
+
+    result = blacken_docs.main(("f.md", "g.md", "--diff-base", "HEAD"))
+
+    assert result == 1
+    out, _ = capsys.readouterr()
+    assert out == "f.md: Rewriting...\n"
+    assert f.read_text() == "```python\nf(1,2)\n```\n\n```python\ng(1, 2, 3)\n```\n"
+    assert (git_repo / "g.md").read_text() == "```python\nh(1,2)\n```\n"
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        "my doc.md",
+        pytest.param(
+            'tab\tand "quote".md',
+            marks=pytest.mark.skipif(
+                sys.platform == "win32", reason="Invalid filename on Windows."
+            ),
+        ),
+        "é.md",
+        pytest.param(
+            "control\x01.md",
+            marks=pytest.mark.skipif(
+                sys.platform == "win32", reason="Invalid filename on Windows."
+            ),
+        ),
+    ],
+)
+def test_integration_diff_base_quoted_path(git_repo, name):
+    # git adds a tab after paths with spaces, and quotes special characters.
+    f = git_repo / name
+    f.write_text("```python\nf(1,2)\n```\n")
+    _git(git_repo, "add", name)
+    _git(git_repo, "commit", "-q", "-m", "Add")
+    f.write_text("```python\nf(1,2,3)\n```\n")
+
+    result = blacken_docs.main((name, "--diff-base", "HEAD"))
+
+    assert result == 1
+    assert f.read_text() == "```python\nf(1, 2, 3)\n```\n"
+
+
+def test_integration_diff_base_untracked(git_repo, capsys):
+    (git_repo / ".gitignore").write_text("ignored.md\n")
+    new = git_repo / "new.md"
+    new.write_text("```python\nf(1,2)\n```\n")
+    ignored = git_repo / "ignored.md"
+    ignored.write_text("```python\nf(1,2)\n```\n")
+
+    result = blacken_docs.main(("new.md", "ignored.md", "g.md", "--diff-base", "HEAD"))
+
+    assert result == 1
+    out, _ = capsys.readouterr()
+    assert out == "new.md: Rewriting...\n"
+    assert new.read_text() == "```python\nf(1, 2)\n```\n"
+    assert ignored.read_text() == "```python\nf(1,2)\n```\n"
+
+
+def test_integration_staged_untracked(git_repo):
+    new = git_repo / "new.md"
+    new.write_text("```python\nf(1,2)\n```\n")
+
+    result = blacken_docs.main(("new.md", "--staged"))
 
     assert result == 0
-    assert not capsys.readouterr()[1]
-    assert f.read_text() == ("```python\nf(1, 2, 3)\n```\n")
+    assert new.read_text() == "```python\nf(1,2)\n```\n"
 
 
-def test_integration_modifies(tmp_path, capsys):
-    f = tmp_path / "f.md"
-    f.write_text(
-        "```python\nf(1,2,3)\n```\n",
-    )
+def test_integration_diff_base_removed_lines(git_repo):
+    f = git_repo / "f.md"
+    f.write_text("```python\nf(1,2)\n```\n\n```python\n```\n")
 
-    result = blacken_docs.main((str(f),))
+    result = blacken_docs.main(("f.md", "--diff-base", "HEAD"))
+
+    assert result == 0
+    assert f.read_text() == "```python\nf(1,2)\n```\n\n```python\n```\n"
+
+
+def test_integration_diff_base_subdirectory(git_repo, monkeypatch):
+    (git_repo / "docs").mkdir()
+    f = git_repo / "docs" / "f.md"
+    f.write_text("```python\nf(1,2)\n```\n")
+    _git(git_repo, "add", ".")
+    monkeypatch.chdir(git_repo / "docs")
+
+    result = blacken_docs.main(("f.md", "../g.md", "--staged", "--workers", "2"))
+
+    assert result == 1
+    assert f.read_text() == "```python\nf(1, 2)\n```\n"
+    assert (git_repo / "g.md").read_text() == "```python\nh(1,2)\n```\n"
+
+
+def test_integration_staged(git_repo, capsys):
+    f = git_repo / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n\n```python\ng(1,2)\n```\n")
+    _git(git_repo, "add", "f.md")
+    (git_repo / "g.md").write_text("```python\nh(1,2,3)\n```\n")
+
+    result = blacken_docs.main(("f.md", "g.md", "--staged"))
 
     assert result == 1
     out, _ = capsys.readouterr()
-    assert out == f"{f}: Rewriting...\n"
-    assert f.read_text() == ("```python\nf(1, 2, 3)\n```\n")
+    assert out == "f.md: Rewriting...\n"
+    assert f.read_text() == "```python\nf(1, 2, 3)\n```\n\n```python\ng(1,2)\n```\n"
+    assert (git_repo / "g.md").read_text() == "```python\nh(1,2,3)\n```\n"
 
 
-def test_integration_line_length(tmp_path):
-    f = tmp_path / "f.md"
-    f.write_text(
-        "```python\n"
-        "foo(very_very_very_very_very_very_very, long_long_long_long_long)\n"
-        "```\n",
-    )
+def test_integration_diff_base_not_cached_clean(git_repo, cache_dir):
+    f = git_repo / "f.md"
+    f.write_text("```python\nf(1,2)\n```\n\n```python\ng(1, 2, 3)\n```\n")
 
-    result = blacken_docs.main((str(f), "--line-length=80"))
+    result = blacken_docs.main(("f.md", "--diff-base", "HEAD"))
     assert result == 0
 
-    result2 = blacken_docs.main((str(f), "--line-length=50"))
-    assert result2 == 1
-    assert f.read_text() == (
-        "```python\n"
-        "foo(\n"
-        "    very_very_very_very_very_very_very,\n"
-        "    long_long_long_long_long,\n"
-        ")\n"
-        "```\n"
-    )
+    result = blacken_docs.main(("f.md",))
+    assert result == 1
+    assert f.read_text() == "```python\nf(1, 2)\n```\n\n```python\ng(1, 2, 3)\n```\n"
 
 
-def test_integration_check(tmp_path):
-    f = tmp_path / "f.md"
-    text = dedent(
-        """\
-        ```python
-        x = 'a' 'b'
-        ```
-        """
-    )
-    f.write_text(text)
+def test_integration_diff_base_mmap_not_cached_clean(git_repo, cache_dir, mmap_all):
+    f = git_repo / "f.md"
+    f.write_text("```python\nf(1,2)\n```\n\n```python\ng(1,2,3)\n```\n")
 
-    result = blacken_docs.main((str(f), "--check"))
+    result = blacken_docs.main(("f.md", "--diff-base", "HEAD"))
+    assert result == 1
+    assert f.read_text() == "```python\nf(1,2)\n```\n\n```python\ng(1, 2, 3)\n```\n"
 
+    result = blacken_docs.main(("f.md",))
     assert result == 1
-    assert f.read_text() == text
+    assert f.read_text() == "```python\nf(1, 2)\n```\n\n```python\ng(1, 2, 3)\n```\n"
 
 
-def test_integration_preview(tmp_path):
+def test_integration_diff_base_invalid(git_repo, capsys):
+    with pytest.raises(SystemExit) as excinfo:
+        blacken_docs.main(("f.md", "--diff-base", "nonexistent"))
+
+    assert excinfo.value.code == 2
+    _, err = capsys.readouterr()
+    assert "error: git diff failed: " in err
+
+
+@pytest.mark.parametrize(
+    ("exc", "message"),
+    [
+        (FileNotFoundError(2, "No such file"), "git is not installed"),
+        (OSError(7, "Argument list too long"), "[Errno 7] Argument list too long"),
+    ],
+)
+def test_integration_diff_base_git_os_error(
+    git_repo, capsys, monkeypatch, exc, message
+):
+    def run(*args, **kwargs):
+        raise exc
+
+    monkeypatch.setattr(subprocess, "run", run)
+
+    with pytest.raises(SystemExit) as excinfo:
+        blacken_docs.main(("f.md", "--diff-base", "HEAD"))
+
+    assert excinfo.value.code == 2
+    _, err = capsys.readouterr()
+    assert f"error: git diff failed: {message}" in err
+
+
+@pytest.fixture
+def mmap_all(monkeypatch):
+    monkeypatch.setattr(blacken_docs, "MMAP_MIN_SIZE", 1)
+
+
+def test_integration_mmap(tmp_path, capsys, mmap_all):
     f = tmp_path / "f.md"
-    f.write_text(
-        dedent(
-            """\
-            ```python
-            x = 'a' 'b'
-            ```
-            """
-        )
+    f.write_bytes(
+        "Café\n\n```python\nf( 'é' )\n```\n\n"
+        "```python\nx = [\n    1,\n    2,\n]\n```\n\n"
+        "```python\ng(  )\n```\n".encode()
     )
 
-    result = blacken_docs.main((str(f), "--preview"))
+    result = blacken_docs.main((str(f),))
 
     assert result == 1
-    assert f.read_text() == dedent(
-        """\
-        ```python
-        x = "a" "b"
-        ```
-        """
+    out, _ = capsys.readouterr()
+    assert out == f"{f}: Rewriting...\n"
+    assert f.read_bytes() == (
+        'Café\n\n```python\nf("é")\n```\n\n'
+        "```python\nx = [\n    1,\n    2,\n]\n```\n\n"
+        "```python\ng()\n```\n".encode()
     )
 
 
-def test_integration_pyi(tmp_path):
+def test_integration_mmap_ok(tmp_path, capsys, mmap_all):
     f = tmp_path / "f.md"
-    f.write_text(
-        dedent(
-            """\
-            ```python
-            class Foo: ...
+    f.write_bytes('```python\nf("é")\n```\n'.encode())
 
+    result = blacken_docs.main((str(f),))
 
-            class Bar: ...
-            ```
-            """
-        )
-    )
+    assert result == 0
+    assert not capsys.readouterr()[1]
 
-    result = blacken_docs.main((str(f), "--pyi"))
+
+def test_integration_mmap_check(tmp_path, mmap_all):
+    f = tmp_path / "f.md"
+    text = b"```python\nf( 1 )\n```\n"
+    f.write_bytes(text)
+
+    result = blacken_docs.main((str(f), "--check"))
 
     assert result == 1
-    assert f.read_text() == dedent(
-        """\
-        ```python
-        class Foo: ...
-        class Bar: ...
-        ```
-        """
-    )
+    assert f.read_bytes() == text
 
 
-def test_integration_py36(tmp_path):
+def test_integration_mmap_syntax_error(tmp_path, capsys, mmap_all):
     f = tmp_path / "f.md"
-    f.write_text(
-        "```python\n"
-        "def very_very_long_function_name(\n"
-        "    very_very_very_very_very_very,\n"
-        "    very_very_very_very_very_very,\n"
-        "    *long_long_long_long_long_long\n"
-        "):\n"
-        "    pass\n"
-        "```\n",
-    )
+    f.write_bytes("```python\n'é' ,\n```\n\n```python\nf(\n```\n".encode())
 
     result = blacken_docs.main((str(f),))
-    assert result == 0
 
-    result2 = blacken_docs.main((str(f), "--target-version=py36"))
+    assert result == 2
+    out, _ = capsys.readouterr()
+    assert out.startswith(f"{f}:5: code block parse error")
 
-    assert result2 == 1
-    assert f.read_text() == (
-        "```python\n"
-        "def very_very_long_function_name(\n"
-        "    very_very_very_very_very_very,\n"
-        "    very_very_very_very_very_very,\n"
-        "    *long_long_long_long_long_long,\n"
-        "):\n"
-        "    pass\n"
-        "```\n"
-    )
 
+def test_integration_mmap_crlf(tmp_path, mmap_all):
+    f = tmp_path / "f.md"
+    f.write_bytes(b"```python\r\nf( 1 )\r\n```\r\n")
 
-def test_integration_filename_last(tmp_path):
+    result = blacken_docs.main((str(f),))
+
+    assert result == 1
+    assert f.read_bytes() == b"```python\nf(1)\n```\n"
+
+
+def test_integration_mmap_unicode_space(tmp_path, mmap_all):
     f = tmp_path / "f.md"
-    f.write_text(
-        "```python\n"
-        "def very_very_long_function_name(\n"
-        "    very_very_very_very_very_very,\n"
-        "    very_very_very_very_very_very,\n"
-        "    *long_long_long_long_long_long\n"
-        "):\n"
-        "    pass\n"
-        "```\n",
-    )
+    f.write_bytes("```python\nf( 1 )\n```\u00a0\n".encode())
 
     result = blacken_docs.main((str(f),))
-    assert result == 0
 
-    result2 = blacken_docs.main(("--target-version", "py36", str(f)))
+    assert result == 1
+    assert f.read_bytes() == "```python\nf(1)\n```\u00a0\n".encode()
 
-    assert result2 == 1
-    assert f.read_text() == (
-        "```python\n"
-        "def very_very_long_function_name(\n"
-        "    very_very_very_very_very_very,\n"
-        "    very_very_very_very_very_very,\n"
-        "    *long_long_long_long_long_long,\n"
-        "):\n"
-        "    pass\n"
-        "```\n"
-    )
 
+@pytest.mark.parametrize("exc", [OSError, ValueError])
+def test_integration_mmap_unsupported(tmp_path, mmap_all, monkeypatch, exc):
+    # Falls back to reading as text.
+    def unsupported(*args, **kwargs):
+        raise exc
 
-def test_integration_multiple_target_version(tmp_path):
+    monkeypatch.setattr(mmap, "mmap", unsupported)
     f = tmp_path / "f.md"
-    f.write_text(
-        "```python\n"
-        "def very_very_long_function_name(\n"
-        "    very_very_very_very_very_very,\n"
-        "    very_very_very_very_very_very,\n"
-        "    *long_long_long_long_long_long\n"
-        "):\n"
-        "    pass\n"
-        "```\n",
-    )
+    f.write_bytes("```python\nf( 'é' )\n```\n".encode())
+
+    result = blacken_docs.format_file(str(f), BLACK_MODE, False, False, False)
+
+    assert result == 1
+    assert f.read_bytes() == '```python\nf("é")\n```\n'.encode()
+
+
+@pytest.mark.parametrize("exc", [OSError, ValueError])
+def test_integration_mmap_unsupported_candidates(
+    tmp_path, mmap_all, monkeypatch, capsys, exc
+):
+    # Files are checked for code blocks before importing Black by reading
+    # them instead.
+    def unsupported(*args, **kwargs):
+        raise exc
+
+    monkeypatch.setattr(mmap, "mmap", unsupported)
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n")
 
     result = blacken_docs.main((str(f),))
-    assert result == 0
 
-    result2 = blacken_docs.main(
-        ("--target-version", "py35", "--target-version", "py36", str(f)),
-    )
-    assert result2 == 0
+    assert result == 1
+    assert capsys.readouterr()[0] == f"{f}: Rewriting...\n"
+    assert f.read_text() == "```python\nf(1, 2, 3)\n```\n"
 
 
-def test_integration_skip_string_normalization(tmp_path):
+def test_integration_mmap_invalid_utf8(tmp_path, mmap_all):
     f = tmp_path / "f.md"
-    f.write_text(
-        "```python\nf('hi')\n```\n",
-    )
+    f.write_bytes(b"\xff\n```python\nf( 1 )\n```\n")
 
-    result = blacken_docs.main((str(f), "--skip-string-normalization"))
+    with pytest.raises(UnicodeDecodeError):
+        blacken_docs.main((str(f),))
+
+
+def test_integration_mmap_no_candidates(tmp_path, mmap_all):
+    f = tmp_path / "f.md"
+    f.write_bytes(b"\xff no code blocks\n")
+
+    result = blacken_docs.format_file(str(f), BLACK_MODE, False, False, False)
 
     assert result == 0
-    assert f.read_text() == ("```python\nf('hi')\n```\n")
+    assert f.read_bytes() == b"\xff no code blocks\n"
 
 
-def test_integration_syntax_error(tmp_path, capsys):
-    f = tmp_path / "f.md"
-    f.write_text(
-        "```python\nf(\n```\n",
+def test_integration_mmap_python(tmp_path):
+    # Docstring offsets are of characters, and mapped files are searched by
+    # byte offsets.
+    f = tmp_path / "f.py"
+    padding = "# Café\n" * (blacken_docs.MMAP_MIN_SIZE // 8)
+    f.write_bytes(
+        f'{padding}x = "é"\n\n\ndef f():\n    """\n    ü\n\n'
+        f"    .. code-block:: python\n\n        f( 'é' )\n\n"
+        f'    ü\n    """\n'.encode()
     )
 
     result = blacken_docs.main((str(f),))
 
-    assert result == 2
-    out, _ = capsys.readouterr()
-    assert out.startswith(f"{f}:1: code block parse error")
-    assert f.read_text() == ("```python\nf(\n```\n")
+    assert result == 1
+    assert f.read_bytes() == (
+        f'{padding}x = "é"\n\n\ndef f():\n    """\n    ü\n\n'
+        f'    .. code-block:: python\n\n        f("é")\n\n'
+        f'    ü\n    """\n'.encode()
+    )
 
 
-def test_integration_ignored_syntax_error(tmp_path, capsys):
+def test_integration_mmap_cache(tmp_path, mmap_all, monkeypatch):
     f = tmp_path / "f.md"
-    f.write_text(
-        "```python\nf( )\n```\n\n```python\nf(\n```\n",
-    )
+    f.write_bytes("```python\nf( 'é' )\n```\n".encode())
+    assert blacken_docs.main((str(f),)) == 1
 
-    result = blacken_docs.main((str(f), "--skip-errors"))
+    def fail(*args, **kwargs):  # pragma: no cover
+        raise AssertionError("File should be known to be formatted")
 
-    assert result == 1
-    out, _ = capsys.readouterr()
-    assert f.read_text() == ("```python\nf()\n```\n\n```python\nf(\n```\n")
+    monkeypatch.setattr(blacken_docs, "_format_blocks", fail)
+
+    assert blacken_docs.main((str(f),)) == 0
 
 
 def test_format_src_rst_jupyter_sphinx():
@@ -0,0 +1,262 @@
+from __future__ import annotations
+
+import os
+import pickle
+import time
+
+import black
+import pytest
+
+from blacken_docs import _cache
+
+BLACK_MODE = black.Mode()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = _cache.get_cache(str(tmp_path))
+    yield cache
+    cache.close()
+
+
+def test_get_cache_dir_env(monkeypatch, tmp_path):
+    monkeypatch.setenv("BLACKEN_DOCS_CACHE_DIR", str(tmp_path))
+    assert _cache.get_cache_dir() == str(tmp_path)
+
+
+def test_get_cache_dir_default(monkeypatch):
+    monkeypatch.delenv("BLACKEN_DOCS_CACHE_DIR", raising=False)
+    assert "blacken-docs" in _cache.get_cache_dir()
+
+
+def test_block_miss(cache):
+    assert cache.get_block("f(1,2)\n", BLACK_MODE) is None
+
+
+def test_block_roundtrip(cache, tmp_path):
+    cache.set_block("f(1,2)\n", BLACK_MODE, "f(1, 2)\n")
+    cache.close()
+
+    cache2 = _cache.get_cache(str(tmp_path))
+    try:
+        assert cache2.get_block("f(1,2)\n", BLACK_MODE) == "f(1, 2)\n"
+    finally:
+        cache2.close()
+
+
+def test_block_keyed_by_mode(cache):
+    cache.set_block("f(1,2)\n", BLACK_MODE, "f(1, 2)\n")
+    cache.flush()
+
+    assert cache.get_block("f(1,2)\n", black.Mode(line_length=10)) is None
+
+
+def test_evict_old(cache, tmp_path, monkeypatch):
+    cache.set_block("f(1,2)\n", BLACK_MODE, "f(1, 2)\n")
+    cache.close()
+
+    monkeypatch.setattr(time, "time", lambda: 1e12)
+    cache2 = _cache.get_cache(str(tmp_path))
+    try:
+        assert cache2.get_block("f(1,2)\n", BLACK_MODE) is None
+    finally:
+        cache2.close()
+
+
+def test_evict_excess(cache, tmp_path, monkeypatch):
+    cache.set_block("a\n", BLACK_MODE, "a\n")
+    cache.flush()
+    cache.set_block("b\n", BLACK_MODE, "b\n")
+    cache.close()
+
+    monkeypatch.setattr(_cache, "MAX_ENTRIES", 1)
+    cache2 = _cache.get_cache(str(tmp_path))
+    try:
+        assert cache2.get_block("b\n", BLACK_MODE) == "b\n"
+    finally:
+        cache2.close()
+
+
+def test_memory_evict_least_recent(cache, monkeypatch):
+    monkeypatch.setattr(_cache, "MAX_MEMORY_ENTRIES", 2)
+    for code in ("a\n", "b\n", "c\n"):
+        cache.set_block(code, BLACK_MODE, code)
+    cache.flush()
+
+    assert list(cache._memory.values()) == ["b\n", "c\n"]
+    assert cache.get_block("b\n", BLACK_MODE) == "b\n"
+    assert list(cache._memory.values()) == ["c\n", "b\n"]
+    assert cache.get_block("a\n", BLACK_MODE) == "a\n"
+    assert list(cache._memory.values()) == ["b\n", "a\n"]
+
+
+@pytest.mark.parametrize("corrupt", [False, True])
+def test_unusable(tmp_path, corrupt):
+    # A cache directory that is a file, or a database that isn't one.
+    if corrupt:
+        path = tmp_path / "cache"
+        path.mkdir()
+        (path / _cache.CACHE_FILENAME).write_bytes(b"not a database" * 100)
+    else:
+        path = tmp_path / "file"
+        path.write_text("")
+    f = tmp_path / "f.md"
+    f.write_text("hi\n")
+    cache = _cache.get_cache(str(path))
+    try:
+        assert cache.get_block("a\n", BLACK_MODE) is None
+        cache.set_block("a\n", BLACK_MODE, "a\n")
+        assert not cache.is_file_clean(str(f), BLACK_MODE, "")
+        cache.set_file_clean(str(f), BLACK_MODE, "", "hi\n")
+        cache.flush()
+        assert cache._connection is None
+    finally:
+        cache.close()
+
+
+def test_database_errors(cache, tmp_path):
+    # Errors from a database that stops working, such as when another
+    # process deletes it, are ignored.
+    f = tmp_path / "f.md"
+    f.write_text("hi\n")
+    connection = cache._connect()
+    assert connection is not None
+    connection.execute("DROP TABLE blocks")
+    connection.execute("DROP TABLE files")
+
+    assert cache.get_block("a\n", BLACK_MODE) is None
+    assert not cache.is_file_clean(str(f), BLACK_MODE, "")
+    cache.set_block("a\n", BLACK_MODE, "a\n")
+    cache.set_file_clean(str(f), BLACK_MODE, "", "hi\n")
+    cache.flush()
+
+    assert cache._new == {}
+    assert cache._new_files == {}
+    # Blocks are still remembered in memory.
+    assert cache.get_block("a\n", BLACK_MODE) == "a\n"
+
+
+def test_pickle_reuses_instance(cache):
+    assert pickle.loads(pickle.dumps(cache)) is cache
+
+
+def test_file_unknown(cache, tmp_path):
+    f = tmp_path / "f.md"
+    f.write_text("hi\n")
+
+    assert not cache.is_file_clean(str(f), BLACK_MODE, "")
+
+
+def test_file_missing(cache, tmp_path):
+    assert not cache.is_file_clean(str(tmp_path / "f.md"), BLACK_MODE, "")
+
+
+def test_file_clean(cache, tmp_path):
+    f = tmp_path / "f.md"
+    f.write_text("hi\n")
+    cache.set_file_clean(str(f), BLACK_MODE, "", "hi\n")
+    cache.flush()
+
+    assert cache.is_file_clean(str(f), BLACK_MODE, "")
+    assert not cache.is_file_clean(str(f), BLACK_MODE, "other")
+    assert not cache.is_file_clean(str(f), black.Mode(line_length=10), "")
+
+
+def test_file_touched(cache, tmp_path):
+    f = tmp_path / "f.md"
+    f.write_text("hi\n")
+    cache.set_file_clean(str(f), BLACK_MODE, "", "hi\n")
+    cache.flush()
+    st = f.stat()
+
+    os.utime(f, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    assert cache.is_file_clean(str(f), BLACK_MODE, "")
+
+
+def test_file_touched_hashed_from_file(cache, tmp_path):
+    f = tmp_path / "f.md"
+    f.write_text("hé\n")
+    cache.set_file_clean(str(f), BLACK_MODE, "")
+    cache.flush()
+    st = f.stat()
+
+    os.utime(f, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    assert cache.is_file_clean(str(f), BLACK_MODE, "")
+
+
+def test_file_touched_unreadable(cache, tmp_path):
+    f = tmp_path / "f.md"
+    f.write_text("hi\n")
+    cache.set_file_clean(str(f), BLACK_MODE, "", "hi\n")
+    cache.flush()
+    st = f.stat()
+
+    f.write_bytes(b"\xff\xff\n")
+    os.utime(f, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    assert not cache.is_file_clean(str(f), BLACK_MODE, "")
+
+
+def test_set_file_clean_missing(cache, tmp_path):
+    cache.set_file_clean(str(tmp_path / "f.md"), BLACK_MODE, "")
+
+    assert cache._new_files == {}
+
+
+def test_file_modified_same_size(cache, tmp_path):
+    f = tmp_path / "f.md"
+    f.write_text("hi\n")
+    cache.set_file_clean(str(f), BLACK_MODE, "", "hi\n")
+    cache.flush()
+    st = f.stat()
+
+    f.write_text("ho\n")
+    os.utime(f, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    assert not cache.is_file_clean(str(f), BLACK_MODE, "")
+
+
+def test_file_modified_size(cache, tmp_path):
+    f = tmp_path / "f.md"
+    f.write_text("hi\n")
+    cache.set_file_clean(str(f), BLACK_MODE, "", "hi\n")
+    cache.flush()
+
+    f.write_text("hello\n")
+
+    assert not cache.is_file_clean(str(f), BLACK_MODE, "")
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Requires fork().")
+def test_forked_process_opens_own_connection(cache, tmp_path):
+    cache.set_block("f(1,2)\n", BLACK_MODE, "f(1, 2)\n")
+    cache.flush()
+    assert cache._connection is not None
+
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        child_cache = _cache.get_cache(str(tmp_path))
+        ok = (
+            child_cache is not cache
+            and child_cache._connection is None
+            and child_cache.get_block("f(1,2)\n", BLACK_MODE) == "f(1, 2)\n"
+        )
+        os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert _cache.get_cache(str(tmp_path)) is cache
+
+
+def test_forget_caches(cache, tmp_path, monkeypatch):
+    monkeypatch.setattr(_cache, "_forked_caches", [])
+
+    _cache._forget_caches()
+
+    assert _cache._forked_caches == [cache]
+    new_cache = _cache.get_cache(str(tmp_path))
+    try:
+        assert new_cache is not cache
+    finally:
+        new_cache.close()
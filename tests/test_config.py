@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+from blacken_docs._config import ConfigError, ConfigFinder
+
+
+@pytest.fixture(autouse=True)
+def chdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir(".git")
+
+
+def _write(path: str, text: str) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def test_nearest_pyproject(tmp_path):
+    _write("pyproject.toml", "")
+    _write("a/pyproject.toml", "")
+    _write("a/docs/index.md", "")
+    _write("b/index.md", "")
+    finder = ConfigFinder()
+    assert finder.root(os.path.join("a", "docs", "index.md")) == str(tmp_path / "a")
+    assert finder.root(os.path.join("b", "index.md")) == str(tmp_path)
+    assert finder.root("README.md") == str(tmp_path)
+
+
+def test_no_pyproject_within_repository():
+    _write("pyproject.toml", "")
+    os.makedirs(os.path.join("repo", ".git"))
+    assert ConfigFinder().root(os.path.join("repo", "README.md")) is None
+
+
+def test_root_cached_per_directory(tmp_path, monkeypatch):
+    _write("pyproject.toml", "")
+    finder = ConfigFinder()
+    assert finder.root(os.path.join("docs", "a.md")) == str(tmp_path)
+
+    def fail(path):  # pragma: no cover
+        raise AssertionError("pyproject.toml should not be searched for")
+
+    monkeypatch.setattr(os.path, "isfile", fail)
+    assert finder.root(os.path.join("docs", "b.md")) == str(tmp_path)
+    assert finder.root("c.md") == str(tmp_path)
+
+
+def test_settings(tmp_path):
+    _write(
+        "pyproject.toml",
+        "[tool.blacken-docs]\n"
+        "line-length = 60\n"
+        "target_version = ['py310']\n"
+        "skip-string-normalization = true\n"
+        "\n"
+        "[tool.black]\n"
+        "line-length = 100\n"
+        "preview = true\n",
+    )
+    assert ConfigFinder().settings(str(tmp_path)) == {
+        "line-length": 60,
+        "target-version": ["py310"],
+        "skip-string-normalization": True,
+    }
+
+
+def test_settings_use_black_config(tmp_path):
+    _write(
+        "pyproject.toml",
+        "[tool.blacken-docs]\n"
+        "use-black-config = true\n"
+        "line-length = 60\n"
+        "\n"
+        "[tool.black]\n"
+        "line-length = 100\n"
+        "preview = true\n"
+        "include = '.pyi?$'\n",
+    )
+    assert ConfigFinder().settings(str(tmp_path)) == {
+        "line-length": 60,
+        "preview": True,
+    }
+
+
+def test_settings_cached(tmp_path):
+    _write("pyproject.toml", "[tool.blacken-docs]\nline-length = 60\n")
+    finder = ConfigFinder()
+    settings = finder.settings(str(tmp_path))
+    os.remove("pyproject.toml")
+    assert finder.settings(str(tmp_path)) is settings
+
+
+def test_settings_no_root():
+    assert ConfigFinder().settings(None) == {}
+
+
+def test_settings_not_a_table(tmp_path):
+    _write("pyproject.toml", "[tool]\nblacken-docs = 1\n")
+    assert ConfigFinder().settings(str(tmp_path)) == {}
+
+
+@pytest.mark.parametrize(
+    ("text", "message"),
+    [
+        ("[tool", "Expected ']'"),
+        ("[tool.blacken-docs]\nline-length = '60'\n", "invalid value for line-length"),
+        ("[tool.blacken-docs]\nline-length = true\n", "invalid value for line-length"),
+        (
+            "[tool.blacken-docs]\ntarget-version = 'py310'\n",
+            "invalid value for target-version",
+        ),
+        ("[tool.blacken-docs]\nline-lenght = 60\n", "unknown setting 'line-lenght'"),
+        (
+            "[tool.blacken-docs]\nuse-black-config = 1\n",
+            "use-black-config must be a boolean",
+        ),
+        (
+            "[tool.blacken-docs]\nuse-black-config = true\n[tool.black]\npyi = 'yes'\n",
+            "invalid value for pyi",
+        ),
+    ],
+)
+def test_settings_invalid(tmp_path, text, message):
+    _write("pyproject.toml", text)
+    with pytest.raises(ConfigError) as excinfo:
+        ConfigFinder().settings(str(tmp_path))
+    assert str(excinfo.value).startswith(str(tmp_path / "pyproject.toml"))
+    assert message in str(excinfo.value)
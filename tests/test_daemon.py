@@ -0,0 +1,294 @@
+from __future__ import annotations
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import blacken_docs
+from blacken_docs import _daemon
+
+pytestmark = pytest.mark.skipif(
+    sys.platform == "win32", reason="The daemon is not supported on Windows."
+)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmp_path):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("BLACKEN_DOCS_CACHE_DIR", str(cache_dir))
+    return cache_dir
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    # Unix socket paths are limited to around 100 characters, which pytest's
+    # temporary directories may exceed.
+    path = os.path.join("/tmp", f"blacken-docs-test-{os.getpid()}.sock")
+    yield path
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+@pytest.fixture
+def server(socket_path):
+    server = _daemon._Server(socket_path, blacken_docs._make_parser())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+    if server.executor is not None:
+        server.executor.shutdown()
+
+
+@pytest.fixture
+def no_local_run(monkeypatch):
+    # Only the daemon, running in the test process, may format files.
+    run = blacken_docs._run
+    local = threading.get_ident()
+
+    def _run(*args, **kwargs):
+        assert threading.get_ident() != local, "formatted outside the daemon"
+        return run(*args, **kwargs)
+
+    monkeypatch.setattr(blacken_docs, "_run", _run)
+
+
+def test_default_socket_path_runtime_dir(monkeypatch):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", "/run/user/1000")
+    assert _daemon.default_socket_path() == "/run/user/1000/blacken-docs.sock"
+
+
+def test_default_socket_path_temp_dir(monkeypatch):
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+    assert _daemon.default_socket_path().endswith(f"blacken-docs-{os.getuid()}.sock")
+
+
+def test_request(server, socket_path, tmp_path, capsys, no_local_run):
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n")
+
+    result = blacken_docs.main((str(f), "--use-daemon", "--daemon-socket", socket_path))
+
+    assert result == 1
+    out, _ = capsys.readouterr()
+    assert out == f"{f}: Rewriting...\n"
+    assert f.read_text() == "```python\nf(1, 2, 3)\n```\n"
+
+
+def test_request_relative_paths(
+    server, socket_path, tmp_path, monkeypatch, capsys, no_local_run
+):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "f1.md").write_text("```python\nf(1,2,3)\n```\n")
+    (tmp_path / "f2.md").write_text("```python\nf(1, 2, 3)\n```\n")
+
+    result = blacken_docs.main(
+        ("f1.md", "f2.md", "-j", "2", "--use-daemon", "--daemon-socket", socket_path)
+    )
+
+    assert result == 1
+    out, _ = capsys.readouterr()
+    assert out == "f1.md: Rewriting...\n"
+    assert (tmp_path / "f1.md").read_text() == "```python\nf(1, 2, 3)\n```\n"
+
+
+def test_request_workers(server, socket_path, tmp_path, monkeypatch, no_local_run):
+    # The daemon's workers follow each client's -j, kept for later requests
+    # with the same number.
+    make_executor = blacken_docs._make_executor
+    created = []
+
+    def _make_executor(workers):
+        created.append(workers)
+        return make_executor(workers)
+
+    monkeypatch.setattr(blacken_docs, "_make_executor", _make_executor)
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "f1.md").write_text("```python\nf(1,2,3)\n```\n")
+    (tmp_path / "f2.md").write_text("```python\nf(1, 2, 3)\n```\n")
+
+    results = [
+        _daemon.request(socket_path, ["f1.md", "f2.md", "-j", workers])
+        for workers in ["2", "2", "3"]
+    ]
+
+    assert results == [1, 0, 0]
+    assert created == [2, 3]
+    assert server.workers == 3
+    assert (tmp_path / "f1.md").read_text() == "```python\nf(1, 2, 3)\n```\n"
+
+
+def test_request_error(server, socket_path, capsys, no_local_run):
+    result = blacken_docs.main(
+        ("--workers", "0", "--use-daemon", "--daemon-socket", socket_path)
+    )
+
+    assert result == 2
+    _, err = capsys.readouterr()
+    assert "argument -j/--workers: must be at least 1" in err
+
+
+def test_request_daemon(server, socket_path, capsys):
+    result = _daemon.request(socket_path, ["--daemon"])
+
+    assert result == 2
+    _, err = capsys.readouterr()
+    assert "a daemon is already running" in err
+
+
+def test_request_exception(server, socket_path, tmp_path, capsys, no_local_run):
+    result = blacken_docs.main(
+        (str(tmp_path / "missing.md"), "--use-daemon", "--daemon-socket", socket_path)
+    )
+
+    assert result == 1
+    _, err = capsys.readouterr()
+    assert err.startswith("blacken-docs daemon: FileNotFoundError(")
+
+
+def test_run_other_environment(server):
+    message = {"argv": ["--help"], "cwd": os.getcwd(), "prefix": "/other"}
+
+    assert server.run(message) == {
+        "error": "the daemon runs in a different Python environment"
+    }
+
+
+def test_request_error_response(server, socket_path, monkeypatch):
+    monkeypatch.setattr(server, "run", lambda message: {"error": "nope"})
+
+    assert _daemon.request(socket_path, ["--help"]) is None
+
+
+def test_request_not_running(socket_path, tmp_path):
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n")
+
+    result = blacken_docs.main((str(f), "--use-daemon", "--daemon-socket", socket_path))
+
+    assert result == 1
+    assert f.read_text() == "```python\nf(1, 2, 3)\n```\n"
+
+
+def test_serve(socket_path, tmp_path):
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n")
+    # A socket left behind by a daemon that didn't exit cleanly.
+    with open(socket_path, "w"):
+        pass
+    with subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "blacken_docs",
+            "--daemon",
+            "--daemon-socket",
+            socket_path,
+        ],
+        stderr=subprocess.PIPE,
+        text=True,
+    ) as daemon:
+        try:
+            assert daemon.stderr is not None
+            line = daemon.stderr.readline()
+            assert line == f"blacken-docs daemon listening on {socket_path}\n"
+
+            with pytest.raises(SystemExit) as excinfo:
+                blacken_docs.main(("--daemon", "--daemon-socket", socket_path))
+            assert excinfo.value.code == 2
+
+            assert _daemon.request(socket_path, [str(f)]) == 1
+            assert f.read_text() == "```python\nf(1, 2, 3)\n```\n"
+        finally:
+            daemon.terminate()
+            daemon.wait(timeout=10)
+
+    assert daemon.returncode == 0
+    # The socket is removed before the daemon exits.
+    assert not os.path.exists(socket_path)
+
+
+@pytest.fixture
+def restore_sigterm():
+    handler = signal.getsignal(signal.SIGTERM)
+    yield
+    signal.signal(signal.SIGTERM, handler)
+
+
+def _serve_in_process(
+    socket_path: str, argv: list[str], signum: signal.Signals
+) -> int | None:
+    # Serve on the main thread, as it handles signals, until a client has
+    # made one request and sent signum. Return the request's result.
+    results: list[int | None] = []
+
+    def client() -> None:
+        try:
+            deadline = time.monotonic() + 10
+            result = None
+            while result is None and time.monotonic() < deadline:
+                result = _daemon.request(socket_path, argv)
+                time.sleep(0.01)
+            results.append(result)
+        finally:
+            os.kill(os.getpid(), signum)
+
+    thread = threading.Thread(target=client)
+    thread.start()
+    try:
+        returncode = _daemon.serve(blacken_docs._make_parser(), socket_path)
+    finally:
+        thread.join()
+    assert returncode == 0
+    assert not os.path.exists(socket_path)
+    return results[0]
+
+
+def test_serve_in_process(socket_path, tmp_path, capsys, restore_sigterm):
+    # As test_serve, in this process so coverage sees it.
+    f = tmp_path / "f.md"
+    f.write_text("```python\nf(1,2,3)\n```\n")
+    with open(socket_path, "w"):
+        pass
+
+    with pytest.raises(SystemExit) as excinfo:
+        _serve_in_process(socket_path, [str(f)], signal.SIGTERM)
+
+    assert excinfo.value.code == 0
+    assert not os.path.exists(socket_path)
+    assert f.read_text() == "```python\nf(1, 2, 3)\n```\n"
+    _, err = capsys.readouterr()
+    assert err.startswith(f"blacken-docs daemon listening on {socket_path}\n")
+
+
+def test_serve_interrupted(socket_path, capsys, restore_sigterm):
+    assert _serve_in_process(socket_path, ["--help"], signal.SIGINT) == 0
+
+    out, _ = capsys.readouterr()
+    assert out.startswith("usage: ")
+
+
+def test_serve_already_listening(server, socket_path, capsys):
+    with pytest.raises(SystemExit) as excinfo:
+        _daemon.serve(blacken_docs._make_parser(), socket_path)
+
+    assert excinfo.value.code == 2
+    _, err = capsys.readouterr()
+    assert f"a daemon is already listening on {socket_path}" in err
+
+
+def test_handle_invalid_request(server, socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(b"not json\n")
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile("rb") as f:
+            assert f.read() == b""
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import os
+import re
+
+import pytest
+
+from blacken_docs import _files
+
+INCLUDE = re.compile(_files.DEFAULT_INCLUDES)
+EXCLUDE = re.compile(_files.DEFAULT_EXCLUDES)
+
+
+@pytest.fixture(autouse=True)
+def chdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+
+def _touch(*paths: str) -> None:
+    for path in paths:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w"):
+            pass
+
+
+def _gen_files(
+    *paths: str,
+    include: re.Pattern[str] = INCLUDE,
+    exclude: re.Pattern[str] = EXCLUDE,
+) -> list[str]:
+    return list(_files.gen_files(paths, include=include, exclude=exclude))
+
+
+def test_files():
+    _touch("b.md", "a.rst")
+    assert _gen_files("b.md", "a.rst", "missing.md") == ["b.md", "a.rst", "missing.md"]
+
+
+def test_directory():
+    _touch("d/b.md", "d/a.rst", "d/c/x.tex", "d/c/y.py", "d/z.markdown", "d/other.txt")
+    assert _gen_files("d") == [
+        os.path.join("d", "a.rst"),
+        os.path.join("d", "b.md"),
+        os.path.join("d", "c", "x.tex"),
+        os.path.join("d", "c", "y.py"),
+        os.path.join("d", "z.markdown"),
+    ]
+
+
+def test_directory_default_excludes():
+    _touch("build/a.md", ".tox/b.md", "docs/_build/c.md", "docs/d.md")
+    assert _gen_files(".") == [os.path.join(".", "docs", "d.md")]
+
+
+def test_file_given_directly_not_excluded():
+    _touch("build/a.txt")
+    assert _gen_files(os.path.join("build", "a.txt")) == [
+        os.path.join("build", "a.txt")
+    ]
+
+
+def test_include():
+    _touch("a.md", "b.txt")
+    assert _gen_files(".", include=re.compile(r"\.txt$")) == [
+        os.path.join(".", "b.txt")
+    ]
+
+
+def test_exclude():
+    _touch("a.md", "docs/b.md", "docs/api/c.md")
+    assert _gen_files(".", exclude=re.compile(r"^/docs/api/")) == [
+        os.path.join(".", "a.md"),
+        os.path.join(".", "docs", "b.md"),
+    ]
+
+
+def test_exclude_git_always():
+    _touch(".git/a.md", "b.md")
+    assert _gen_files(".", exclude=re.compile("^$")) == [os.path.join(".", "b.md")]
+
+
+def test_gitignore():
+    _touch("a.md", "ignored.md", "gen/b.md", "docs/c.md", "docs/d.md")
+    with open(".gitignore", "w") as f:
+        f.write("ignored.md\ngen/\n")
+    with open("docs/.gitignore", "w") as f:
+        f.write("/c.md\n")
+    assert _gen_files(".") == [
+        os.path.join(".", "a.md"),
+        os.path.join(".", "docs", "d.md"),
+    ]
+
+
+def test_gitignore_parent():
+    os.mkdir(".git")
+    _touch("docs/a.md", "docs/b.md", "docs/api/c.md")
+    with open(".gitignore", "w") as f:
+        f.write("/docs/b.md\napi/\n")
+    assert _gen_files("docs") == [os.path.join("docs", "a.md")]
+
+
+def test_gitignore_parent_without_gitignore():
+    os.mkdir(".git")
+    _touch("docs/api/a.md", "docs/api/b.md")
+    with open(".gitignore", "w") as f:
+        f.write("b.md\n")
+    assert _gen_files(os.path.join("docs", "api")) == [
+        os.path.join("docs", "api", "a.md")
+    ]
+
+
+def test_gitignore_parent_outside_repository():
+    _touch("docs/a.md", "docs/b.md")
+    with open(".gitignore", "w") as f:
+        f.write("b.md\n")
+    assert _gen_files("docs") == [
+        os.path.join("docs", "a.md"),
+        os.path.join("docs", "b.md"),
+    ]
+
+
+@pytest.mark.skipif(not hasattr(os, "symlink"), reason="Requires symlinks.")
+def test_symlink_directory_not_followed():
+    _touch("d/a.md")
+    os.symlink("..", os.path.join("d", "loop"))
+    assert _gen_files("d") == [os.path.join("d", "a.md")]
+
+
+def test_unreadable_directory_skipped(monkeypatch):
+    # Permissions don't stop root reading directories, so fake it.
+    _touch("d/a.md", "d/sub/b.md")
+    scandir = os.scandir
+
+    def unreadable(path):
+        if os.path.basename(path) == "sub":
+            raise PermissionError(13, "Permission denied", path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", unreadable)
+
+    assert _gen_files("d") == [os.path.join("d", "a.md")]
+
+
+def test_unreadable_gitignore_ignored():
+    _touch("d/a.md", "d/.gitignore/x")
+    assert _gen_files("d") == [os.path.join("d", "a.md")]
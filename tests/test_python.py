@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+from textwrap import dedent
+
+from blacken_docs._python import docstring_spans
+
+
+def _docstrings(src: str) -> list[str]:
+    spans = docstring_spans(src)
+    assert spans is not None
+    return [src[start:end] for start, end in spans]
+
+
+def test_module_class_and_function():
+    src = dedent(
+        '''\
+        """Module."""
+        import x
+
+
+        class A(B, metaclass=M):
+            r\'\'\'Class.\'\'\'
+
+            async def f(self, a: dict = {1: 2}, b=lambda: 3) -> "A":
+                # A comment.
+
+                """Function.
+
+                More.
+                """
+                "Not a docstring."
+        '''
+    )
+    assert _docstrings(src) == [
+        "Module.",
+        "Class.",
+        "Function.\n\n        More.\n        ",
+    ]
+
+
+def test_single_line_bodies():
+    src = "def f(): 'f'\nclass A: 'a'; x = 1\ndef g(): return 'g'\n"
+    assert _docstrings(src) == ["f", "a"]
+
+
+def test_not_docstrings():
+    src = dedent(
+        """\
+        from __future__ import annotations
+        "Not first."
+        def f():
+            b"Bytes."
+        def g():
+            f"Formatted."
+        def h():
+            "Not" "alone."
+        def i():
+            "Not alone.".strip()
+        x = "Assigned."
+        """
+    )
+    assert _docstrings(src) == []
+
+
+def test_tokenize_error():
+    assert docstring_spans('def f():\n    """Unterminated.\n') is None
+
+
+def test_attribute_docstrings():
+    src = dedent(
+        '''\
+        x = 1
+        """Module attribute."""
+
+
+        class A:
+            y: int
+            """Annotated."""
+            z: dict[str, int] = {"a": 1}; "Same line."
+
+            def __init__(self):
+                self.w = 2
+                """Instance attribute."""
+                f(a=1)
+                "After a call."
+                if x: y = 3
+                else: y = 4
+                "After a block."
+            v = 5
+        "After a dedent."
+        '''
+    )
+    assert _docstrings(src) == [
+        "Module attribute.",
+        "Annotated.",
+        "Same line.",
+        "Instance attribute.",
+    ]
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import io
+
+from blacken_docs import _stats
+
+
+def test_slowest_limited(monkeypatch):
+    monkeypatch.setattr(_stats, "TOP", 2)
+    stats = _stats.Stats()
+    with stats.file("f.md"):
+        for lineno, seconds in enumerate((0.3, 0.1, 0.2), 1):
+            stats.add_block("md", lineno, seconds)
+
+    assert sorted(stats.slowest_blocks) == [(0.2, "f.md:3 (md)"), (0.3, "f.md:1 (md)")]
+    assert stats.block_counts == {"md": 3}
+    assert stats.files == 1
+
+
+def test_merge():
+    stats = _stats.Stats()
+    stats.add_phase("black", 1.0)
+    stats.add_block("md", 1, 0.5)
+    other = _stats.Stats()
+    other.add_phase("black", 2.0)
+    other.add_phase("read", 0.5)
+    with other.file("f.rst"):
+        other.add_block("rst", 2, 0.25)
+
+    stats.merge(other)
+
+    assert stats.phase_times == {"black": 3.0, "read": 0.5}
+    assert stats.block_counts == {"md": 1, "rst": 1}
+    assert stats.block_times == {"md": 0.5, "rst": 0.25}
+    assert stats.files == 1
+    assert [filename for _, filename in stats.slowest_files] == ["f.rst"]
+    assert len(stats.slowest_blocks) == 2
+
+
+def test_report():
+    stats = _stats.Stats()
+    with stats.file("f.md"):
+        with stats.phase("black"):
+            pass
+        stats.add_block("md", 3, 0.5)
+    output = io.StringIO()
+
+    stats.report(1.0, file=output)
+
+    report = output.getvalue()
+    assert report.startswith("1 files in 1.000s\n")
+    assert "  black " in report
+    assert "  md                   1     0.500s\n" in report
+    assert "     0.500s f.md:3 (md)\n" in report
+    assert "Peak memory: " in report
+
+
+def test_report_no_peak_memory(monkeypatch):
+    monkeypatch.setattr(_stats, "_peak_memory", lambda: None)
+    output = io.StringIO()
+
+    _stats.Stats().report(1.0, file=output)
+
+    assert "Peak memory" not in output.getvalue()
+
+
+def test_report_skipped():
+    stats = _stats.Stats()
+    other = _stats.Stats()
+    other.skip_file()
+    other.skip_block()
+    other.skip_block()
+    stats.merge(other)
+    output = io.StringIO()
+
+    stats.report(1.0, file=output)
+
+    report = output.getvalue()
+    assert "\nSkipped for size:\n" in report
+    assert "  files                1\n" in report
+    assert "  code blocks          2\n" in report
+
+
+def test_report_nothing_skipped():
+    output = io.StringIO()
+
+    _stats.Stats().report(1.0, file=output)
+
+    assert "Skipped" not in output.getvalue()
+
+
+def test_report_skipped_summary():
+    stats = _stats.Stats()
+    stats.skip_file()
+    stats.skip_block()
+    stats.skip_block()
+    output = io.StringIO()
+
+    stats.report_skipped(file=output)
+
+    assert output.getvalue() == "Skipped 1 files and 2 code blocks for size\n"
+
+
+def test_report_skipped_summary_nothing_skipped():
+    output = io.StringIO()
+
+    _stats.Stats().report_skipped(file=output)
+
+    assert output.getvalue() == ""